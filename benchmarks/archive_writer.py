@@ -0,0 +1,102 @@
+#
+# archive_writer.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Sustained archival with :class:`FileWriter`.
+
+Sends bitrate bit/s of data in 10 ms steps from an inlet to a FileWriter for some seconds
+while the reactor is running. Reports how late the 10 ms steps were (the reactor must never
+block on the disk), the stats of the writer and whether every byte ended up in the file.
+
+Usage: python benchmarks/archive_writer.py [seconds] [bitrate] [fsyncPolicy]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import knive.knive
+from knive.foundation import KNInlet
+from knive.files import FileWriter
+from knive import diskio
+
+from twisted.internet import reactor, task
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    bitrate = int(sys.argv[2]) if len(sys.argv) > 2 else 50000000
+    fsyncPolicy = sys.argv[3] if len(sys.argv) > 3 else 'interval'
+    step = 0.01
+    payload = os.urandom(bitrate / 8 / 100)
+    destdir = tempfile.mkdtemp(prefix='knive-bench-')
+
+    inlet = KNInlet(name='bench')
+    writer = FileWriter(destdir, filename='archive.ts', fsyncPolicy=fsyncPolicy)
+    inlet.addOutlet(writer)
+    writer._start()
+    writer.running = True
+
+    state = {'sent': 0, 'last': None, 'maxLate': 0.0, 'steps': 0}
+
+    def send():
+        now = time.time()
+        if state['last'] is not None:
+            late = now - state['last'] - step
+            if late > state['maxLate']:
+                state['maxLate'] = late
+        state['last'] = now
+        state['steps'] += 1
+        inlet.sendDataToAllOutlets(payload)
+        state['sent'] += len(payload)
+
+    loop = task.LoopingCall(send)
+    loop.start(step)
+
+    def finish():
+        loop.stop()
+        writer.stop()
+        waitForDisk()
+
+    def waitForDisk():
+        if diskio.getPool().pending:
+            reactor.callLater(0.05, waitForDisk)
+            return
+        size = os.path.getsize(os.path.join(destdir, 'archive.ts'))
+        stats = writer.getStats()
+        print "%d s at %.1f Mbit/s, fsync %s" % (seconds, bitrate / 1000000.0, fsyncPolicy)
+        print "sent %d bytes, file has %d bytes: %s" % (state['sent'], size, 'OK' if size == state['sent'] else 'DATA LOST')
+        print "reactor: %d steps, max %.1f ms late" % (state['steps'], state['maxLate'] * 1000)
+        print "writer: %d flushes, latency avg %.1f ms max %.1f ms, max buffered %d bytes, %d pauses, %d fsyncs, %d errors" % (
+            stats['flushes'], stats['flushLatencyAvg'] * 1000, stats['flushLatencyMax'] * 1000,
+            stats['maxBufferedBytes'], stats['pauseCount'], stats['fsyncs'], stats['writeErrors'])
+        print "edge: %s" % inlet.getEdgeStats()
+        shutil.rmtree(destdir)
+        reactor.stop()
+
+    reactor.callLater(seconds, finish)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,471 @@
+#
+# pipeline.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""End to end throughput of knive: publisher -> TCPTSServer -> Channel -> HTTPLiveStream ->
+HTTPLiveVariantStream -> encoder -> segmenter -> playlist.
+
+Builds channels x variants from a generated knive.conf, exactly like kniveServ.py does. The
+encoder and the segmenter are the stand-ins in benchmarks/standins: they copy and cut the
+stream without encoding it, so the numbers are about knive and not about ffmpeg. A second
+process publishes synthetic TS to every channel with :class:`knive.tcpts.TCPTSClient` over
+loopback, paced to speed times real time.
+
+Reported:
+
+- sustained Mbit/s: bytes that went through the channels while publishing, per second.
+  Falls behind the target when knive can't keep up (TCP pushes back on the publisher).
+- segment publish latency: from the moment the keyframe ending a segment was sent until
+  the playlist listing the segment is written.
+- reactor CPU: CPU time of the knive process (reactor and disk I/O threads) per second,
+  and the lag of a 10 ms timer. The CPU time of the stand-ins is reported separately.
+
+Every run is appended to a results file (JSON, one run per line) together with the git
+commit. A run is compared to the last run with the same parameters.
+
+Usage: python benchmarks/pipeline.py [--channels 4] [--variants 3] [--bitrate 4000000] ...
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+
+from twisted.internet import reactor, process, protocol, task
+
+SECRET = 'benchmark'
+
+CONFIG = """
+[paths]
+ffmpegbin = %(bindir)s/ffmpeg
+segmenterbin = %(bindir)s/live_segmenter
+
+[logging]
+logfile = %(workdir)s/knive.log
+loglevel = WARN
+
+[channels]
+"""
+
+CHANNEL = """
+    [[bench%(number)d]]
+    name = Benchmark %(number)d
+    slug = bench%(number)d
+        [[[source]]]
+        type = kniveTCPSource
+        listenPort = %(port)d
+        sharedSecret = %(secret)s
+        [[[outlets]]]
+            [[[[httplive]]]]
+            type = HTTPLive
+            publishURL = http://localhost/bench%(number)d
+            outputLocation = %(outputLocation)s
+            segmenter = %(segmenter)s
+            segmentLength = %(segmentLength)d
+            encoding = %(encoding)s
+            storage = %(storage)s
+"""
+
+VARIANT = """
+                [[[[[%(name)s]]]]]
+                vcodec = copy
+                acodec = copy
+"""
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCHMARKS).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def writeStandins(bindir):
+    """Shell wrappers running the stand-ins with this interpreter"""
+    os.mkdir(bindir)
+    for name in ('ffmpeg', 'live_segmenter'):
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as wrapper:
+            wrapper.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(BENCHMARKS, 'standins', name + '.py')))
+        os.chmod(path, 0755)
+
+
+def writeConfig(workdir, options):
+    bindir = os.path.join(workdir, 'bin')
+    writeStandins(bindir)
+    config = CONFIG % {'bindir': bindir, 'workdir': workdir}
+    for number in range(1, options.channels + 1):
+        outputLocation = os.path.join(workdir, 'bench%d' % number)
+        os.mkdir(outputLocation)
+        config += CHANNEL % {'number': number, 'port': options.port + number - 1, 'secret': SECRET,
+                             'outputLocation': outputLocation, 'segmenter': options.segmenter,
+                             'segmentLength': options.segment_length, 'encoding': options.encoding,
+                             'storage': options.storage}
+        for variant in range(1, options.variants + 1):
+            os.mkdir(os.path.join(outputLocation, 'v%d' % variant))
+            config += VARIANT % {'name': 'v%d' % variant}
+    filename = os.path.join(workdir, 'knive.conf')
+    with open(filename, 'w') as configFile:
+        configFile.write(config)
+    return filename
+
+
+class PublishLatency(object):
+    """Wraps :class:`HTTPLiveStreamM3U8` to time every segment from the keyframe that ends it to the
+    playlist that lists it. Segment boundaries are media times: the sum of the segment durations."""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.start = None
+        """Wall time the publisher sent media time 0"""
+        self.latencies = []
+        self._mediaTime = {}
+        self._pending = {}
+
+    def install(self):
+        from knive.httplive import HTTPLiveStreamM3U8
+        meter = self
+        addSegment = HTTPLiveStreamM3U8.addSegment
+        writeIndexFile = HTTPLiveStreamM3U8.writeIndexFile
+
+        def _addSegment(m3u8, segmentLength=10):
+            segment = addSegment(m3u8, segmentLength)
+            meter._mediaTime[m3u8] = meter._mediaTime.get(m3u8, 0.0) + float(segmentLength)
+            meter._pending.setdefault(m3u8, []).append(meter._mediaTime[m3u8])
+            return segment
+
+        def _writeIndexFile(m3u8):
+            writeIndexFile(m3u8)
+            now = time.time()
+            for mediaTime in meter._pending.pop(m3u8, []):
+                if meter.start is not None:
+                    meter.latencies.append(now - (meter.start + mediaTime / meter.speed))
+
+        HTTPLiveStreamM3U8.addSegment = _addSegment
+        HTTPLiveStreamM3U8.writeIndexFile = _writeIndexFile
+
+
+class ReactorLag(object):
+    """How late a timer that should fire every interval seconds fires"""
+
+    interval = 0.01
+
+    def __init__(self):
+        self.samples = []
+        self._last = None
+        self._loop = task.LoopingCall(self._tick)
+
+    def start(self):
+        self._last = time.time()
+        self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _tick(self):
+        now = time.time()
+        self.samples.append(max(0.0, now - self._last - self.interval))
+        self._last = now
+
+
+class PublisherProtocol(protocol.ProcessProtocol):
+    """Reads 'start <time>' and 'done <bytes> <cpu seconds>' from the publisher"""
+
+    def __init__(self, bench):
+        self.bench = bench
+        self._buffer = ''
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            words = line.split()
+            if words and words[0] == 'start':
+                self.bench.publishStarted(float(words[1]))
+            elif words and words[0] == 'done':
+                self.bench.publishDone(int(words[1]), float(words[2]))
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+    def processEnded(self, reason):
+        self.bench.publisherEnded(reason)
+
+
+class PipelineBenchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.workdir = tempfile.mkdtemp(prefix='knive-pipeline-')
+        self.knive = None
+        self.latency = PublishLatency(options.speed)
+        self.lag = ReactorLag()
+        self.results = None
+        self.failure = None
+        self._start = None
+        self._startUsage = None
+        self._end = None
+        self._endUsage = None
+        self._publishedBytes = None
+        self._publisherCPU = 0.0
+        self._publisherEnded = False
+        self._childrenUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._waitLoop = None
+
+    def run(self):
+        import knive.knive
+        self.latency.install()
+        self.knive = knive.knive.Knive(writeConfig(self.workdir, self.options))
+        for sectionName in self.knive.config['channels']:
+            self.knive.createChannelFromConfig(self.knive.config['channels'][sectionName])
+        self.knive.startService()
+        self.lag.start()
+
+        args = [sys.executable, os.path.abspath(__file__), '--publish',
+                '--channels', str(self.options.channels), '--port', str(self.options.port),
+                '--bitrate', str(self.options.bitrate), '--seconds', str(self.options.seconds),
+                '--speed', str(self.options.speed)]
+        reactor.spawnProcess(PublisherProtocol(self), sys.executable, args, env=os.environ)
+        reactor.callLater(self.options.seconds / self.options.speed + 60, self.fail, 'Timed out')
+        reactor.run()
+        shutil.rmtree(self.workdir, True)
+        if self.failure:
+            raise SystemExit(self.failure)
+        return self.results
+
+    def fail(self, reason):
+        self.failure = reason
+        if reactor.running:
+            reactor.stop()
+
+    def publishStarted(self, start):
+        self.latency.start = start
+        self._start = start
+        self._startUsage = resource.getrusage(resource.RUSAGE_SELF)
+
+    def publishDone(self, publishedBytes, cpu):
+        self._publishedBytes = publishedBytes * self.options.channels
+        self._publisherCPU = cpu
+        self._waitLoop = task.LoopingCall(self._waitForData)
+        self._waitLoop.start(0.01)
+
+    def _bytesThrough(self):
+        return sum([channel.bytesOut for channel in self.knive.channels])
+
+    def _waitForData(self):
+        """The publisher is done when its data went through the channels"""
+        if self._bytesThrough() < self._publishedBytes:
+            return
+        self._waitLoop.stop()
+        self._end = time.time()
+        self._endUsage = resource.getrusage(resource.RUSAGE_SELF)
+        # Give the last segments time to show up in the playlists
+        reactor.callLater(2 + self.options.segment_length / self.options.speed, self.finish)
+
+    def publisherEnded(self, reason):
+        self._publisherEnded = True
+        if self._publishedBytes is None:
+            self.fail('Publisher failed: %s' % reason.value)
+
+    def finish(self):
+        self.lag.stop()
+        stats = self.knive.getStats()
+        self.knive.stopService()
+        # Wait for the publisher and the stand-ins, their CPU time is known once they are reaped
+        self._waitLoop = task.LoopingCall(self._waitForProcesses, time.time() + 10)
+        self._waitLoop.start(0.1)
+
+        options = self.options
+        wallTime = self._end - self._start
+        cpuTime = (self._endUsage.ru_utime + self._endUsage.ru_stime) - (self._startUsage.ru_utime + self._startUsage.ru_stime)
+        channels = stats['channels'].values()
+        segmentsPerVariant = int(options.seconds / options.segment_length) - 1
+        latencies = self.latency.latencies
+        lag = self.lag.samples
+        self.results = {
+            'mbitPerSecond': self._bytesThrough() * 8 / wallTime / 1e6,
+            'targetMbitPerSecond': self._publishedBytes * 8 * options.speed / options.seconds / 1e6,
+            'wallTime': wallTime,
+            'segments': len(latencies),
+            'segmentsExpected': segmentsPerVariant * options.channels * options.variants,
+            'latencyAvg': sum(latencies) / len(latencies) if latencies else None,
+            'latencyP95': percentile(latencies, 0.95),
+            'latencyMax': max(latencies) if latencies else None,
+            'reactorCPU': cpuTime / wallTime,
+            'reactorLagAvg': sum(lag) / len(lag) if lag else None,
+            'reactorLagMax': max(lag) if lag else None,
+            'droppedBytes': sum([channel['droppedBytes'] for channel in channels]),
+            'processRestarts': sum([channel['processRestarts'] for channel in channels]),
+        }
+
+    def _waitForProcesses(self, deadline):
+        if (self._publisherEnded and not process.reapProcessHandlers) or time.time() > deadline:
+            self._waitLoop.stop()
+            reactor.stop()
+
+    def standinCPU(self):
+        """CPU seconds of the encoder and segmenter stand-ins. Known once they are reaped."""
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        before = self._childrenUsage
+        return (usage.ru_utime + usage.ru_stime) - (before.ru_utime + before.ru_stime) - self._publisherCPU
+
+
+def publish(options):
+    """Run by the publisher process. Send options.seconds of synthetic TS to every channel, paced
+    to options.speed times real time."""
+    from knive.foundation import KNInlet
+    from knive.tcpts      import TCPTSClient
+    from synthetic        import SyntheticTS
+
+    stream = SyntheticTS(bitrate=options.bitrate)
+    frames = [stream.nextFrame() for frame in range(int(options.seconds * stream.fps))]
+    inlets = []
+    clients = []
+    for number in range(options.channels):
+        inlet = KNInlet(name='publisher %d' % number)
+        client = TCPTSClient('127.0.0.1', options.port + number, secret=SECRET)
+        inlet.addOutlet(client)
+        inlets.append(inlet)
+        clients.append(client)
+    state = {'sent': 0, 'bytes': 0, 'start': None}
+
+    def _ready():
+        if not all([client.factory.ready for client in clients]):
+            return
+        readyLoop.stop()
+        state['start'] = time.time() + 0.5
+        sys.stdout.write('start %f\n' % state['start'])
+        sys.stdout.flush()
+        reactor.callLater(0.5, sendLoop.start, 0.01)
+
+    def _send():
+        due = min(len(frames), int((time.time() - state['start']) * options.speed * stream.fps) + 1)
+        if due > state['sent']:
+            data = ''.join(frames[state['sent']:due])
+            state['sent'] = due
+            state['bytes'] += len(data)
+            for inlet in inlets:
+                inlet.sendDataToAllOutlets(data)
+        if state['sent'] == len(frames) and not any([client.backlog.getStats()['backlogBytes'] for client in clients]):
+            sendLoop.stop()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            sys.stdout.write('done %d %f\n' % (state['bytes'], usage.ru_utime + usage.ru_stime))
+            sys.stdout.flush()
+            for client in clients:
+                client.stop()
+            reactor.callLater(1, reactor.stop)
+
+    readyLoop = task.LoopingCall(_ready)
+    sendLoop = task.LoopingCall(_send)
+    for client in clients:
+        client.start()
+    readyLoop.start(0.1)
+    reactor.run()
+
+
+def compare(results, previous):
+    print "%-22s %12s %12s %9s" % ('', 'this run', 'previous', 'change')
+    for key in sorted(results):
+        value = results[key]
+        before = previous['results'].get(key) if previous else None
+        change = ''
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+            change = '%+8.1f%%' % ((value - before) * 100.0 / before)
+        print "%-22s %12s %12s %9s" % (key, _format(value), _format(before), change)
+    if previous:
+        print "Previous run: %s (%s)" % (previous['commit'], previous['time'])
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    if value is None:
+        return '-'
+    return str(value)
+
+
+def loadResults(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as resultsFile:
+        return [json.loads(line) for line in resultsFile if line.strip()]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='End to end throughput of knive with stand-in encoder and segmenter.')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--variants', type=int, default=3, help='variants per channel')
+    parser.add_argument('--bitrate', type=int, default=4000000, help='bits per second per channel')
+    parser.add_argument('--seconds', type=int, default=30, help='seconds of stream to publish')
+    parser.add_argument('--speed', type=float, default=1.0, help='publish this many times faster than real time')
+    parser.add_argument('--segmenter', choices=('live_segmenter', 'native'), default='live_segmenter')
+    parser.add_argument('--encoding', choices=('per-variant', 'shared'), default='per-variant')
+    parser.add_argument('--storage', choices=('disk', 'memory', 'both'), default='disk')
+    parser.add_argument('--segment-length', type=int, default=2, help='seconds')
+    parser.add_argument('--port', type=int, default=43300, help='port of the first channel')
+    parser.add_argument('--results', default=os.path.join(BENCHMARKS, 'results', 'pipeline.jsonl'),
+                        help='file the results are appended to (default: %(default)s)')
+    parser.add_argument('--no-save', action='store_true', help="don't append this run to the results file")
+    parser.add_argument('--publish', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.publish:
+        publish(options)
+        return 0
+
+    logging.basicConfig(level=logging.WARN)
+    bench = PipelineBenchmark(options)
+    results = bench.run()
+    results['standinCPU'] = bench.standinCPU() / results['wallTime']
+
+    params = dict([(key, getattr(options, key)) for key in
+                   ('channels', 'variants', 'bitrate', 'seconds', 'speed', 'segmenter', 'encoding', 'storage', 'segment_length')])
+    run = {'commit': gitCommit(), 'time': datetime.datetime.now().isoformat(), 'params': params, 'results': results}
+    previous = [old for old in loadResults(options.results) if old['params'] == params]
+    print "%(channels)d channel(s) x %(variants)d variant(s), %(bitrate)d bit/s at %(speed)gx, %(segmenter)s, %(encoding)s, %(storage)s" % params
+    compare(results, previous[-1] if previous else None)
+
+    if not options.no_save:
+        if not os.path.isdir(os.path.dirname(options.results)):
+            os.makedirs(os.path.dirname(options.results))
+        with open(options.results, 'a') as resultsFile:
+            resultsFile.write(json.dumps(run, sort_keys=True) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,70 @@
+#
+# playlist_updates.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Playlist updates per second of :class:`HTTPLiveStreamM3U8`.
+
+One update is what a segmenter does for every segment: addSegment() and writeIndexFile().
+Measured for live playlists with a 10 and a 10000 segment window and for an append
+only EVENT playlist that already contains 10000 segments.
+
+Usage: python benchmarks/playlist_updates.py [updates]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import knive.knive
+from knive.httplive import HTTPLiveStreamM3U8
+
+
+def run(destdir, window, playlistType, updates):
+    m3u8 = HTTPLiveStreamM3U8(destdir, None, maxSegments=window, playlistType=playlistType, filename='%s-%s.m3u8' % (window, playlistType))
+    m3u8.segmenttitle = 'Benchmark'
+    # Fill the window first
+    for n in range(window):
+        m3u8.addSegment(10.0)
+    m3u8.writeIndexFile()
+
+    start = time.time()
+    for n in range(updates):
+        m3u8.addSegment(9.96)
+        m3u8.writeIndexFile()
+    return updates / (time.time() - start)
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    destdir = tempfile.mkdtemp(prefix='knive-bench-')
+    try:
+        print "%-8s %8s %14s" % ('type', 'window', 'updates/s')
+        for window, playlistType in ((10, None), (10000, None), (10000, 'EVENT')):
+            rate = run(destdir, window, playlistType, updates)
+            print "%-8s %8d %14.0f" % (playlistType or 'live', window, rate)
+    finally:
+        shutil.rmtree(destdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#
+# rechunk_fanout.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Calls per MB through a channel with 4 variants, with and without :class:`TSRechunker`.
+
+The stream is cut into fragments of random size (like TCP delivers it) and sent through
+source -> [rechunker] -> channel -> httplive -> 4 variants -> sink. Every dataReceived of
+every object in the graph counts as a call.
+
+Usage: python benchmarks/rechunk_fanout.py [seconds] [maxFragment]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import knive.knive
+from knive.foundation import KNInlet, KNDistributor, KNOutlet
+from knive.rechunker import TSRechunker
+from synthetic import SyntheticTS
+
+
+class Sink(KNOutlet):
+    def dataReceived(self, data):
+        pass
+
+
+def build(rechunk):
+    source = KNInlet(name='source')
+    top = source
+    if rechunk:
+        rechunker = TSRechunker()
+        rechunker.inlet = source
+        top = rechunker
+    channel = KNDistributor(name='channel')
+    channel.inlet = top
+    stream = KNDistributor(name='httplive')
+    stream.inlet = channel
+    for n in range(4):
+        variant = KNDistributor(name='variant%d' % n)
+        variant.inlet = stream
+        variant.addOutlet(Sink(name='sink%d' % n))
+    return source, top
+
+
+def run(fragments, rechunk):
+    source, top = build(rechunk)
+    start = time.time()
+    for fragment in fragments:
+        source.sendDataToAllOutlets(fragment)
+    if rechunk:
+        top.flush()
+    elapsed = time.time() - start
+    calls = sum([edge['chunksDelivered'] for edge in source.getEdgeStats()])
+    return calls, elapsed
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    maxFragment = int(sys.argv[2]) if len(sys.argv) > 2 else 1448
+    stream = SyntheticTS().read(seconds)
+    random.seed(0)
+    fragments = []
+    offset = 0
+    while offset < len(stream):
+        size = random.randint(1, maxFragment)
+        fragments.append(stream[offset:offset + size])
+        offset += size
+    megabytes = len(stream) / 1048576.0
+
+    print "%.1f MB in %d fragments (1..%d bytes)" % (megabytes, len(fragments), maxFragment)
+    print "%-12s %12s %12s %10s" % ('', 'calls/MB', 'ms/MB', 'MB/s')
+    for rechunk in (False, True):
+        calls, elapsed = run(fragments, rechunk)
+        print "%-12s %12.0f %12.2f %10.1f" % ('rechunked' if rechunk else 'direct', calls / megabytes, elapsed * 1000 / megabytes, megabytes / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#
+# segment_index.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Append and lookup times of :class:`knive.segmentindex.HTTPLiveSegmentIndex`.
+
+Usage: python benchmarks/segment_index.py [hours of segments] [segment length]
+
+12 hours of 2 second segments are 21600 records.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from knive.segmentindex import HTTPLiveSegmentIndex
+
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 12
+    segmentLength = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    records = int(hours * 3600 / segmentLength)
+    epoch = time.time() - hours * 3600
+
+    destdir = tempfile.mkdtemp(prefix='knive-bench-')
+    try:
+        filename = os.path.join(destdir, 'segments.idx')
+        index = HTTPLiveSegmentIndex(filename).open()
+        start = time.time()
+        for number in xrange(1, records + 1):
+            index.append(number, epoch + (number - 1) * segmentLength, segmentLength, 1000000, 'bench-%d.ts' % number)
+        appendTime = time.time() - start
+        index.close()
+
+        openTime = timed(lambda: HTTPLiveSegmentIndex(filename).open().close(), 20)
+        index = HTTPLiveSegmentIndex(filename).open()
+        numbers = [random.randint(1, records) for _ in xrange(1000)]
+        times = [epoch + random.random() * records * segmentLength for _ in xrange(1000)]
+        byIndex = timed(lambda: [index.findIndex(number) for number in numbers], 1) / len(numbers)
+        byTime = timed(lambda: [index.findTime(timestamp) for timestamp in times], 1) / len(times)
+        window = timed(lambda: index.between(times[0], times[0] + 60), 100)
+        tail = timed(lambda: index.tail(10), 100)
+        size = os.path.getsize(filename)
+    finally:
+        shutil.rmtree(destdir)
+
+    print "%d records (%.1f h of %.1f s segments), %.1f KB" % (records, hours, segmentLength, size / 1024.0)
+    print "append   %8.1f us/record" % (appendTime / records * 1e6)
+    print "open     %8.3f ms" % (openTime * 1e3)
+    print "index    %8.1f us/lookup" % (byIndex * 1e6)
+    print "time     %8.1f us/lookup" % (byTime * 1e6)
+    print "60 s     %8.1f us" % (window * 1e6)
+    print "tail(10) %8.1f us" % (tail * 1e6)
+
+
+if __name__ == '__main__':
+    main()
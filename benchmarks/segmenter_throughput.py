@@ -0,0 +1,80 @@
+#
+# segmenter_throughput.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Throughput of :class:`HTTPLiveNativeSegmenter` on synthetic TS.
+
+Usage: python benchmarks/segmenter_throughput.py [seconds of stream] [bitrate]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import knive.knive
+from knive.httplive import HTTPLiveNativeSegmenter, HTTPLiveStreamM3U8
+from synthetic      import SyntheticTS
+
+
+class BenchStream(object):
+    """Stand-in for the HTTPLiveStream a segmenter reports to"""
+    def setLastIndex(self, index):
+        pass
+
+    def segmentMeasured(self, segmenter):
+        pass
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    bitrate = int(sys.argv[2]) if len(sys.argv) > 2 else 4000000
+    stream = SyntheticTS(bitrate=bitrate).read(seconds)
+    reads = [stream[i:i + 32768] for i in range(0, len(stream), 32768)]
+
+    destdir = tempfile.mkdtemp(prefix='knive-bench-')
+    try:
+        segmenter = HTTPLiveNativeSegmenter(name='bench', destdir=destdir, segmentLength=10)
+        segmenter.filePrefix = 'bench-'
+        segmenter.httpStream = BenchStream()
+        # No reactor is running. Write in this thread, the numbers include the disk writes.
+        segmenter.diskIO = None
+        segmenter.m3u8 = HTTPLiveStreamM3U8(destdir, segmenter)
+        segmenter.running = True
+
+        start = time.time()
+        for data in reads:
+            segmenter.dataReceived(data)
+        segmenter.stop()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(destdir)
+
+    megabits = len(stream) * 8 / 1000000.0
+    print "%d s of %.1f Mbit/s TS (%.1f MB) in %.3f s" % (seconds, bitrate / 1000000.0, len(stream) / 1048576.0, elapsed)
+    print "%.1f Mbit/s, %.0fx realtime, %d segments: %s" % (
+        megabits / elapsed, seconds / elapsed, len(segmenter.m3u8.segments),
+        ', '.join('%.2f' % segment.length for segment in segmenter.m3u8.segments))
+
+
+if __name__ == '__main__':
+    main()
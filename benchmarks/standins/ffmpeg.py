@@ -0,0 +1,144 @@
+#
+# ffmpeg.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Stand-in for ffmpeg in benchmarks. Copies STDIN to every output unchanged and reports
+progress like ``ffmpeg -progress`` does. Costs next to no CPU, so a benchmark measures knive
+and not the encoder.
+
+Understands the command lines :class:`knive.ffmpeg.FFMpeg` and :class:`knive.ffmpeg.FFMpegMultiOutput`
+build: ``ffmpeg -y -nostats -progress pipe:3 -i - [options] - | pipe:N [[options] pipe:N ...]``
+"""
+import errno
+import os
+import sys
+import time
+
+TS_PACKET_SIZE = 188
+PROGRESS_INTERVAL = 0.5
+
+
+def outputFD(name):
+    """File descriptor of an output (or progress) url or None"""
+    if name == '-':
+        return 1
+    if name.startswith('pipe:'):
+        return int(name[5:])
+    return None
+
+
+class Progress(object):
+    """Counts video frames (PES starts with a video stream_id) and writes -progress blocks"""
+
+    def __init__(self, fd, outputs, fps):
+        self.fd = fd
+        self.outputs = outputs
+        self.fps = fps
+        self.frames = 0
+        self.bytes = 0
+        self.started = None
+        self.lastReport = 0
+        self._remainder = ''
+
+    def count(self, data):
+        if self.started is None:
+            self.started = time.time()
+        self.bytes += len(data)
+        data = self._remainder + data
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        for pos in xrange(0, end, TS_PACKET_SIZE):
+            if not ord(data[pos + 1]) & 0x40:
+                continue
+            flags = ord(data[pos + 3])
+            start = pos + 4
+            if flags & 0x20:
+                start += 1 + ord(data[pos + 4])
+            if data[start:start + 3] == '\x00\x00\x01' and 0xe0 <= ord(data[start + 3:start + 4] or '\x00') <= 0xef:
+                self.frames += 1
+        self._remainder = data[end:]
+
+    def report(self, end=False):
+        now = time.time()
+        if self.fd is None or (not end and now - self.lastReport < PROGRESS_INTERVAL):
+            return
+        self.lastReport = now
+        elapsed = now - self.started if self.started else 0.0
+        outTime = self.frames / float(self.fps)
+        lines = ['frame=%d' % self.frames, 'fps=%.2f' % (self.frames / elapsed if elapsed else 0.0)]
+        lines.extend(['stream_%d_0_q=-1.0' % output for output in range(self.outputs)])
+        lines.extend([
+            'bitrate=%.1fkbits/s' % (self.bytes * 8 / outTime / 1000 if outTime else 0.0),
+            'total_size=%d' % self.bytes,
+            'out_time_us=%d' % (outTime * 1000000),
+            'out_time_ms=%d' % (outTime * 1000000),
+            'out_time=%02d:%02d:%09.6f' % (outTime // 3600, outTime % 3600 // 60, outTime % 60),
+            'dup_frames=0',
+            'drop_frames=0',
+            'speed=%.3gx' % (outTime / elapsed if elapsed else 0.0),
+            'progress=%s' % ('end' if end else 'continue'),
+        ])
+        os.write(self.fd, '\n'.join(lines) + '\n')
+
+
+def main(args):
+    progressFD = None
+    fps = 25
+    outputs = []
+    afterInput = False
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '-progress':
+            progressFD = outputFD(args[i + 1])
+            i += 1
+        elif arg == '-r':
+            fps = float(args[i + 1])
+            i += 1
+        elif arg == '-i':
+            afterInput = True
+            i += 1
+        elif afterInput and outputFD(arg) is not None:
+            outputs.append(outputFD(arg))
+        i += 1
+
+    sys.stderr.write('ffmpeg stand-in: %d output(s), progress on fd %s\n' % (len(outputs), progressFD))
+    sys.stderr.flush()
+    progress = Progress(progressFD, len(outputs), fps)
+    try:
+        while True:
+            data = os.read(0, 65536)
+            if not data:
+                break
+            progress.count(data)
+            for fd in outputs:
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+            progress.report()
+        progress.report(end=True)
+    except OSError, err:
+        if err.errno != errno.EPIPE:
+            raise
+        # Our reader is gone (knive is stopping)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
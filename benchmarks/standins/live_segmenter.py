@@ -0,0 +1,117 @@
+#
+# live_segmenter.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Stand-in for live_segmenter in benchmarks. Cuts STDIN at the first keyframe after
+segmentLength seconds, writes the segments to tempdir and reports every segment on
+STDERR the way :class:`knive.httplive.SegmenterProtocol` expects it.
+
+Usage: live_segmenter.py <segmentLength> <tempdir> <filePrefix> <encodingProfile>
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from knive.foundation import TS_PACKET_SIZE
+from knive.mpegts     import TSParser, SYNC_BYTE, PTS_CLOCK, ptsDiff
+
+
+class Segmenter(object):
+
+    def __init__(self, segmentLength, tempdir, filePrefix, encodingProfile):
+        self.segmentLength = segmentLength
+        self.tempdir = tempdir
+        self.filePrefix = filePrefix
+        self.encodingProfile = encodingProfile
+        self.parser = TSParser()
+        self.index = 0
+        self.segmentFile = None
+        self.startPTS = None
+        self._remainder = ''
+
+    def feed(self, data):
+        if self._remainder:
+            data = self._remainder + data
+            self._remainder = ''
+        parser = self.parser
+        offset = runStart = 0
+        length = len(data)
+        while offset + TS_PACKET_SIZE <= length:
+            if data[offset] != SYNC_BYTE:
+                offset = data.find(SYNC_BYTE, offset + 1)
+                if offset == -1:
+                    return
+                runStart = offset
+                continue
+            pid = parser.parsePacket(data, offset)
+            if parser.keyframe and pid == parser.cutPid and parser.pts is not None:
+                if self.startPTS is None:
+                    runStart = offset
+                    self.startSegment(parser.pts)
+                elif ptsDiff(parser.pts, self.startPTS) >= self.segmentLength * PTS_CLOCK:
+                    self.write(data[runStart:offset])
+                    runStart = offset
+                    self.finishSegment(parser.pts)
+                    self.startSegment(parser.pts)
+            offset += TS_PACKET_SIZE
+        self.write(data[runStart:offset])
+        self._remainder = data[offset:]
+
+    def write(self, data):
+        if self.segmentFile is not None and data:
+            self.segmentFile.write(data)
+
+    def startSegment(self, pts):
+        self.index += 1
+        self.startPTS = pts
+        filename = os.path.join(self.tempdir, '%s-%08d.ts' % (self.encodingProfile, self.index))
+        self.segmentFile = open(filename, 'wb')
+        self.segmentFile.write(self.parser.patPacket + self.parser.pmtPacket)
+
+    def finishSegment(self, pts, end=0):
+        self.segmentFile.close()
+        self.segmentFile = None
+        duration = ptsDiff(pts, self.startPTS) / float(PTS_CLOCK)
+        # 'segmenter: <firstsegment>, <lastsegment>, <end>, <encodingprofile>, <duration>'
+        sys.stderr.write('segmenter: 1, %d, %d, %s, %.2f\n' % (self.index, end, self.encodingProfile, duration))
+        sys.stderr.flush()
+
+    def close(self):
+        if self.segmentFile is not None and self.parser.lastPTS is not None:
+            self.finishSegment(self.parser.lastPTS, end=1)
+
+
+def main(args):
+    if len(args) != 4:
+        sys.stderr.write(__doc__)
+        return 2
+    segmenter = Segmenter(int(args[0]), args[1], args[2], args[3])
+    while True:
+        data = os.read(0, 65536)
+        if not data:
+            break
+        segmenter.feed(data)
+    segmenter.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,131 @@
+#
+# synthetic.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Synthetic MPEG-TS for benchmarks.
+
+Produces a valid looking transport stream with one h264 video PID (IDR every gop
+frames, random access indicator and PCR on keyframes) and one AAC audio PID. The
+payload is filler behind a real SPS (High profile 1280x720) and ADTS header. Good enough
+for everything that only looks at TS/PES headers.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from knive.foundation import TS_PACKET_SIZE
+from knive.mpegts     import encodeTimestamp, PTS_CLOCK
+
+PMT_PID = 0x1000
+VIDEO_PID = 0x100
+AUDIO_PID = 0x101
+
+SPS_NAL = '\x00\x00\x00\x01\x67' + '4d401fe8802802dd80b501010140000003004000000ca3c60c4480'.decode('hex')
+ADTS_HEADER = '\xff\xf1\x50\x80'
+
+
+def _crc32(data):
+    crc = 0xffffffff
+    for byte in data:
+        crc ^= ord(byte) << 24
+        for _ in range(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ 0x04c11db7) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+    return ''.join(chr((crc >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+def _section(tableId, body):
+    length = len(body) + 5 + 4
+    section = chr(tableId) + chr(0xb0 | (length >> 8)) + chr(length & 0xff) + '\x00\x01\xc1\x00\x00' + body
+    section += _crc32(section)
+    return section
+
+
+def _packet(pid, payload, counter, unitStart=False, adaptation=''):
+    header = chr(0x47) + chr((0x40 if unitStart else 0) | (pid >> 8)) + chr(pid & 0xff)
+    space = TS_PACKET_SIZE - 4
+    if adaptation or len(payload) < space:
+        stuffing = space - len(payload) - 1
+        field = adaptation or ('\x00' if stuffing > 0 else '')
+        if stuffing > 0:
+            field = field + '\xff' * (stuffing - len(field))
+        header += chr(0x30 | (counter & 0x0f)) + chr(len(field)) + field
+    else:
+        header += chr(0x10 | (counter & 0x0f))
+    return header + payload
+
+
+class SyntheticTS(object):
+    """Generates a TS with a constant bitrate. Call :meth:`read` to get the next n seconds."""
+
+    def __init__(self, bitrate=2000000, fps=25, gop=50):
+        super(SyntheticTS, self).__init__()
+        self.fps = fps
+        self.gop = gop
+        self.frameBytes = max(bitrate // 8 // fps, 200)
+        self.frame = 0
+        self.counters = {}
+
+    def _counter(self, pid):
+        self.counters[pid] = (self.counters.get(pid, -1) + 1) & 0x0f
+        return self.counters[pid]
+
+    def _tables(self):
+        pat = _section(0x00, '\x00\x01' + chr(0xe0 | (PMT_PID >> 8)) + chr(PMT_PID & 0xff))
+        streams = ('\x1b' + chr(0xe0 | (VIDEO_PID >> 8)) + chr(VIDEO_PID & 0xff) + '\xf0\x00' +
+                   '\x0f' + chr(0xe0 | (AUDIO_PID >> 8)) + chr(AUDIO_PID & 0xff) + '\xf0\x00')
+        pmt = _section(0x02, chr(0xe0 | (VIDEO_PID >> 8)) + chr(VIDEO_PID & 0xff) + '\xf0\x00' + streams)
+        return (_packet(0, '\x00' + pat, self._counter(0), unitStart=True) +
+                _packet(PMT_PID, '\x00' + pmt, self._counter(PMT_PID), unitStart=True))
+
+    def _pes(self, pid, streamId, pts, payload, keyframe):
+        pes = '\x00\x00\x01' + streamId + '\x00\x00' + '\x80\x80\x05' + encodeTimestamp(0x2, pts) + payload
+        packets = []
+        first = True
+        while pes:
+            adaptation = ''
+            if first and keyframe:
+                pcr = pts - 9000
+                adaptation = '\x50' + ''.join(chr((pcr >> shift) & 0xff) for shift in (25, 17, 9, 1)) + chr(((pcr & 1) << 7) | 0x7e) + '\x00'
+            space = TS_PACKET_SIZE - 4 - (len(adaptation) + 1 if adaptation else 0)
+            chunk, pes = pes[:space], pes[space:]
+            packets.append(_packet(pid, chunk, self._counter(pid), unitStart=first, adaptation=adaptation))
+            first = False
+        return ''.join(packets)
+
+    def nextFrame(self):
+        """Return the packets of the next video frame and its audio"""
+        keyframe = self.frame % self.gop == 0
+        pts = 90000 + self.frame * PTS_CLOCK // self.fps
+        data = ''
+        if keyframe:
+            data += self._tables()
+        nal = SPS_NAL + '\x00\x00\x00\x01\x65' if keyframe else '\x00\x00\x00\x01\x41'
+        data += self._pes(VIDEO_PID, '\xe0', pts, nal + '\x00' * self.frameBytes, keyframe)
+        data += self._pes(AUDIO_PID, '\xc0', pts, ADTS_HEADER + '\x00' * 296, False)
+        self.frame += 1
+        return data
+
+    def read(self, seconds):
+        """Return the next seconds of the stream"""
+        return ''.join(self.nextFrame() for _ in range(int(seconds * self.fps)))
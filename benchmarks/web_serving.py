@@ -0,0 +1,365 @@
+#
+# web_serving.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""How many HLS viewers can one knive process serve?
+
+A server process serves one variant with :class:`webknive.hls.WebLive`, from a
+:class:`knive.httplive.HTTPLiveSegmentStore` (--storage memory) or from files (--storage disk).
+A new segment of bitrate x segment length bytes is published every segment length seconds.
+
+Client processes run the viewers. Every viewer keeps one HTTP/1.1 connection and behaves like
+a player: it reloads the playlist (If-None-Match, gzip) and fetches every new segment, paced
+to real time. With --flood viewers don't wait and fetch the newest segment over and over,
+which gives the most requests per second the server can answer.
+
+Reported:
+
+- requests/s and Mbit/s delivered
+- latency (request sent until the last byte arrived) of playlist and segment requests
+- late segments: segment downloads that took longer than a segment lasts. A player would stall.
+- CPU of the server process and hit rate of its object cache
+
+Usage: python benchmarks/web_serving.py [--viewers 2000] [--seconds 20] [--bitrate 2000000] ...
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+
+PLAYLIST = 'stream.m3u8'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def raiseFileLimit():
+    """Every viewer needs a socket on both ends"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class BenchSegmenter(object):
+    def __init__(self, writeToDisk):
+        self.writeToDisk = writeToDisk
+
+
+class BenchVariant(object):
+    """What :class:`webknive.hls.WebLive` needs of a :class:`knive.httplive.HTTPLiveVariantStream`"""
+
+    def __init__(self, store, destdir):
+        self.store = store
+        self.segmenter = BenchSegmenter(destdir is not None)
+        self.destinationDirectory = destdir
+
+
+class BenchBackend(object):
+    """Publishes a segment every segmentLength seconds to the store or to destdir"""
+
+    window = 6
+
+    def __init__(self, options, destdir=None):
+        from knive.httplive import HTTPLiveSegmentStore
+        self.options = options
+        self.segmentLength = options.segment_length
+        self.segmentSize = options.bitrate * options.segment_length // 8
+        store = None
+        if destdir is None:
+            store = HTTPLiveSegmentStore(maxSegments=self.window + 3)
+        self.variant = BenchVariant(store, destdir)
+        self.destdir = destdir
+        self.index = 0
+        for n in range(self.window):
+            self.publish()
+
+    def publish(self):
+        self.index += 1
+        filename = 's%d.ts' % self.index
+        data = os.urandom(256) * (self.segmentSize // 256)
+        first = max(self.index - self.window + 1, 1)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:%d' % self.segmentLength,
+                 '#EXT-X-MEDIA-SEQUENCE:%d' % first]
+        for index in range(first, self.index + 1):
+            lines.append('#EXT-X-PROGRAM-DATE-TIME:2012-01-01T00:00:%02d.000Z' % (index % 60))
+            lines.append('#EXTINF:%d, Benchmark segment %d' % (self.segmentLength, index))
+            lines.append('s%d.ts' % index)
+        playlist = '\n'.join(lines) + '\n'
+        if self.variant.store is not None:
+            self.variant.store.addSegment(filename, data)
+            self.variant.store.setPlaylist(PLAYLIST, playlist)
+        else:
+            with open(os.path.join(self.destdir, filename), 'wb') as f:
+                f.write(data)
+            with open(os.path.join(self.destdir, PLAYLIST + '.tmp'), 'wb') as f:
+                f.write(playlist)
+            os.rename(os.path.join(self.destdir, PLAYLIST + '.tmp'), os.path.join(self.destdir, PLAYLIST))
+            old = os.path.join(self.destdir, 's%d.ts' % (self.index - self.window - 3))
+            if os.path.exists(old):
+                os.unlink(old)
+
+    def getVariantStream(self, channelSlug, qualityName):
+        if channelSlug == 'bench' and qualityName == 'q':
+            return self.variant
+        return None
+
+    def getMasterPlaylist(self, channelSlug):
+        return None
+
+
+def serve(options):
+    """The server process. Prints its stats as JSON when it gets SIGTERM."""
+    import knive.knive
+    from twisted.internet import reactor, task
+    from twisted.web import server
+    from twisted.web.resource import Resource
+    from webknive.hls import WebLive
+
+    class QuietSite(server.Site):
+        def log(self, request):
+            pass
+
+    raiseFileLimit()
+    destdir = tempfile.mkdtemp(prefix='knive-web-') if options.storage == 'disk' else None
+    backend = BenchBackend(options, destdir)
+    root = Resource()
+    live = WebLive(backend)
+    root.putChild('live', live)
+    reactor.listenTCP(options.port, QuietSite(root), backlog=4096, interface='127.0.0.1')
+    publisher = task.LoopingCall(backend.publish)
+    publisher.start(options.segment_length, now=False)
+    reactor.run()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = live.cache.getStats()
+    stats['cpu'] = usage.ru_utime + usage.ru_stime
+    stats['segmentsPublished'] = backend.index
+    sys.stdout.write(json.dumps(stats) + '\n')
+    if destdir is not None:
+        shutil.rmtree(destdir, True)
+
+
+def runViewers(options, count, results):
+    """A client process with count viewers. Puts its stats into results."""
+    from twisted.internet import reactor, protocol
+
+    stats = {'requests': 0, 'bytes': 0, 'notModified': 0, 'errors': 0, 'lateSegments': 0,
+             'segments': 0, 'playlistLatency': [], 'segmentLatency': [], 'connectionsLost': 0}
+    deadline = time.time() + options.seconds
+    flood = options.flood
+
+    class Viewer(protocol.Protocol):
+        def connectionMade(self):
+            self.buffer = ''
+            self.response = None
+            self.etag = None
+            self.fetched = None
+            self.queue = []
+            self.poll()
+
+        def request(self, path, kind, headers=''):
+            if time.time() >= deadline:
+                self.transport.loseConnection()
+                return
+            self.kind = kind
+            self.sent = time.time()
+            self.transport.write('GET /live/bench/q/%s HTTP/1.1\r\nHost: bench\r\n%s\r\n' % (path, headers))
+
+        def poll(self):
+            headers = 'Accept-Encoding: gzip\r\n'
+            if self.etag is not None and not flood:
+                headers += 'If-None-Match: %s\r\n' % self.etag
+            self.request(PLAYLIST, 'playlist', headers)
+
+        def dataReceived(self, data):
+            self.buffer += data
+            while True:
+                if self.response is None:
+                    end = self.buffer.find('\r\n\r\n')
+                    if end < 0:
+                        return
+                    lines = self.buffer[:end].split('\r\n')
+                    self.buffer = self.buffer[end + 4:]
+                    headers = dict([(name.lower(), value.strip()) for name, value in
+                                    [line.split(':', 1) for line in lines[1:]]])
+                    status = int(lines[0].split()[1])
+                    length = 0 if status == 304 else int(headers.get('content-length', 0))
+                    self.response = (status, headers, length)
+                status, headers, length = self.response
+                if len(self.buffer) < length:
+                    return
+                body, self.buffer = self.buffer[:length], self.buffer[length:]
+                self.response = None
+                self.responseReceived(status, headers, body)
+
+        def responseReceived(self, status, headers, body):
+            latency = time.time() - self.sent
+            stats['requests'] += 1
+            stats['bytes'] += len(body)
+            if status == 304:
+                stats['notModified'] += 1
+            elif status != 200:
+                stats['errors'] += 1
+            if self.kind == 'playlist':
+                stats['playlistLatency'].append(latency)
+                if status == 200:
+                    self.etag = headers.get('etag')
+                    if headers.get('content-encoding') == 'gzip':
+                        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                    segments = [line for line in body.splitlines() if line and not line.startswith('#')]
+                    if flood or self.fetched is None:
+                        self.queue = segments[-1:]
+                    else:
+                        self.queue = segments[segments.index(self.fetched) + 1:] if self.fetched in segments else segments[-1:]
+            else:
+                stats['segments'] += 1
+                stats['segmentLatency'].append(latency)
+                if latency > options.segment_length:
+                    stats['lateSegments'] += 1
+                if status == 200:
+                    self.fetched = self.segment
+            self.next()
+
+        def next(self):
+            if self.queue:
+                self.segment = self.queue.pop(0)
+                self.request(self.segment, 'segment')
+            elif flood:
+                self.poll()
+            else:
+                # Reload once per target duration
+                reactor.callLater(options.segment_length, self.poll)
+
+        def connectionLost(self, reason):
+            if time.time() < deadline:
+                stats['connectionsLost'] += 1
+
+    factory = protocol.ClientFactory()
+    factory.protocol = Viewer
+    raiseFileLimit()
+    ramp = 0 if flood else options.segment_length
+    for n in range(count):
+        reactor.callLater(ramp * n / float(count), reactor.connectTCP, '127.0.0.1', options.port, factory, timeout=30)
+    reactor.callLater(options.seconds + 1, reactor.stop)
+    reactor.run()
+    results.put(stats)
+
+
+def waitForPort(port, timeout=10):
+    until = time.time() + timeout
+    while time.time() < until:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='HLS viewers served by one knive process.')
+    parser.add_argument('--viewers', type=int, default=2000)
+    parser.add_argument('--seconds', type=int, default=20)
+    parser.add_argument('--bitrate', type=int, default=2000000, help='bits per second of the variant')
+    parser.add_argument('--segment-length', type=int, default=2, help='seconds')
+    parser.add_argument('--storage', choices=('memory', 'disk'), default='memory')
+    parser.add_argument('--flood', action='store_true', help="viewers don't wait, requests per second is the limit")
+    parser.add_argument('--clients', type=int, default=max(multiprocessing.cpu_count() - 1, 1), help='client processes')
+    parser.add_argument('--port', type=int, default=43800)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARN)
+    if options.serve:
+        serve(options)
+        return 0
+
+    limit = raiseFileLimit()
+    if options.viewers + 100 > limit:
+        print "Open file limit is %d. Raise it (ulimit -n) for %d viewers." % (limit, options.viewers)
+        return 1
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve'] + argv, stdout=subprocess.PIPE)
+    try:
+        if not waitForPort(options.port):
+            print "Server did not start"
+            return 1
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=runViewers, args=(options, options.viewers // options.clients +
+                                                                    (1 if n < options.viewers % options.clients else 0), results))
+                   for n in range(options.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        collected = [results.get() for client in clients]
+        for client in clients:
+            client.join()
+        wallTime = time.time() - start
+    finally:
+        server.terminate()
+        serverStats = json.loads(server.communicate()[0] or '{}')
+
+    stats = {}
+    for key in collected[0]:
+        if isinstance(collected[0][key], list):
+            stats[key] = sum([result[key] for result in collected], [])
+        else:
+            stats[key] = sum([result[key] for result in collected])
+
+    seconds = float(options.seconds)
+    print "%d viewer(s) of %d bit/s, %d s segments, %s storage%s, %d client process(es)" % (
+        options.viewers, options.bitrate, options.segment_length, options.storage, ', flood' if options.flood else '', options.clients)
+    print "%-26s %12.0f" % ('requests/s', stats['requests'] / seconds)
+    print "%-26s %12.1f" % ('Mbit/s', stats['bytes'] * 8 / seconds / 1e6)
+    print "%-26s %12d" % ('segments', stats['segments'])
+    print "%-26s %12d" % ('late segments', stats['lateSegments'])
+    print "%-26s %12d" % ('304 Not Modified', stats['notModified'])
+    print "%-26s %12d" % ('errors', stats['errors'])
+    print "%-26s %12d" % ('connections lost', stats['connectionsLost'])
+    for kind in ('playlist', 'segment'):
+        latencies = stats[kind + 'Latency']
+        if latencies:
+            print "%-26s %9.1f ms %9.1f ms" % (kind + ' latency p50/p99', percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+    if serverStats:
+        print "%-26s %11.0f%%" % ('server CPU', serverStats['cpu'] / wallTime * 100)
+        lookups = serverStats['hits'] + serverStats['misses']
+        print "%-26s %11.1f%%" % ('cache hit rate', serverStats['hits'] * 100.0 / lookups if lookups else 0)
+        print "%-26s %12d" % ('file reads', serverStats['fileReads'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -27,7 +27,11 @@
 
 """
 
-from foundation import KNDistributor
+from foundation     import KNDistributor
+from kninterfaces   import IKNRecorder
+from episode        import Episode
+
+from twisted.internet import reactor
 
 class Channel(KNDistributor):
     """A channel (also called Stream or Show) is the central element. For example a podcast project or a room at a conference is a channel.
@@ -52,27 +56,39 @@ class Channel(KNDistributor):
 
         self._recording = False
         self._lastRecording = None
+        self._autoStop = None
 
     def __str__(self):
         return "%s/%s (%s) %s episodes" % (self.slug,self.name,self.url,len(self.episodes))
 
 
-    def startRecording(self):
-        """Starts a recording of the stream. Return an episode object if recording started."""
+    def startRecording(self,autoStop=None,title=None):
+        """Starts a recording of the stream. Return an episode object if recording started.
+
+        Kwargs:
+            autoStop: Stop the recording after autoStop seconds.
+            title: Title of the episode.
+        """
         if not self._recording:
             self._recording = True
-            episode = Episode()
+            episode = Episode(self,len(self.episodes) + 1,title=title)
             self.episodes.append(episode)
             episode.start()
+            self.log.info('Recording episode %s' % episode)
             for outlet in self.outlets:
                 if IKNRecorder.providedBy(outlet):
-                    outlet.startRecording()
+                    outlet.startRecording(episode)
+            if autoStop:
+                self._autoStop = reactor.callLater(autoStop,self.stopRecording)
             return episode
 
     def stopRecording(self):
         """Stops a running recording."""
         if self._recording:
             self._recording = False
+            if self._autoStop is not None and self._autoStop.active():
+                self._autoStop.cancel()
+            self._autoStop = None
             for outlet in self.outlets:
                 if IKNRecorder.providedBy(outlet):
                     outlet.stopRecording()
@@ -0,0 +1,172 @@
+#
+# diskio.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Blocking file operations off the reactor thread.
+
+Moving segments, writing playlists and fsyncing archive files may block for a
+long time on a slow disk. :class:`KNDiskIOPool` runs them in a bounded pool of
+worker threads. Operations submitted with the same key (e.g. the directory of a
+variant) run one after the other in the order they were submitted.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from twisted.internet         import reactor
+from twisted.internet.defer   import Deferred, maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+import logging
+import time
+
+
+class KNDiskIOPool(object):
+    """A bounded pool of threads for blocking disk I/O with per key ordering and latency stats"""
+
+    def __init__(self, maxThreads=4, name='knive-diskio'):
+        super(KNDiskIOPool, self).__init__()
+        self.log = logging.getLogger('[%s]' % (self.__class__.__name__))
+        self.maxThreads = maxThreads
+        self._threadPool = ThreadPool(minthreads=1, maxthreads=maxThreads, name=name)
+        self._tails = {}
+        """Keys mapped to the Deferred of the last operation submitted for them"""
+        self.pending = 0
+        """Operations submitted but not finished yet"""
+        self.stats = {}
+        """Operation names mapped to their stats. See :meth:`getStats`"""
+
+    def start(self):
+        if not self._threadPool.started:
+            self._threadPool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._threadPool.started:
+            self._threadPool.stop()
+
+    def setMaxThreads(self, maxThreads):
+        self.maxThreads = maxThreads
+        self._threadPool.adjustPoolsize(minthreads=1, maxthreads=maxThreads)
+
+    def run(self, key, opName, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in a worker thread after all operations submitted earlier with the same key.
+        Returns a Deferred firing with the result of func or failing with its exception. Failures are
+        counted, handling them is up to the caller."""
+        self.start()
+        submitted = time.time()
+        self.pending += 1
+
+        def _submit(ignored):
+            return deferToThreadPool(reactor, self._threadPool, _timed)
+
+        def _timed():
+            started = time.time()
+            result = func(*args, **kwargs)
+            return (started, time.time(), result)
+
+        def _done(timedResult):
+            started, finished, result = timedResult
+            self._record(opName, started - submitted, finished - started)
+            return result
+
+        def _failed(failure):
+            self._record(opName, None, None)
+            return failure
+
+        def _finished(result):
+            self.pending -= 1
+            if self._tails.get(key) is d:
+                del self._tails[key]
+            return result
+
+        previous = self._tails.get(key)
+        if previous is None:
+            d = _submit(None)
+        else:
+            d = Deferred()
+
+            def _next(result):
+                d.callback(None)
+                return result
+            previous.addBoth(_next)
+            d.addCallback(_submit)
+        d.addCallbacks(_done, _failed)
+        d.addBoth(_finished)
+        self._tails[key] = d
+        return d
+
+    def _record(self, opName, queueLatency, runTime):
+        stats = self.stats.get(opName)
+        if stats is None:
+            stats = self.stats[opName] = {
+                'count': 0,
+                'failures': 0,
+                'queueLatencyTotal': 0.0,
+                'queueLatencyMax': 0.0,
+                'runTimeTotal': 0.0,
+                'runTimeMax': 0.0,
+            }
+        if queueLatency is None:
+            stats['failures'] += 1
+            return
+        stats['count'] += 1
+        stats['queueLatencyTotal'] += queueLatency
+        stats['runTimeTotal'] += runTime
+        if queueLatency > stats['queueLatencyMax']:
+            stats['queueLatencyMax'] = queueLatency
+        if runTime > stats['runTimeMax']:
+            stats['runTimeMax'] = runTime
+
+    def getStats(self):
+        """Return a dictionary with the number of pending operations and, per operation type, counts,
+        average and maximum queue latency (time waiting for a thread and for earlier operations) and run time in seconds."""
+        operations = {}
+        for opName, stats in self.stats.items():
+            count = stats['count'] or 1
+            operations[opName] = {
+                'count': stats['count'],
+                'failures': stats['failures'],
+                'queueLatencyAvg': stats['queueLatencyTotal'] / count,
+                'queueLatencyMax': stats['queueLatencyMax'],
+                'runTimeAvg': stats['runTimeTotal'] / count,
+                'runTimeMax': stats['runTimeMax'],
+            }
+        return {'threads': self.maxThreads, 'pending': self.pending, 'operations': operations}
+
+
+_pool = None
+
+
+def getPool():
+    """Return the disk I/O pool shared by all objects of this process"""
+    global _pool
+    if _pool is None:
+        _pool = KNDiskIOPool()
+    return _pool
+
+
+def deferToDiskIO(pool, key, opName, func, *args):
+    """Run func in pool (see :meth:`KNDiskIOPool.run`). If pool is None func is called right away.
+    Either way a Deferred is returned."""
+    if pool is None:
+        return maybeDeferred(func, *args)
+    return pool.run(key, opName, func, *args)
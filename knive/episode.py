@@ -0,0 +1,74 @@
+#!/usr/bin/env/python
+#
+# episode.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Episodes are the recordings of a channel. One episode per :meth:`channel.Channel.startRecording`.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+import time
+
+
+class Episode(object):
+    """A recording of a channel between startdate and enddate. Every IKNRecorder outlet of the
+    channel registers its :class:`kninterfaces.IKNRecording` with the episode."""
+
+    def __init__(self,channel,index,title=None):
+        """
+        Args:
+            channel: The :class:`channel.Channel` this episode belongs to.
+            index: Number of the episode in the channel.
+
+        Kwargs:
+            title: Title of the episode. Defaults to the name of the channel.
+        """
+        super(Episode, self).__init__()
+        self.channel = channel
+        self.index = index
+        self.title = title or channel.name
+        self.startdate = None
+        """Wall clock time the recording started"""
+        self.enddate = None
+        """Wall clock time the recording stopped"""
+        self.slug = None
+        """Name of the episode in paths. Unique per channel (from the slug of the channel and startdate)."""
+        self.recordings = []
+        """The recordings of the outlets"""
+
+    def __str__(self):
+        return "%s (%s)" % (self.title,self.slug)
+
+    @property
+    def recording(self):
+        return self.startdate is not None and self.enddate is None
+
+    def start(self):
+        self.startdate = time.time()
+        self.slug = "%s-%s" % (self.channel.slug,time.strftime("%Y%m%d-%H%M%S",time.gmtime(self.startdate)))
+
+    def stop(self):
+        self.enddate = time.time()
+
+    def register(self,recording):
+        """Called by the IKNRecorder outlets for the recording they started"""
+        self.recordings.append(recording)
@@ -20,22 +20,131 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
-import re
+import time
 from foundation import KNDistributor, KNProcessProtocol
+from supervisor import KNProcessSupervisor
 from twisted.internet       import reactor
 from twisted.python         import log
 
+PROGRESS_FD = 3
+"""ffmpeg writes its -progress output to this file descriptor"""
+
+
+def encoderArgumentList(encoderArguments):
+    """Turn a dictionary of ffmpeg arguments into a list of command line arguments.
+    If the value of a item is None it is skipped. True means the argument has no value (Example: -vn).
+    Lists or tuples repeat the argument for every value (Example: -vpre)."""
+    fargs = []
+    for key in encoderArguments.keys():
+        if encoderArguments[key] is None:
+            continue # No None values
+        if type(encoderArguments[key]) == tuple or type(encoderArguments[key]) == list : #Some ffmpeg argument may apear more than once. (-vpre)
+            for val in encoderArguments[key]:
+                fargs.append("-%s" % key)
+                fargs.append("%s" % val)
+        else:
+            fargs.append("-%s" % key)
+            if encoderArguments[key] is True: #Some ffmpeg arguments are of boolean type. There or not. No value
+                pass
+            else:
+                fargs.append("%s" % encoderArguments[key])
+    return fargs
+
+
+def _number(value, cast=float):
+    """Turn a -progress value into a number. 'N/A' and garbage become None."""
+    try:
+        return cast(value)
+    except ValueError:
+        return None
+
+
+class FFMpegProgress(object):
+    """One block of ffmpeg's -progress output"""
+    __slots__ = ('frame', 'fps', 'bitrate', 'totalSize', 'outTime', 'dupFrames', 'dropFrames', 'speed', 'qualities', 'ended', 'time')
+
+    def __init__(self, values=None):
+        values = values or {}
+        self.frame = _number(values.get('frame', '0'), int)
+        self.fps = _number(values.get('fps', '0'))
+        self.bitrate = _number(values.get('bitrate', 'N/A').replace('kbits/s', ''))
+        """kbit/s"""
+        self.totalSize = _number(values.get('total_size', 'N/A'), int)
+        outTime = _number(values.get('out_time_us', values.get('out_time_ms', 'N/A')), int)
+        # out_time_ms is in microseconds too
+        self.outTime = outTime / 1000000.0 if outTime is not None else None
+        """Seconds of output written"""
+        self.dupFrames = _number(values.get('dup_frames', '0'), int)
+        self.dropFrames = _number(values.get('drop_frames', '0'), int)
+        self.speed = _number(values.get('speed', 'N/A').rstrip('x'))
+        """Encoding speed relative to real time"""
+        self.qualities = {}
+        """Output file index mapped to q of its first stream that has one (-1 means none)"""
+        for key in sorted(values):
+            if key.startswith('stream_') and key.endswith('_q'):
+                output = int(key.split('_')[1])
+                q = _number(values[key])
+                if q is not None and (q >= 0 or output not in self.qualities):
+                    if self.qualities.get(output, -1) < 0:
+                        self.qualities[output] = q
+        self.ended = values.get('progress') == 'end'
+        self.time = time.time()
+
+    def getStats(self, output=0):
+        """Return the values of output as dictionary"""
+        return {
+            'fps': self.fps,
+            'speed': self.speed,
+            'bitrate': self.bitrate,
+            'dupFrames': self.dupFrames,
+            'dropFrames': self.dropFrames,
+            'outTime': self.outTime,
+            'q': self.qualities.get(output),
+        }
+
+
+class FFMpegProgressParser(object):
+    """Incremental parser of ffmpeg's -progress output (key=value lines). Calls progressReceived
+    with a :class:`FFMpegProgress` after every block. Lines may be split across reads."""
+
+    def __init__(self, progressReceived):
+        self.progressReceived = progressReceived
+        self._buffer = ''
+        self._values = {}
+
+    def feed(self, data):
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            key = key.strip()
+            self._values[key] = value.strip()
+            if key == 'progress':
+                values = self._values
+                self._values = {}
+                self.progressReceived(FFMpegProgress(values))
+
+    def reset(self):
+        self._buffer = ''
+        self._values = {}
+
 
 class FFMpeg(KNDistributor):
-    def __init__(self,ffmpegbin='/usr/bin/ffmpeg',encoderArguments=None):
+    def __init__(self,ffmpegbin='/usr/bin/ffmpeg',encoderArguments=None,standby=False):
         """Start a ffmpeg process.
         ffmpegbin:          path to ffmpeg
         encoderArguments:   a dictionary of ffmpeg arguments. 
                             If the value of a item is None it 
-                            is considered to have no value. (Example: -vn)"""
+                            is considered to have no value. (Example: -vn)
+        standby:            keep a second ffmpeg process waiting to take over (see :class:`supervisor.KNProcessSupervisor`)"""
         super(FFMpeg,self).__init__(name='FFMpeg')
-        self.protocol = FFMpegProtocol()
-        self.protocol.factory = self
+        self.supervisor = KNProcessSupervisor(self,FFMpegProtocol,standby=standby)
+        """Restarts ffmpeg when it dies"""
+        self._paused = False
         self.ffmpegbin = ffmpegbin
         self.encoderArguments = encoderArguments
 
@@ -45,29 +154,33 @@ class FFMpeg(KNDistributor):
         except KeyError:
             pass
         
-        self.fargs = ['ffmpeg','-y','-i','-']
-        for key in self.encoderArguments.keys():
-            if self.encoderArguments[key] is None:
-                continue # No None values
-            if type(self.encoderArguments[key]) == tuple or type(self.encoderArguments[key]) == list : #Some ffmpeg argument may apear more than once. (-vpre)
-                for val in self.encoderArguments[key]:
-                    self.fargs.append("-%s" % key)
-                    self.fargs.append("%s" % val)
-            else:
-                self.fargs.append("-%s" % key)
-                if self.encoderArguments[key] is True: #Some ffmpeg arguments are of boolean type. There or not. No value
-                    pass
-                else:
-                    self.fargs.append("%s" % self.encoderArguments[key])
-                
+        self.fargs = ['ffmpeg','-y','-nostats','-progress','pipe:%d' % PROGRESS_FD,'-i','-'] + encoderArgumentList(self.encoderArguments)
         self.fargs.append("-")
         self.log.debug("FFMpegcommand: %s %s" % (self.ffmpegbin," ".join(self.fargs)))
         self.cmdline = "%s %s" % (self.ffmpegbin," ".join(self.fargs))
         
+    @property
+    def protocol(self):
+        """The :class:`FFMpegProtocol` of the running process"""
+        return self.supervisor.active
+
     def _start(self):
         """Stuff to be done after all outlets have started but before the inlet is notified"""
+        self.supervisor.start()
+
+    def _willStop(self):
+        self.supervisor.stop()
+
+    def spawnProcess(self,protocol):
+        """Called by our supervisor"""
         self.log.debug('Spawning new FFMpeg process')
-        reactor.spawnProcess(self.protocol,self.ffmpegbin,self.fargs)
+        reactor.spawnProcess(protocol,self.ffmpegbin,self.fargs,childFDs={0: 'w', 1: 'r', 2: 'r', PROGRESS_FD: 'r'})
+
+    def processRestarted(self):
+        """A new process took over. Its output starts with new timestamps."""
+        if self._paused:
+            self.protocol.transport.pauseProducing()
+        self.streamDiscontinuity()
 
     def dataReceived(self,data):
         """Data received from our inlet. Pipe this data to the ffmpeg process"""
@@ -76,42 +189,196 @@ class FFMpeg(KNDistributor):
         else:
             self.protocol.writeData(data)    
 
+    def progressReceived(self,progress):
+        """The protocol parsed a :class:`FFMpegProgress`"""
+        pass
+
+    def getEncodingStats(self,variant=None):
+        """Return the latest progress values (fps, speed, bitrate, ...)"""
+        return self.protocol.progress.getStats()
+
+    def getStats(self):
+        """Return our counters, the process restarts and the latest progress values"""
+        stats = super(FFMpeg,self).getStats()
+        stats.update(self.protocol.getStats())
+        stats.update(self.getEncodingStats())
+        return stats
+
+    def pauseProducing(self):
+        """Our outlets can not keep up. Stop reading from ffmpeg. ffmpeg will stop reading its STDIN and our inlet edge gets paused."""
+        self._paused = True
+        self.protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        self.protocol.transport.resumeProducing()
+
 
 class FFMpegProtocol(KNProcessProtocol):
-    """Parsing and communication with FFMpeg"""
-    fps = 0
-    # Output matching
-    REversion = re.compile('FFmpeg version')
-    #frame=97 fps= 21 q=30.0 size=     443kB time=2.32 bitrate=1564.3kbits/s dup=12 drop=0 
-    REencodingStats = re.compile('frame=\s*(\d+)\s*fps')
-    REencodingStatsFPS = re.compile('fps=\s*(\d+)\s*q')
-    #size=     560kB time=64.91 bitrate=  70.7kbits/s
-    REencodingStatsAudio = re.compile('size= *(\d+)kB *time=\d+')
-    
-    
+    """Parsing and communication with FFMpeg
+
+    Progress is read from the -progress pipe (see :class:`FFMpegProgressParser`). STDERR only
+    carries messages. At most logLines lines are logged per logInterval seconds.
+    """
+    logLines = 20
+    logInterval = 10.0
+    warnInterval = 30.0
+    """Seconds between warnings about encoding too slow"""
+
+    def __init__(self, name='FFMpeg'):
+        KNProcessProtocol.__init__(self, name)
+        self.progress = FFMpegProgress()
+        """The latest :class:`FFMpegProgress`"""
+        self.parser = FFMpegProgressParser(self.progressReceived)
+        self.suppressedLines = 0
+        self._errBuffer = ''
+        self._logWindow = 0
+        self._logged = 0
+        self._suppressed = 0
+        self._lastWarning = 0
+
+    @property
+    def currentFPS(self):
+        return self.progress.fps or 0
+
+    def connectionMade(self):
+        KNProcessProtocol.connectionMade(self)
+        self.parser.reset()
+        self._errBuffer = ''
+
+    def childDataReceived(self, childFD, data):
+        if childFD == PROGRESS_FD:
+            self.parser.feed(data)
+        else:
+            KNProcessProtocol.childDataReceived(self, childFD, data)
+
     def errReceived(self, data):
-        lines = str(data).splitlines()
-        log.msg(data)
+        if self._errBuffer:
+            data = self._errBuffer + data
+        lines = data.split('\n')
+        self._errBuffer = lines.pop()
         for line in lines:
-            self._lastlogline = line
-            if(self.__class__.REversion.match(line)):
-                log.msg(line)
-            elif(self.__class__.REencodingStats.match(line)):
-                self.stats = line
-                self.updateStats(line)
-            elif(self.__class__.REencodingStatsAudio.match(line)):
-                self.stats = line
-            else:
-                self._lastlogline = line
-                log.msg("%s" % (line))
-
-    def updateStats(self,line):
-        match = self.__class__.REencodingStatsFPS.search(line)
-        self.currentFPS = int(match.group(1))
-        #log.msg("Current FPS: %s Target FPS: %s " % (self.currentFPS,self.factory.targetFPS))
-        if self.currentFPS < self.factory._targetFPS:
-            log.msg("WARNING! Current encoding FPS (%s) below target FPS (%s) Not encoding fast enough! Reduce encoding quality!" % (self.currentFPS,self.factory._targetFPS))
-    
+            line = line.rstrip('\r')
+            if line:
+                self._lastLogLine = line
+                self._logLine(line)
+
+    def _logLine(self, line):
+        now = time.time()
+        if now - self._logWindow >= self.logInterval:
+            if self._suppressed:
+                log.msg("%d lines of ffmpeg output suppressed" % self._suppressed)
+            self._logWindow = now
+            self._logged = 0
+            self._suppressed = 0
+        if self._logged < self.logLines:
+            self._logged += 1
+            log.msg(line)
+        else:
+            self._suppressed += 1
+            self.suppressedLines += 1
+
+    def progressReceived(self, progress):
+        self.progress = progress
+        if not progress.ended and progress.fps is not None and progress.fps < self.factory._targetFPS:
+            if progress.time - self._lastWarning >= self.warnInterval:
+                self._lastWarning = progress.time
+                log.msg("WARNING! Current encoding FPS (%s, speed %sx) below target FPS (%s) Not encoding fast enough! Reduce encoding quality!" % (progress.fps,progress.speed,self.factory._targetFPS))
+        self.factory.progressReceived(progress)
+
+    def getStats(self):
+        stats = KNProcessProtocol.getStats(self)
+        stats['suppressedLogLines'] = self.suppressedLines
+        return stats
+
     def outReceived(self, data):
         """Received data from ffmpegs STDOUT"""
         self.factory.sendDataToAllOutlets(data)
+
+
+class FFMpegMultiOutput(FFMpeg):
+    """A single ffmpeg process encoding every quality of a :class:`httplive.HTTPLiveStream`.
+
+    The input is decoded once. Every variant gets its own set of output options and its
+    own pipe (file descriptor 3, 4, ...). Data read from a pipe is only sent to the
+    variant it belongs to.
+    """
+
+    def __init__(self,ffmpegbin='/usr/bin/ffmpeg',name='FFMpeg',standby=False):
+        super(FFMpeg,self).__init__(name=name)
+        self.supervisor = KNProcessSupervisor(self,FFMpegMultiOutputProtocol,standby=standby)
+        self._paused = False
+        self.ffmpegbin = ffmpegbin
+        self.encoderArguments = {}
+        """Variants mapped to their encoder arguments"""
+        self.stats = {}
+        """Variants mapped to their encoding stats (see :meth:`FFMpegProgress.getStats`)"""
+
+        self._variants = []
+        self._variantsByFD = {}
+        self._targetFPS = 25
+        self.fargs = []
+        self.cmdline = None
+
+    def addVariant(self,variant,encoderArguments):
+        """Encode to variant with encoderArguments. The variant becomes an outlet of this encoder."""
+        childFD = PROGRESS_FD + 1 + len(self._variants)
+        self._variants.append(variant)
+        self._variantsByFD[childFD] = variant
+        self.encoderArguments[variant] = encoderArguments
+        self.stats[variant] = FFMpegProgress().getStats()
+        try:
+            self._targetFPS = max(self._targetFPS, int(encoderArguments['r']))
+        except KeyError:
+            pass
+        self.addOutlet(variant)
+
+    def _buildCommandLine(self):
+        self.fargs = ['ffmpeg','-y','-nostats','-progress','pipe:%d' % PROGRESS_FD,'-i','-']
+        for childFD, variant in sorted(self._variantsByFD.items()):
+            self.fargs.extend(encoderArgumentList(self.encoderArguments[variant]))
+            self.fargs.append('pipe:%d' % childFD)
+        self.cmdline = "%s %s" % (self.ffmpegbin," ".join(self.fargs))
+        self.log.debug("FFMpegcommand: %s" % self.cmdline)
+
+    def _start(self):
+        self._buildCommandLine()
+        self.supervisor.start()
+
+    def spawnProcess(self,protocol):
+        childFDs = {0: 'w', 1: 'r', 2: 'r', PROGRESS_FD: 'r'}
+        for childFD in self._variantsByFD:
+            childFDs[childFD] = 'r'
+        self.log.debug('Spawning new FFMpeg process for %d variants' % len(self._variants))
+        reactor.spawnProcess(protocol,self.ffmpegbin,self.fargs,childFDs=childFDs)
+
+    def variantDataReceived(self,childFD,data):
+        """Data read from the pipe of a variant"""
+        self.bytesOut += len(data)
+        self.chunksOut += 1
+        self.edges[self._variantsByFD[childFD]].write(data)
+
+    def progressReceived(self,progress):
+        """Every variant is an output of the process. Output index = variant index."""
+        for index, variant in enumerate(self._variants):
+            self.stats[variant] = progress.getStats(index)
+
+    def getEncodingStats(self,variant=None):
+        """Return the latest progress values of variant or of the first output"""
+        if variant is None:
+            return self.protocol.progress.getStats()
+        return dict(self.stats[variant])
+
+    def processCrashed(self):
+        """All variants are affected when the shared process dies"""
+        self.log.error('Encoder for %s died' % ', '.join(str(variant) for variant in self._variants))
+
+
+class FFMpegMultiOutputProtocol(FFMpegProtocol):
+    """Protocol for :class:`FFMpegMultiOutput`. Routes the output pipes to the variants."""
+
+    def childDataReceived(self, childFD, data):
+        if childFD > PROGRESS_FD:
+            self.factory.variantDataReceived(childFD,data)
+        else:
+            FFMpegProtocol.childDataReceived(self,childFD,data)
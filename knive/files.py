@@ -20,29 +20,93 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
-from twisted.internet       import fdesc, reactor
+from twisted.internet       import reactor
 from zope.interface import implements
 from twisted.application    import service
 from twisted.python         import log
 from foundation             import KNOutlet
+from diskio                 import getPool, deferToDiskIO
+import errno
 import os
 import shutil
+import time
 
 import  foundation
 
 
 class FileWriter(KNOutlet):
-    """Write data received from self.inlet to file specified during init"""
-    def __init__(self, outdir, filename = 'Unknown-knive-file',keepFiles=5, suffix=None):
+    """Write data received from self.inlet to file specified during init
+
+    Received data is collected in memory and written by the disk I/O pool in blocks of
+    flushSize bytes (a multiple of blockSize). Every flushInterval seconds the whole blocks
+    buffered so far are written, or the rest if there is less than a block, and the rest is
+    written when the writer stops. A slow stream therefore also writes partial blocks and
+    writes after that no longer start at block aligned offsets.
+
+    Nothing is dropped. While more than maxBufferedBytes are buffered or being written the
+    edge from our inlet is paused and queues for us (which in turn pauses the inlet).
+
+    A write that fails keeps what it could not write. Every later write starts with it, so the
+    file never has a gap. Until a write succeeds again the edge stays paused and the write is
+    retried every retryInterval seconds. What can't be written when the file is closed is lost
+    (and logged).
+
+    fsyncPolicy is 'none', 'interval' (every fsyncInterval seconds) or 'flush' (after every write).
+    """
+
+    blockSize = 4096
+    retryInterval = 1.0
+    """Seconds between attempts to write after a failed write"""
+
+    def __init__(self, outdir, filename = 'Unknown-knive-file',keepFiles=5, suffix=None,
+                 flushSize=1048576, maxBufferedBytes=16777216, flushInterval=1, fsyncPolicy='interval', fsyncInterval=5):
+        super(FileWriter, self).__init__(name=filename)
         self.outfile = None
+        self.parent = None
         if os.path.exists(outdir):
             self.outdir = outdir
         else:
             raise(Exception("Directory doesn't exist %s" % outdir))
+        if fsyncPolicy not in ('none','interval','flush'):
+            raise(Exception("Unknown fsync policy %s" % fsyncPolicy))
         self.running = 0
         self.filename = filename
         self.keepFiles = keepFiles
         self.suffix = suffix
+        self.flushSize = max(self.blockSize, flushSize - flushSize % self.blockSize)
+        self.maxBufferedBytes = max(maxBufferedBytes, 2 * self.flushSize)
+        self.flushInterval = flushInterval
+        self.fsyncPolicy = fsyncPolicy
+        self.fsyncInterval = fsyncInterval
+        self.diskIO = getPool()
+        """The :class:`knive.diskio.KNDiskIOPool` writes and fsyncs run in"""
+
+        self._buffer = bytearray()
+        self._flushTimer = None
+        self._retryTimer = None
+        self._writeFailing = False
+        """The last write failed"""
+        self._unwritten = bytearray()
+        """What failed writes left behind. Only touched by the disk I/O pool."""
+        self._partiallyWritten = 0
+        """Bytes failed writes did write. Only touched by the disk I/O pool."""
+        self.paused = False
+        """True while the edge from our inlet is paused"""
+
+        self.bytesReceived = 0
+        self.bytesWritten = 0
+        self.inFlightBytes = 0
+        """Bytes handed to the disk I/O pool and not yet written"""
+        self.maxBufferedBytesSeen = 0
+        self.flushes = 0
+        self.flushLatencyTotal = 0.0
+        self.flushLatencyMax = 0.0
+        self.fsyncs = 0
+        self.writeErrors = 0
+        self.bytesLost = 0
+        """Bytes that could not be written when the file was closed"""
+        self.pauseCount = 0
+
         self._outfileName = self.getFileName()
         
     def getFileName(self):
@@ -54,6 +118,17 @@ class FileWriter(KNOutlet):
         self._outfileName = self.outdir + os.path.sep + self.filename
         return self._outfileName
         
+    def _start(self):
+        edge = self.getInletEdge()
+        if edge is not None:
+            # An archive must not lose data. Queue instead of dropping.
+            edge.overflowPolicy = 'pause'
+        self.startService()
+
+    def stop(self):
+        self.stopService()
+        super(FileWriter, self).stop()
+
     def startService(self):
         """docstring for startService"""
         log.msg("Starting %s" % self)
@@ -67,34 +142,202 @@ class FileWriter(KNOutlet):
                     shutil.move(filename,newFileName)
                 
         checkAndMove(self._outfileName)
-        self.outfile = os.open(self._outfileName,os.O_WRONLY | os.O_NONBLOCK | os.O_CREAT)
+        # Writes run in the disk I/O pool. The file is opened blocking, short writes are retried.
+        self.outfile = os.open(self._outfileName,os.O_WRONLY | os.O_CREAT)
         if not self.outfile:
             raise("Could not open %s" % self._outfileName)
         else:
             log.msg("Opened %s" % self._outfileName)
-        fdesc.setNonBlocking(self.outfile)
         
         self.running = 1
+        self._flushTimer = reactor.callLater(self.flushInterval,self._flushTimeout)
         def syncToDisc():
-            """docstring for flushToDisk"""
-            
-            os.fsync(self.outfile)
-            if self.running:
-                reactor.callLater(5,syncToDisc)
-        syncToDisc()
+            """fsync in the disk I/O pool. The next sync is scheduled when this one is done."""
+            if not self.running:
+                return
+            def synced(ignored):
+                self.fsyncs += 1
+            def failed(failure):
+                self.log.error('fsync of %s failed: %s' % (self._outfileName,failure.getErrorMessage()))
+            def scheduleNext(ignored):
+                if self.running:
+                    reactor.callLater(self.fsyncInterval,syncToDisc)
+            d = deferToDiskIO(self.diskIO,self._outfileName,'fsync',os.fsync,self.outfile)
+            d.addCallbacks(synced,failed)
+            d.addCallback(scheduleNext)
+        if self.fsyncPolicy == 'interval':
+            syncToDisc()
         
     def stopService(self):
-        """docstring for stopService"""
+        """Write everything that is buffered and close the file"""
+        if not self.running:
+            return
         self.running = 0
-        os.close(self.outfile)
+        if self._flushTimer is not None and self._flushTimer.active():
+            self._flushTimer.cancel()
+        self._flushTimer = None
+        if self._retryTimer is not None and self._retryTimer.active():
+            self._retryTimer.cancel()
+        self._retryTimer = None
+        edge = self.getInletEdge()
+        if self.paused and edge is not None:
+            # Take everything the edge queued for us
+            self.paused = False
+            edge.resumeProducing()
+        self.flush(aligned=False)
+        # Queued behind the last write and a running fsync of the same file
+        d = deferToDiskIO(self.diskIO,self._outfileName,'close',self._closeFile,self.outfile)
+        def _closed(lost):
+            if lost:
+                self.bytesLost += lost
+                self.log.error('Closed %s. Could not write the last %d bytes.' % (self._outfileName,lost))
+        d.addCallbacks(_closed,lambda failure: self.log.error('Closing %s failed: %s' % (self._outfileName,failure.getErrorMessage())))
+        self.outfile = None
         
     def dataReceived(self,data):
-        """docstring for writeData"""
-        fdesc.writeToFD(self.outfile,data)
+        """Buffer data. Hand a block to the disk I/O pool once flushSize bytes are buffered."""
+        self._buffer.extend(data)
+        self.bytesReceived += len(data)
+        buffered = len(self._buffer) + self.inFlightBytes
+        if buffered > self.maxBufferedBytesSeen:
+            self.maxBufferedBytesSeen = buffered
+        if len(self._buffer) >= self.flushSize:
+            self.flush()
+        if self.running and not self.paused and len(self._buffer) + self.inFlightBytes > self.maxBufferedBytes:
+            self.log.warn('Disk is too slow. %d bytes buffered. Pausing.' % (len(self._buffer) + self.inFlightBytes))
+            self._pause()
     
     def writeData(self,data):
         """docstring for writeData"""
-        fdesc.writeToFD(self.outfile,data)
+        self.dataReceived(data)
+
+    def flush(self,aligned=True):
+        """Hand the buffer to the disk I/O pool. If aligned, only whole blocks are written and the rest stays buffered."""
+        length = len(self._buffer)
+        if aligned:
+            length -= length % self.blockSize
+        if length <= 0 or self.outfile is None:
+            return
+        block = self._buffer
+        self._buffer = bytearray(block[length:])
+        del block[length:]
+        self.inFlightBytes += length
+        self._submit(block)
+
+    def _submit(self,block):
+        """Hand block to the disk I/O pool. Bytes stay in flight until a write reports them written."""
+        submitted = time.time()
+
+        def _written(result):
+            # result includes what failed writes left behind
+            self.inFlightBytes -= result
+            self.bytesWritten += result
+            if self.fsyncPolicy == 'flush':
+                self.fsyncs += 1
+            if self._writeFailing:
+                self._writeFailing = False
+                self.log.info('Writing to %s again' % self._outfileName)
+            _done()
+        def _failed(failure):
+            self.writeErrors += 1
+            if not self._writeFailing:
+                self._writeFailing = True
+                self.log.error('Writing to %s failed: %s. Pausing and retrying every %.1f s.' % (self._outfileName,failure.getErrorMessage(),self.retryInterval))
+            self._pause()
+            if self.running and self._retryTimer is None:
+                self._retryTimer = reactor.callLater(self.retryInterval,self._retry)
+            _done()
+        def _done():
+            latency = time.time() - submitted
+            self.flushes += 1
+            self.flushLatencyTotal += latency
+            if latency > self.flushLatencyMax:
+                self.flushLatencyMax = latency
+            if self.paused and not self._writeFailing and len(self._buffer) + self.inFlightBytes <= self.maxBufferedBytes / 2:
+                self.paused = False
+                self.getInletEdge().resumeProducing()
+        d = deferToDiskIO(self.diskIO,self._outfileName,'write',self._writeBlock,self.outfile,block)
+        d.addCallbacks(_written,_failed)
+
+    def _retry(self):
+        self._retryTimer = None
+        if self._writeFailing and self.outfile is not None:
+            # Nothing new, just what failed
+            self._submit(bytearray())
+
+    def _pause(self):
+        if self.running and not self.paused:
+            edge = self.getInletEdge()
+            if edge is not None:
+                self.paused = True
+                self.pauseCount += 1
+                edge.pauseProducing()
+
+    def _flushTimeout(self):
+        self._flushTimer = reactor.callLater(self.flushInterval,self._flushTimeout)
+        # Don't leave data in memory just because the stream is slow
+        self.flush(aligned=len(self._buffer) >= self.blockSize)
+
+    def _writeBlock(self,fd,block):
+        """Blocking. Write what earlier writes left behind and all of block to fd. Return the number of bytes
+        written since the last successful call. If it fails, the rest is kept for the next call."""
+        if self._unwritten:
+            self._unwritten.extend(block)
+            block = self._unwritten
+            self._unwritten = bytearray()
+        view = memoryview(block)
+        written = 0
+        try:
+            while written < len(block):
+                try:
+                    written += os.write(fd,view[written:])
+                except OSError, e:
+                    if e.errno not in (errno.EINTR, errno.EAGAIN):
+                        raise
+            if self.fsyncPolicy == 'flush':
+                os.fsync(fd)
+        except EnvironmentError:
+            self._unwritten = bytearray(block[written:])
+            self._partiallyWritten += written
+            raise
+        written += self._partiallyWritten
+        self._partiallyWritten = 0
+        return written
+
+    def _closeFile(self,fd):
+        """Blocking. Try to write what failed writes left behind one last time and close fd.
+        Return the number of bytes that could not be written."""
+        lost = 0
+        if self._unwritten:
+            try:
+                self._writeBlock(fd,bytearray())
+            except EnvironmentError:
+                lost = len(self._unwritten)
+                self._unwritten = bytearray()
+        os.close(fd)
+        return lost
+
+    def getStats(self):
+        """Return a dictionary with bytes received and written, buffer occupancy and flush latency (seconds)"""
+        flushes = self.flushes or 1
+        stats = super(FileWriter, self).getStats()
+        stats.update({
+            'file': self._outfileName,
+            'bytesReceived': self.bytesReceived,
+            'bytesWritten': self.bytesWritten,
+            'bufferedBytes': len(self._buffer),
+            'inFlightBytes': self.inFlightBytes,
+            'bufferOccupancy': float(len(self._buffer) + self.inFlightBytes) / self.maxBufferedBytes,
+            'maxBufferedBytes': self.maxBufferedBytesSeen,
+            'flushes': self.flushes,
+            'flushLatencyAvg': self.flushLatencyTotal / flushes,
+            'flushLatencyMax': self.flushLatencyMax,
+            'fsyncs': self.fsyncs,
+            'writeErrors': self.writeErrors,
+            'bytesLost': self.bytesLost,
+            'pauseCount': self.pauseCount,
+        })
+        return stats
         
     def setParent(self,parent):
         """docstring for setParent"""
@@ -106,4 +349,4 @@ class FileWriter(KNOutlet):
         try:
             return "%s (%s)" % (self.__class__.__name__,self._outfileName)
         except:
-            return "%s" % (self.__class__.__name__) 
\ No newline at end of file
+            return "%s" % (self.__class__.__name__)
@@ -29,10 +29,18 @@ from kninterfaces           import IKNStreamObject, IKNOutlet, IKNInlet
 from zope.interface         import implements
 from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet       import protocol, reactor
+from twisted.internet.interfaces import IPushProducer
 from exceptions             import ServiceRunningWithouInlet, ServiceRunningWithoutOutlets
 
+from collections import deque
 import logging
 
+TS_PACKET_SIZE = 188
+"""Size of a single MPEG-TS packet in bytes"""
+
+_DISCONTINUITY = object()
+"""Queued in a :class:`KNEdge` where the stream restarts"""
+
 
 class KNStreamObject(object):
     """KNStreamObject is a superclass for all classes that produce or consume data.
@@ -54,6 +62,15 @@ class KNStreamObject(object):
     def stop(self):
         self.running = False
 
+    def getStats(self):
+        """Return a dictionary with counters of this object. Subclasses add their own.
+        Only cheap reads of existing counters. This is called periodically by :class:`stats.KNStatsCollector`."""
+        return {
+            'name': self.name,
+            'class': self.__class__.__name__,
+            'running': bool(self.running),
+        }
+
     def __str__(self):
         if self.name:
             return "<%s | %s>" % (self.name,self.__class__.__name__)
@@ -61,6 +78,185 @@ class KNStreamObject(object):
             return self.__instance__
 
 
+class KNEdge(object):
+    """A bounded queue between an IKNInlet and one of its IKNOutlets.
+
+    As long as the outlet keeps up, data is handed through to outlet.dataReceived
+    without being queued. An edge is also an IPushProducer: outlets writing to a
+    consumer (e.g. the STDIN of a process) register the edge as producer. When the
+    consumer is saturated the edge is paused and starts queueing. Once the queue
+    grows beyond highWatermark the overflowPolicy decides what happens:
+
+    - 'pause': The inlet is asked to pause. The pause travels upstream until it
+      reaches the source of the stream (e.g. the TCPTS ingest transport). The inlet
+      is resumed when the queue drained below lowWatermark.
+    - 'drop': Whole TS packets are dropped until the queue drained.
+
+    A discontinuity (:meth:`streamDiscontinuity`) reaches the outlet after the data queued in front of it.
+    """
+    implements(IPushProducer)
+
+    highWatermark = 4*1024*1024
+    """Queue size (bytes) at which the overflowPolicy kicks in"""
+    lowWatermark = 1024*1024
+    """Queue size (bytes) at which a paused inlet is resumed"""
+    overflowPolicy = 'pause'
+    """'pause' or 'drop'"""
+
+    def __init__(self, inlet, outlet):
+        super(KNEdge, self).__init__()
+        self.inlet = inlet
+        self.outlet = outlet
+        self.paused = False
+        """The consumer of our outlet asked us to stop delivering data"""
+        self.inletPaused = False
+        """We asked our inlet to stop sending data"""
+
+        self.queue = deque()
+        self.queuedBytes = 0
+        self.maxQueuedBytes = 0
+        self.bytesDelivered = 0
+        self.chunksDelivered = 0
+        self.droppedBytes = 0
+        self.droppedPackets = 0
+        self.pauseCount = 0
+
+        self._alignment = 0
+        """Bytes accepted (delivered, queued) modulo TS_PACKET_SIZE. Needed to drop whole packets."""
+        self._dropRemaining = 0
+        """Bytes of a partially dropped packet that still have to be dropped"""
+
+    def setFlowControl(self, highWatermark=None, lowWatermark=None, overflowPolicy=None):
+        """Change the limits of this edge. None leaves a value untouched."""
+        if highWatermark is not None:
+            self.highWatermark = highWatermark
+        if lowWatermark is not None:
+            self.lowWatermark = lowWatermark
+        if overflowPolicy is not None:
+            if overflowPolicy not in ('pause', 'drop'):
+                raise(ValueError('Unknown overflowPolicy %s' % overflowPolicy))
+            self.overflowPolicy = overflowPolicy
+
+    def write(self, data):
+        """Deliver data to the outlet or queue it if the outlet is paused."""
+        if not self.paused and not self.queue and not self._dropRemaining:
+            self._alignment = (self._alignment + len(data)) % TS_PACKET_SIZE
+            self.bytesDelivered += len(data)
+            self.chunksDelivered += 1
+            self.outlet.dataReceived(data)
+            return
+
+        overflow = self.queuedBytes + len(data) > self.highWatermark
+        if self.overflowPolicy == 'drop':
+            if overflow or self._dropRemaining:
+                data = self._dropPackets(data,overflow)
+                if not data:
+                    return
+        elif overflow and not self.inletPaused:
+            self.inletPaused = True
+            self.pauseCount += 1
+            self.inlet.edgeFull(self)
+
+        self._alignment = (self._alignment + len(data)) % TS_PACKET_SIZE
+        self.queue.append(data)
+        self.queuedBytes += len(data)
+        if self.queuedBytes > self.maxQueuedBytes:
+            self.maxQueuedBytes = self.queuedBytes
+        if not self.paused:
+            self._flush()
+
+    def streamDiscontinuity(self):
+        """The stream restarts after the data written so far. Tell the outlet when it got that data."""
+        # The new stream starts with a whole packet
+        self._alignment = 0
+        self._dropRemaining = 0
+        if not self.paused and not self.queue:
+            self.outlet.streamDiscontinuity()
+        else:
+            self.queue.append(_DISCONTINUITY)
+
+    def _dropPackets(self, data, overflow):
+        """Drop whole TS packets from data. Returns the bytes that still have to be queued.
+
+        A packet which was started to be dropped in a previous chunk is dropped completely. While
+        the queue overflows the end of a packet that was already accepted is kept and every
+        following packet is dropped."""
+        length = len(data)
+        pos = 0
+        if self._dropRemaining:
+            pos = min(self._dropRemaining, length)
+            self._dropRemaining -= pos
+            self.droppedBytes += pos
+        if pos >= length or not overflow:
+            return data[pos:]
+
+        head = (TS_PACKET_SIZE - self._alignment) % TS_PACKET_SIZE
+        kept = data[pos:pos + head]
+        pos += head
+        rest = length - pos
+        if rest > 0:
+            partial = rest % TS_PACKET_SIZE
+            self.droppedPackets += rest // TS_PACKET_SIZE
+            if partial:
+                self.droppedPackets += 1
+                self._dropRemaining = TS_PACKET_SIZE - partial
+            self.droppedBytes += rest
+        return kept
+
+    def _flush(self):
+        while self.queue and not self.paused:
+            data = self.queue.popleft()
+            if data is _DISCONTINUITY:
+                self.outlet.streamDiscontinuity()
+                continue
+            self.queuedBytes -= len(data)
+            self.bytesDelivered += len(data)
+            self.chunksDelivered += 1
+            self.outlet.dataReceived(data)
+        if self.inletPaused and self.queuedBytes <= self.lowWatermark:
+            self.inletPaused = False
+            self.inlet.edgeDrained(self)
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        """The consumer of our outlet is saturated. Queue everything from now on."""
+        self.paused = True
+
+    def resumeProducing(self):
+        """The consumer of our outlet accepts data again. Drain the queue."""
+        self.paused = False
+        self._flush()
+
+    def stopProducing(self):
+        """The consumer of our outlet went away. Throw away what is queued."""
+        self.queue.clear()
+        self.queuedBytes = 0
+        self.paused = False
+        if self.inletPaused:
+            self.inletPaused = False
+            self.inlet.edgeDrained(self)
+
+    def getStats(self):
+        """Return a dictionary describing the state of this edge"""
+        return {
+            'inlet': str(self.inlet),
+            'outlet': str(self.outlet),
+            'paused': self.paused,
+            'inletPaused': self.inletPaused,
+            'queuedBytes': self.queuedBytes,
+            'maxQueuedBytes': self.maxQueuedBytes,
+            'bytesDelivered': self.bytesDelivered,
+            'chunksDelivered': self.chunksDelivered,
+            'droppedBytes': self.droppedBytes,
+            'droppedPackets': self.droppedPackets,
+            'pauseCount': self.pauseCount,
+        }
+
+    def __str__(self):
+        return "<%s -> %s>" % (self.inlet, self.outlet)
+
+
 class KNInlet(KNStreamObject):
     """Implementation of :class:`IKNInlet`"""
     implements(IKNInlet)
@@ -68,7 +264,12 @@ class KNInlet(KNStreamObject):
         super(KNInlet, self).__init__(name=name)
         self.name = name
         self.outlets = []
+        self.edges = {}
+        """Dictionary of :class:`KNEdge` objects. One for every outlet"""
         self.starting = False
+        self._fullEdges = set()
+        self.bytesOut = 0
+        self.chunksOut = 0
 
 
     def start(self):
@@ -153,6 +354,7 @@ class KNInlet(KNStreamObject):
             if outlet not in self.outlets:
                 if outlet is not self:
                     self.outlets.append(outlet)
+                    self.edges[outlet] = KNEdge(self,outlet)
                     # print "Self.outlets:%s" % self.outlets
                     # print "Outlet.outlets: %s" % outlet.outlets
                 else:
@@ -165,19 +367,75 @@ class KNInlet(KNStreamObject):
         """Remove the outlet from the list of outlets. The outlet will no longer receive any data."""
         if outlet in self.outlets:
             self.outlets.remove(outlet)
+            edge = self.edges.pop(outlet)
+            edge.stopProducing()
             outlet.inlet = None
             if outlet.running:
                 raise(ServiceRunningWithouInlet)
         
-    def getStats():
-        """Return a string with statistics about data flow (bits p second?)"""
-        pass
+    def getStats(self):
+        """Return a dictionary with the data we sent and what is queued for our outlets"""
+        stats = super(KNInlet, self).getStats()
+        stats['bytesOut'] = self.bytesOut
+        stats['chunksOut'] = self.chunksOut
+        stats['outletQueuedBytes'] = sum([edge.queuedBytes for edge in self.edges.values()])
+        stats['outletDroppedBytes'] = sum([edge.droppedBytes for edge in self.edges.values()])
+        return stats
 
     def sendDataToAllOutlets(self,data):
         """Send data to our outlets"""
+        self.bytesOut += len(data)
+        self.chunksOut += 1
         for outlet in self.outlets:
-            outlet.dataReceived(data)
-        
+            self.edges[outlet].write(data)
+
+    def streamDiscontinuity(self):
+        """The stream we send restarts (new timestamps and continuity counters). Tell our outlets."""
+        for outlet in self.outlets:
+            self.edges[outlet].streamDiscontinuity()
+
+    # Flow control
+
+    def edgeFull(self,edge):
+        """The queue of edge exceeded its highWatermark. Pause if this is the first full edge."""
+        if not self._fullEdges:
+            self.log.info('Outlet %s can not keep up. Pausing.' % edge.outlet)
+            self._fullEdges.add(edge)
+            self.pauseProducing()
+        else:
+            self._fullEdges.add(edge)
+
+    def edgeDrained(self,edge):
+        """The queue of edge drained below its lowWatermark. Resume if no other edge is full."""
+        self._fullEdges.discard(edge)
+        if not self._fullEdges:
+            self.log.info('Outlet %s drained. Resuming.' % edge.outlet)
+            self.resumeProducing()
+
+    def pauseProducing(self):
+        """Stop producing data until resumeProducing is called. Override this in sources of data."""
+        self.log.warning('Asked to pause but can not pause. Outlets will buffer or drop data.')
+
+    def resumeProducing(self):
+        """Continue to produce data after pauseProducing."""
+        pass
+
+    def setFlowControl(self,highWatermark=None,lowWatermark=None,overflowPolicy=None):
+        """Set the limits of all edges in the graph below this object. See :class:`KNEdge`"""
+        for outlet in self.outlets:
+            self.edges[outlet].setFlowControl(highWatermark,lowWatermark,overflowPolicy)
+            if IKNInlet.providedBy(outlet):
+                outlet.setFlowControl(highWatermark,lowWatermark,overflowPolicy)
+
+    def getEdgeStats(self):
+        """Return a list with the stats of every edge in the graph below this object"""
+        stats = []
+        for outlet in self.outlets:
+            stats.append(self.edges[outlet].getStats())
+            if IKNInlet.providedBy(outlet):
+                stats.extend(outlet.getEdgeStats())
+        return stats
+
 
 class KNOutlet(KNStreamObject):
     """Implementation of :class:`IKNOutlet`"""
@@ -195,6 +453,28 @@ class KNOutlet(KNStreamObject):
         if recursiveCall:
             self.inlet.addOutlet(self)
 
+    def getInletEdge(self):
+        """Return the :class:`KNEdge` our inlet uses to send us data or None"""
+        try:
+            return self.inlet.edges.get(self)
+        except AttributeError:
+            return None
+
+    def streamDiscontinuity(self):
+        """The stream we receive restarted (new timestamps and continuity counters). Override this if it matters."""
+        pass
+
+    def getStats(self):
+        """Return a dictionary with the data delivered to us by our inlet"""
+        stats = super(KNOutlet, self).getStats()
+        edge = self.getInletEdge()
+        if edge is not None:
+            stats['bytesIn'] = edge.bytesDelivered
+            stats['chunksIn'] = edge.chunksDelivered
+            stats['queuedBytes'] = edge.queuedBytes
+            stats['droppedBytes'] = edge.droppedBytes
+        return stats
+
     def start(self):
         startDefer = Deferred()
         def _started(target):
@@ -256,7 +536,13 @@ class KNDistributor(KNOutlet):
         super(KNDistributor, self).__init__(name=name)
 
         self.inlet = None
-        self.outlets = []        
+        self.outlets = []
+        self.edges = {}
+        """Dictionary of :class:`KNEdge` objects. One for every outlet"""
+        self.starting = False
+        self._fullEdges = set()
+        self.bytesOut = 0
+        self.chunksOut = 0
 
 
     # Dataflow .. Inlet and outlets
@@ -298,6 +584,7 @@ class KNDistributor(KNOutlet):
             if outlet not in self.outlets:
                 if outlet is not self:
                     self.outlets.append(outlet)
+                    self.edges[outlet] = KNEdge(self,outlet)
                     # print "Self.outlets:%s" % self.outlets
                     # print "Outlet.outlets: %s" % outlet.outlets
                 else:
@@ -310,6 +597,8 @@ class KNDistributor(KNOutlet):
         """Remove the outlet from the list of outlets. The outlet will no longer receive any data."""
         if outlet in self.outlets:
             self.outlets.remove(outlet)
+            edge = self.edges.pop(outlet)
+            edge.stopProducing()
             outlet.inlet = None
             if outlet.running:
                 raise(ServiceRunningWithouInlet)
@@ -329,7 +618,12 @@ class KNDistributor(KNOutlet):
         if not len(self.outlets):
             raise(ServiceRunningWithoutOutlets)
 
+        if self.starting:
+            self.log.debug('Already starting.')
+            return
+
         if not self.running:
+            self.starting = True
 
             self._willStart()
 
@@ -342,22 +636,29 @@ class KNDistributor(KNOutlet):
 
             def _allOutletsStarted():
                 self.running = True
+                self.starting = False
                 self._start()
                 self.log.debug("Did start")
-                self.log.debug("Will notify %s that I started" % self.inlet)
-                self.inlet.start()
+                # The inlet may be the one starting us. Don't start it twice.
+                if not self.inlet.running and not getattr(self.inlet,'starting',False):
+                    self.log.debug("Will notify %s that I started" % self.inlet)
+                    self.inlet.start()
                 defStarted.callback(self)
                 self.log.debug("Started and notified %s" % self.inlet)
                 self._didStartAndNotifiedInlet()
 
             for outlet in self.outlets:
-                self.log.debug('Starting outlet %s' % outlet)
-                d = maybeDeferred(outlet.start)
-                d.addCallback(_outletStarted)
+                if not outlet.running:
+                    self.log.debug('Starting outlet %s' % outlet)
+                    d = maybeDeferred(outlet.start)
+                    d.addCallback(_outletStarted)
+                else:
+                    _outletStarted(outlet)
             if not len(self.outlets):
                 _allOutletsStarted()
         else:
             self.log.warning("%s is already running. Can not start" % self)
+            defStarted.callback(self)
 
         return defStarted
 
@@ -426,6 +727,11 @@ class KNDistributor(KNOutlet):
         """Stuff to be done before outlets get the stop command"""
         pass
 
+    def streamDiscontinuity(self):
+        """The stream we receive restarted (e.g. the encoder feeding us). Tell our outlets."""
+        for outlet in self.outlets:
+            self.edges[outlet].streamDiscontinuity()
+
     def _didStop(self):
         """Stuff to be done after outlets stopped but before the inlet is notified."""
         pass
@@ -442,8 +748,66 @@ class KNDistributor(KNOutlet):
     # IKNInlet - Produce data
     def sendDataToAllOutlets(self,data):
         """Send data to our outlets"""
+        self.bytesOut += len(data)
+        self.chunksOut += 1
+        for outlet in self.outlets:
+            self.edges[outlet].write(data)
+
+    # Flow control
+
+    def edgeFull(self,edge):
+        """The queue of edge exceeded its highWatermark. Pause if this is the first full edge."""
+        if not self._fullEdges:
+            self.log.info('Outlet %s can not keep up. Pausing.' % edge.outlet)
+            self._fullEdges.add(edge)
+            self.pauseProducing()
+        else:
+            self._fullEdges.add(edge)
+
+    def edgeDrained(self,edge):
+        """The queue of edge drained below its lowWatermark. Resume if no other edge is full."""
+        self._fullEdges.discard(edge)
+        if not self._fullEdges:
+            self.log.info('Outlet %s drained. Resuming.' % edge.outlet)
+            self.resumeProducing()
+
+    def pauseProducing(self):
+        """Stop producing data. A distributor only passes data through, so the edge we receive data from is paused.
+        Its queue will fill up and pass the pause further upstream."""
+        edge = self.getInletEdge()
+        if edge:
+            edge.pauseProducing()
+
+    def resumeProducing(self):
+        """Continue to produce data after pauseProducing."""
+        edge = self.getInletEdge()
+        if edge:
+            edge.resumeProducing()
+
+    def setFlowControl(self,highWatermark=None,lowWatermark=None,overflowPolicy=None):
+        """Set the limits of all edges in the graph below this object. See :class:`KNEdge`"""
         for outlet in self.outlets:
-            outlet.dataReceived(data)
+            self.edges[outlet].setFlowControl(highWatermark,lowWatermark,overflowPolicy)
+            if IKNInlet.providedBy(outlet):
+                outlet.setFlowControl(highWatermark,lowWatermark,overflowPolicy)
+
+    def getEdgeStats(self):
+        """Return a list with the stats of every edge in the graph below this object"""
+        stats = []
+        for outlet in self.outlets:
+            stats.append(self.edges[outlet].getStats())
+            if IKNInlet.providedBy(outlet):
+                stats.extend(outlet.getEdgeStats())
+        return stats
+
+    def getStats(self):
+        """Return a dictionary with the data we received and sent"""
+        stats = super(KNDistributor, self).getStats()
+        stats['bytesOut'] = self.bytesOut
+        stats['chunksOut'] = self.chunksOut
+        stats['outletQueuedBytes'] = sum([edge.queuedBytes for edge in self.edges.values()])
+        stats['outletDroppedBytes'] = sum([edge.droppedBytes for edge in self.edges.values()])
+        return stats
 
     # INKOutlet - Consume data
 
@@ -454,11 +818,19 @@ class KNDistributor(KNOutlet):
 
 class KNProcessProtocol(protocol.ProcessProtocol):
     """Base class for all process Protocols"""
+    supervisor = None
+    """The :class:`supervisor.KNProcessSupervisor` that spawned the process or None"""
+    standby = False
+    """A standby process doesn't get data until :meth:`activate` is called"""
+
     def __init__(self, name='Unknown'):
         self.name = name
         self.factory = None
         self._lastLogLine = None
         self.log = logging.getLogger('[%s]' % (self.__class__.__name__))
+        self.starts = 0
+        """How often a process was started with this protocol"""
+        self.crashes = 0
 
     def errReceived(self,data):
         """This is STDERR of the process. Everything gets written to the log. If this is usefull information override this method"""
@@ -468,19 +840,49 @@ class KNProcessProtocol(protocol.ProcessProtocol):
             self._lastLogLine = line
             self.log.warn("%s" % (line))
 
+    def connectionMade(self):
+        """Register the edge feeding our factory as producer for STDIN. If the process doesn't read
+        fast enough the edge gets paused and queues data instead of the pipe buffering without limit."""
+        self.starts += 1
+        if not self.standby:
+            self._registerProducer()
+
+    def activate(self):
+        """A standby process becomes the active one"""
+        self.standby = False
+        self._registerProducer()
+
+    def _registerProducer(self):
+        edge = self.factory.getInletEdge()
+        if edge:
+            self.transport.registerProducer(edge, True)
+
     def writeData(self,data):
         """Write data to STDIN"""
         self.transport.write(data)
 
+    def getStats(self):
+        """Return a dictionary with process starts, restarts and crashes"""
+        if self.supervisor is not None:
+            return self.supervisor.getStats()
+        return {
+            'processStarts': self.starts,
+            'processRestarts': max(0, self.starts - 1),
+            'processCrashes': self.crashes,
+        }
+
     def processEnded(self, reason):
         if(reason.value.exitCode):
+            self.crashes += 1
             self.log.error("crashed: %s" % reason)
             self.log.error("Process was: %s" % (self.factory.cmdline))
             self.log.error("Last message: %s" % (self._lastLogLine))
-            if "processCrashed" in dir(self.factory):
+            if self.supervisor is None and "processCrashed" in dir(self.factory):
                 self.factory.processCrashed()
         else:
             self.log.info("ended.") 
+        if self.supervisor is not None:
+            self.supervisor.processEnded(self, reason)
 
     def childConnectionLost(self,childFD):
         self.log.error('Process closed: %s %s %s' % (childFD, self.factory.cmdline,self._lastLogLine))
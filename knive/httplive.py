@@ -14,17 +14,40 @@ import logging
 import datetime
 import time
 import string
+import math
+import heapq
+import sys
+import errno
 
-from twisted.internet       import reactor
-# from zope.interface import implements
-# from kninterfaces           import IKNOutlet
+from collections import OrderedDict, deque
 
-from foundation import KNDistributor, KNOutlet, KNProcessProtocol
-from ffmpeg     import FFMpeg
+from twisted.internet       import reactor, defer
+from twisted.python.failure import Failure
+from zope.interface         import implements
+from kninterfaces           import IKNRecorder, IKNRecording
+
+from foundation import KNDistributor, KNOutlet, KNProcessProtocol, TS_PACKET_SIZE
+from ffmpeg     import FFMpeg, FFMpegMultiOutput
+from mpegts     import TSParser, TSProbe, ptsDiff, PTS_CLOCK, PTS_WRAP, SYNC_BYTE
 from channel    import Channel
+from diskio     import getPool, deferToDiskIO
+from supervisor import KNProcessSupervisor
+from segmentindex import HTTPLiveSegmentIndex
+from remux      import KNRemuxJob, getQueue
 # from exceptions import 
 import knive
 
+
+def replaceFile(dstPath,filename,data):
+    """Blocking. Atomically replace dstPath/filename with data. The temporary file lives in the same directory, so rename doesn't copy."""
+    destfile = "%s%s%s" % (dstPath,os.path.sep,filename)
+    tmpfile = "%s%s.%s.tmp" % (dstPath,os.path.sep,filename)
+    with open(tmpfile,'wb') as tmp:
+        os.fchmod(tmp.fileno(),0664)
+        tmp.write(data)
+    os.rename(tmpfile,destfile)
+
+
 class HTTPLiveStream(KNDistributor):
     """
     A HTTPLiveStream accepts mpeg-ts streams (optionally) reencodes the data to (optionally) various qualities and cuts them in pieces.
@@ -33,11 +56,15 @@ class HTTPLiveStream(KNDistributor):
     The .ts segments and playlist are then typically stored on a webserver. Clients supporting HTTPLiveStream specification can then display
     the stream. See http://tools.ietf.org/html/draft-pantos-http-live-streaming for a full specification.
 
+    Recording (see :meth:`startRecording`) costs no encoding and no copies: the segments of an
+    episode are hard links of the live segments.
+
     Extends :class:`KNDistributor`
     """
+    implements(IKNRecorder)
     
-    
-    def __init__(self,name='Unknown',destdir=None,channel=None,publishURL=None,lastIndex=1):
+    def __init__(self,name='Unknown',destdir=None,channel=None,publishURL=None,lastIndex=1,segmenter='live_segmenter',segmentLength=10,encoding='per-variant',storage='disk',standby=False,
+                 lowLatency=False,partLength=1.0,remux=None,remuxQuality=None,alignSegments=False):
         """
         Kwargs:
         name: Name of the stream. (Set by channel.name if not set and channel available)
@@ -45,7 +72,23 @@ class HTTPLiveStream(KNDistributor):
         channel: The :mod:`channel` object this stream belongs to.
         publishURL: The URL where the stream will be acessible to users.
         lastIndex: The "biggest" index currently used by all variant streams. 
+        segmenter: 'live_segmenter' (external process) or 'native' (:class:`HTTPLiveNativeSegmenter`)
+        segmentLength: Target duration of the segments in seconds.
+        encoding: 'per-variant' (one ffmpeg process per quality) or 'shared' (one :class:`FFMpegMultiOutput` decoding once for all qualities)
+        storage: 'disk' (segments and playlists are written to destdir), 'memory' (kept in a :class:`HTTPLiveSegmentStore` only)
+                 or 'both' (served from memory, written to disk for archive and DVR)
+        standby: Keep a pre-spawned standby process for every encoder and segmenter process. See :class:`supervisor.KNProcessSupervisor`
+        lowLatency: Low latency HLS. Segments are published in parts of up to partLength seconds and WebKnive holds
+                    playlist requests until the part they ask for exists. Needs the native segmenter and storage 'memory' or 'both'.
+        remux: 'mp4' or 'm4a': remux every recorded episode to a single file in the background (see :mod:`remux`). None: don't.
+        remuxQuality: Name of the quality that is remuxed. None: the first.
+        alignSegments: Every variant cuts at the same source PTS and gives the segment the same media sequence number
+                       (see :class:`HTTPLiveSegmentClock`). Needs the native segmenter.
         """
+        if lowLatency and (segmenter != 'native' or storage == 'disk'):
+            raise Exception("Low latency HLS needs segmenter 'native' and storage 'memory' or 'both'")
+        if alignSegments and segmenter != 'native':
+            raise Exception("Aligned segments need segmenter 'native'")
         self.name = name
         """name of the stream"""
         if channel.name and name == 'Unknown':
@@ -55,6 +98,40 @@ class HTTPLiveStream(KNDistributor):
         self.publishURL = publishURL
         """The URL the stream will be available at."""
 
+        self.segmenter = segmenter
+        """Which segmenter the variant streams use. 'live_segmenter' or 'native'"""
+
+        self.segmentLength = segmentLength
+        """Target duration of the segments in seconds"""
+
+        self.encoding = encoding
+        """'per-variant' or 'shared'"""
+
+        self.encoder = None
+        """The shared :class:`FFMpegMultiOutput` if encoding is 'shared'"""
+
+        self.storage = storage
+        """'disk', 'memory' or 'both'"""
+
+        self.standby = standby
+        """Keep standby processes"""
+
+        self.lowLatency = lowLatency
+        """Publish parts of segments (low latency HLS)"""
+
+        self.partLength = partLength
+        """Maximum duration of a part in seconds"""
+
+        self.variants = []
+        """List of all :class:`HTTPLiveVariantStream` objects of this stream"""
+
+        self.segmentsPublished = False
+        """True once a segment with lastIndex was published"""
+
+        self.runId = '%x' % int(time.time())
+        """Part of every segment name. The numbers start over when the index is lost (storage 'memory'),
+        the names of this run still differ from the ones of earlier runs. Caches may keep segments forever."""
+
         self.lastIndex = lastIndex
         """This is the index of the first index in a resulting new M3U8 file. 
 
@@ -76,6 +153,23 @@ class HTTPLiveStream(KNDistributor):
             raise Exception('destdir can not be none.')
         self.setDestdir(destdir)
 
+        self.master = HTTPLiveMasterPlaylist(self)
+        """The master playlist (index.m3u8) listing our variants"""
+
+        self.recording = None
+        """The running :class:`HTTPLiveRecording` or None"""
+        self._autoStop = None
+
+        self.remux = remux
+        """'mp4', 'm4a' or None"""
+
+        self.remuxQuality = remuxQuality
+
+        self.clock = None
+        """The :class:`HTTPLiveSegmentClock` of the variants if segments are aligned"""
+        if alignSegments:
+            self.clock = HTTPLiveSegmentClock(self,segmentLength)
+
     def createQuality(self,name,config,ffmpegbin=None):
         """
         Create a new :class:`HTTPLiveVariantStream` object and add it to self.qualities.
@@ -90,8 +184,25 @@ class HTTPLiveStream(KNDistributor):
         """
 
         self.log.info('Creating new HTTPLiveVariantStream: %s' % name)
-        httpliveStreamvariant = HTTPLiveVariantStream(name,config,ffmpegbin=ffmpegbin,destdir=self._destdir + os.path.sep + name)
-        self.addQuality(httpliveStreamvariant)
+        encoder = None
+        if self.encoding == 'shared':
+            if self.encoder is None:
+                if ffmpegbin:
+                    self.encoder = FFMpegMultiOutput(ffmpegbin=ffmpegbin,name='FFMpeg %s' % self.name,standby=self.standby)
+                else:
+                    self.encoder = FFMpegMultiOutput(name='FFMpeg %s' % self.name,standby=self.standby)
+                self.addOutlet(self.encoder)
+            encoder = self.encoder
+
+        if self.clock is not None:
+            config = self.clock.encoderArguments(config)
+        httpliveStreamvariant = HTTPLiveVariantStream(name,config,ffmpegbin=ffmpegbin,destdir=self._destdir + os.path.sep + name,
+                                                        segmenter=self.segmenter,segmentLength=self.segmentLength,encoder=encoder,
+                                                        storage=self.storage,standby=self.standby,
+                                                        partLength=self.partLength if self.lowLatency else None,clock=self.clock)
+        self.variants.append(httpliveStreamvariant)
+        if encoder is None:
+            self.addQuality(httpliveStreamvariant)
         return httpliveStreamvariant
 
         
@@ -105,8 +216,71 @@ class HTTPLiveStream(KNDistributor):
         self.removeOutlet(quality)
         
    
+    def _willStart(self):
+        """Continue after the newest segment any variant recorded in its segment index (before a restart of knive)"""
+        for variant in self.variants:
+            last = variant.segmenter.openIndex()
+            if last is not None:
+                self.setLastIndex(last.index)
+
+    def startRecording(self,episode,autoStop=None):
+        """Record the segments from now on into the directory episode.slug next to the variants.
+        Return the :class:`HTTPLiveRecording`"""
+        if self.recording is not None:
+            self.log.warning('Already recording. Can not start again.')
+            return None
+        if not self.running:
+            self.log.warning('Not running. Can not record.')
+            return None
+        self.recording = HTTPLiveRecording(self,episode,os.path.join(self._destdir,episode.slug))
+        self.recording.start()
+        episode.register(self.recording)
+        if autoStop:
+            self._autoStop = reactor.callLater(autoStop,self.stopRecording)
+        return self.recording
+
+    def stopRecording(self):
+        """Stop the recording. Return a Deferred that fires with the :class:`HTTPLiveRecording` when its playlists are written."""
+        if self._autoStop is not None and self._autoStop.active():
+            self._autoStop.cancel()
+        self._autoStop = None
+        if self.recording is None:
+            return defer.succeed(None)
+        recording = self.recording
+        self.recording = None
+        d = recording.stop()
+        if self.remux:
+            d.addCallback(self._remuxRecording)
+        return d
+
+    def _remuxRecording(self,recording):
+        """Queue the remux of a finished recording to <episode slug>.<remux> in its directory"""
+        variants = [variant for variant in recording.variants if self.remuxQuality in (None,variant.name)]
+        if not variants or not variants[0].m3u8.segments:
+            self.log.warning('Nothing to remux in %s' % recording.directory)
+            return recording
+        variant = variants[0]
+        job = KNRemuxJob(recording.episode.slug,os.path.join(variant.directory,variant.m3u8.filename),
+                         os.path.join(recording.directory,"%s.%s" % (recording.episode.slug,self.remux)),
+                         format=self.remux,duration=variant.m3u8.segmentDurationTotal)
+        recording.remuxJob = getQueue().add(job)
+        return recording
+
+    def segmentMeasured(self,segmenter):
+        """A segmenter measured the size of a segment. Update the master playlist if the bandwidths moved."""
+        self.master.update()
+
+    def getStats(self):
+        stats = super(HTTPLiveStream,self).getStats()
+        stats['masterPlaylistWrites'] = self.master.writes
+        if self.clock is not None:
+            stats['clockBaseIndex'] = self.clock.baseIndex
+            stats['clockGenerations'] = len(self.clock.generations)
+        return stats
+
     def setLastIndex(self,lastIndex):
         """Update self.lastIndex if it's larger than the current value. This is called by variant streams everytime they write a segment."""
+        self.segmentsPublished = True
         if (lastIndex > self.lastIndex):
             self.lastIndex = lastIndex
 
@@ -126,16 +300,191 @@ class HTTPLiveStream(KNDistributor):
             else:
                 raise Exception("Directory does not exist %s" % destdir)
 
+class HTTPLiveBandwidthMeter(object):
+    """Bitrates of the last window segments, measured from their sizes and durations"""
+
+    def __init__(self,window=20):
+        self.segments = deque(maxlen=window)
+        """(size in bytes, duration in seconds) of the recent segments"""
+
+    def addSegment(self,size,duration):
+        if duration > 0:
+            self.segments.append((size,duration))
+
+    @property
+    def peak(self):
+        """Highest bitrate of a segment in bit/s (BANDWIDTH). Segments shorter than half the longest
+        (the first after a restart, the last before a discontinuity) are ignored, they don't say much."""
+        if not self.segments:
+            return None
+        longest = max([duration for size, duration in self.segments])
+        return int(max([size * 8 / duration for size, duration in self.segments if duration >= longest / 2]))
+
+    @property
+    def average(self):
+        """Bitrate over all recent segments in bit/s (AVERAGE-BANDWIDTH)"""
+        if not self.segments:
+            return None
+        return int(sum([size for size, duration in self.segments]) * 8 / sum([duration for size, duration in self.segments]))
+
+
+class HTTPLiveMasterPlaylist(object):
+    """The master playlist (index.m3u8) of a :class:`HTTPLiveStream`. Lists every variant with
+    BANDWIDTH and AVERAGE-BANDWIDTH as measured by its segmenter and CODECS and RESOLUTION as
+    probed from the segmented stream.
+
+    Nothing is written until every variant published a segment. After that the playlist is
+    only rewritten when a bitrate moved by more than threshold (relative) or the codecs change,
+    players may reload it any time and shouldn't see numbers jitter.
+    """
+
+    threshold = 0.1
+
+    def __init__(self,stream,filename='index.m3u8'):
+        self.stream = stream
+        self.filename = filename
+        self.playlist = None
+        """The current rendition or None"""
+        self.writes = 0
+        self.writeToDisk = stream.storage != 'memory'
+        self.diskIO = getPool()
+        self._variants = None
+
+    def update(self):
+        """Collect the measurements of every variant. Write the playlist if they moved enough."""
+        variants = []
+        for variant in self.stream.variants:
+            segmenter = variant.segmenter
+            peak = segmenter.bandwidth.peak
+            if peak is None:
+                return
+            uri = "%s/%s" % (variant.name,segmenter.m3u8.filename)
+            variants.append((uri,peak,segmenter.bandwidth.average,segmenter.probe.codecString,segmenter.probe.resolution))
+        if not variants or not self._changed(variants):
+            return
+        self._variants = variants
+        self.playlist = self.render(variants)
+        self.writes += 1
+        if self.writeToDisk:
+            d = deferToDiskIO(self.diskIO,self.stream._destdir,'playlist',replaceFile,self.stream._destdir,self.filename,self.playlist)
+            d.addErrback(lambda failure: self.stream.log.error('Could not write %s: %s' % (self.filename,failure.getErrorMessage())))
+
+    def _changed(self,variants):
+        if self._variants is None or len(variants) != len(self._variants):
+            return True
+        for new, old in zip(variants,self._variants):
+            if new[0] != old[0] or new[3:] != old[3:]:
+                return True
+            for value, written in zip(new[1:3],old[1:3]):
+                if abs(value - written) > written * self.threshold:
+                    return True
+        return False
+
+    def render(self,variants):
+        lines = ["#EXTM3U\n"]
+        for uri, peak, average, codecs, resolution in variants:
+            attributes = "BANDWIDTH=%d,AVERAGE-BANDWIDTH=%d" % (peak,average)
+            if codecs:
+                attributes += ',CODECS="%s"' % codecs
+            if resolution:
+                attributes += ",RESOLUTION=%s" % resolution
+            lines.append("#EXT-X-STREAM-INF:%s\n%s\n" % (attributes,uri))
+        return ''.join(lines)
+
+
+class HTTPLiveSegmentClock(object):
+    """Cut points and media sequence numbers shared by the variants of a stream.
+
+    The PTS axis of the source is divided into cells of segmentLength seconds. The encoders
+    keep the timestamps of the source (-copyts) and force a keyframe at the first frame of
+    every cell. The native segmenters cut at the first keyframe in a new cell. So segment N
+    of every variant starts at the same source frame. The media sequence number of a segment
+    follows from its cell: the first cell any variant reaches gets the next index of the stream.
+
+    When the timestamps of the source jump (a new source, a failover to a standby encoder) the
+    cells of the new timeline are far away from the ones seen so far. They start a new generation:
+    its first cell gets the index after the highest one handed out so far. Variants following a
+    generation switch to the newer one as soon as their timestamps jump too.
+    """
+
+    maxGap = 60.0
+    """Seconds. A cell further than that from the cells of a generation belongs to a new timeline."""
+
+    def __init__(self,stream,segmentLength):
+        self.stream = stream
+        self.segmentLength = segmentLength
+        self.cellTicks = int(segmentLength * PTS_CLOCK)
+        """Length of a cell in PTS ticks"""
+        self.maxGapCells = int(math.ceil(self.maxGap / segmentLength))
+        self.generations = []
+        """[first cell, latest cell, index of the first cell] of every timeline, oldest first"""
+        self.nextIndex = None
+        """One more than the highest index handed out"""
+
+    @property
+    def epochCell(self):
+        """The first cell of the newest generation. Segments of earlier cells are not published."""
+        return self.generations[-1][0] if self.generations else None
+
+    @property
+    def baseIndex(self):
+        """Media sequence number of epochCell"""
+        return self.generations[-1][2] if self.generations else None
+
+    def indexFor(self,cell,generation=0):
+        """Return (generation, media sequence number) of the segment starting in cell. generation is the
+        oldest one cell may belong to. The number is None if cell is before the first cell of its generation."""
+        for number in range(len(self.generations) - 1,generation - 1,-1):
+            epochCell, latestCell, baseIndex = self.generations[number]
+            if epochCell - self.maxGapCells <= cell <= latestCell + self.maxGapCells:
+                if cell < epochCell:
+                    return number, None
+                if cell > latestCell:
+                    self.generations[number][1] = cell
+                index = baseIndex + cell - epochCell
+                self.nextIndex = max(self.nextIndex,index + 1)
+                return number, index
+        # A new timeline
+        if self.nextIndex is None:
+            baseIndex = self.stream.lastIndex
+            if self.stream.segmentsPublished:
+                baseIndex += 1
+        else:
+            baseIndex = self.nextIndex
+        self.generations.append([cell,cell,baseIndex])
+        self.nextIndex = baseIndex + 1
+        return len(self.generations) - 1, baseIndex
+
+    def encoderArguments(self,encoderArguments):
+        """Return a copy of encoderArguments that keeps the source timestamps and forces keyframes at the cell boundaries"""
+        arguments = OrderedDict(encoderArguments)
+        arguments['copyts'] = True
+        # mpegts adds muxdelay to the timestamps unless told not to
+        arguments['mpegts_copyts'] = 1
+        if arguments.get('vcodec') != 'copy' and not arguments.get('vn'):
+            # Copied video keeps the keyframes of the source
+            arguments['force_key_frames'] = 'expr:if(isnan(prev_forced_t),1,gte(floor(t/%g),floor(prev_forced_t/%g)+1))' % (
+                self.segmentLength,self.segmentLength)
+        return arguments
+
+
 class HTTPLiveVariantStream(KNDistributor):
     """Encode an input mpegts stream to the desired quality and segment the stream to chunks"""
     
-    def __init__(self,name,encoderArguments,destdir=None,ffmpegbin=None):
+    def __init__(self,name,encoderArguments,destdir=None,ffmpegbin=None,segmenter='live_segmenter',segmentLength=10,encoder=None,storage='disk',standby=False,partLength=None,clock=None):
         """
         Args:
         name: Name of this quality (Used in path names)
         encoderArguments: :class:`configobj.ConfigObj` with valid ffmpeg options. This will be passed to a new :class:`FFMpeg` object.
         destdir: The location where files will be saved.
         ffmpegbin: Path to ffmpeg binary.
+        segmenter: 'live_segmenter' or 'native'
+        segmentLength: Target duration of the segments in seconds.
+        encoder: A shared :class:`FFMpegMultiOutput`. If None the variant runs its own :class:`FFMpeg`.
+        storage: 'disk', 'memory' or 'both'. See :class:`HTTPLiveStream`
+        standby: Keep standby processes for our own encoder and the segmenter.
+        partLength: Publish parts of up to partLength seconds (low latency HLS, native segmenter only). None: no parts.
+        clock: The :class:`HTTPLiveSegmentClock` deciding the cut points of the native segmenter. None: cut independently.
         """
         super(HTTPLiveVariantStream,self).__init__(name=name)
 
@@ -143,24 +492,57 @@ class HTTPLiveVariantStream(KNDistributor):
         """Name of this variant"""
 
         self.encoder = None
-        """The :class:`FFMpeg` object used for encoding"""
+        """The :class:`FFMpeg` or shared :class:`FFMpegMultiOutput` object used for encoding"""
 
         self.segmenter = None
         """The :class:`HTTPLiveSegmenter` object used for segmenting"""
 
+        self.store = None
+        """The :class:`HTTPLiveSegmentStore` holding recent segments in memory (storage 'memory' or 'both')"""
+        if storage != 'disk':
+            self.store = HTTPLiveSegmentStore()
+        writeToDisk = storage != 'memory'
+
         self.destinationDirectory = None
         self.setDestdir(destdir)
         # Set up the encoder
-        if ffmpegbin:
-            self.encoder = FFMpeg(ffmpegbin=ffmpegbin,encoderArguments=encoderArguments)
+        if encoder:
+            self.encoder = encoder
+        elif ffmpegbin:
+            self.encoder = FFMpeg(ffmpegbin=ffmpegbin,encoderArguments=encoderArguments,standby=standby)
         else:
-            self.encoder = FFMpeg(encoderArguments=encoderArguments)
+            self.encoder = FFMpeg(encoderArguments=encoderArguments,standby=standby)
 
-        self.segmenter = HTTPLiveSegmenter(name=self.name+"_segmenter",destdir=self.destinationDirectory)
+        if segmenter == 'native':
+            self.segmenter = HTTPLiveNativeSegmenter(name=self.name+"_segmenter",destdir=self.destinationDirectory,segmentLength=segmentLength,
+                                                        store=self.store,writeToDisk=writeToDisk,partLength=partLength,clock=clock)
+        else:
+            self.segmenter = HTTPLiveSegmenter(name=self.name+"_segmenter",destdir=self.destinationDirectory,segmentLength=segmentLength,
+                                                        store=self.store,writeToDisk=writeToDisk,standby=standby)
 
         # Hook everything up
-        self.addOutlet(self.encoder)
-        self.encoder.addOutlet(self.segmenter)
+        if encoder:
+            # Shared encoder -> variant -> segmenter
+            self.addOutlet(self.segmenter)
+            encoder.addVariant(self,encoderArguments)
+        else:
+            # Variant -> encoder -> segmenter
+            self.addOutlet(self.encoder)
+            self.encoder.addOutlet(self.segmenter)
+
+    def getEncodingStats(self):
+        """Return the latest progress values (fps, speed, bitrate, ...) of the encoder feeding this variant"""
+        return self.encoder.getEncodingStats(self)
+
+    def getStats(self):
+        """Return our counters, the encoding stats and the stats of our store"""
+        stats = super(HTTPLiveVariantStream,self).getStats()
+        for key, value in self.getEncodingStats().items():
+            stats['encoder' + key[0].upper() + key[1:]] = value
+        if self.store is not None:
+            for key, value in self.store.getStats().items():
+                stats['store' + key[0].upper() + key[1:]] = value
+        return stats
 
     def willStart(self):
         config = self._findObjectInInletChainOfClass(knive.Knive).config
@@ -192,13 +574,17 @@ class HTTPLiveVariantStream(KNDistributor):
 
 class HTTPLiveSegmenter(KNOutlet):
     """Cuts mpeg-ts streams in chunks and creates index files."""
-    def __init__(self,name="Unknown segmenter",segmenterbin=None,destdir=None,tempdir=None):
+    def __init__(self,name="Unknown segmenter",segmenterbin=None,destdir=None,tempdir=None,segmentLength=10,store=None,writeToDisk=True,standby=False):
         """
         Kwargs:
             name: Name of this segmenter.
             segmenterbin: Path to the segmenter binary
             destdir: The location where ready files will be moved to.
             tempdir: Location where tempfiles will be written. If None, let python decide.
+            segmentLength: Target duration of a segment in seconds.
+            store: A :class:`HTTPLiveSegmentStore` finished segments and playlists are handed to.
+            writeToDisk: Write segments and playlists to destdir.
+            standby: Keep a second segmenter process waiting to take over.
         """
 
         super(HTTPLiveSegmenter, self).__init__(name=name)
@@ -210,13 +596,39 @@ class HTTPLiveSegmenter(KNOutlet):
             self._setSegmenterbin(segmenterbin)
         """The segmenter binary to be used (path)"""
 
+        self.segmentLength = segmentLength
+        """Target duration of a segment in seconds"""
+
+        self.store = store
+        """The :class:`HTTPLiveSegmentStore` of our variant or None"""
+
+        self.writeToDisk = writeToDisk
+        """Write segments and playlists to the destination directory"""
+
+        self.diskIO = getPool()
+        """The :class:`knive.diskio.KNDiskIOPool` blocking file operations run in. None runs them in the reactor thread."""
+
         self.m3u8 = None
         """The :class:`HTTPLiveStreamM3U8` object associated with this segmenter."""
 
         self.httpStream = None
         """The :class:`HTTPLiveStream` this segmenter belongs to. This is determined automatially."""
 
-        
+        self.probe = TSProbe()
+        """Finds the codecs and the resolution of the stream we segment (for the master playlist)"""
+
+        self.bandwidth = HTTPLiveBandwidthMeter()
+        """Bitrates of the recent segments (for the master playlist)"""
+
+        self.index = None
+        """The :class:`segmentindex.HTTPLiveSegmentIndex` of every segment written to disk. See :meth:`openIndex`"""
+
+        self.recorders = []
+        """The :class:`HTTPLiveVariantRecording` objects published segments are handed to while the stream records"""
+        self.segmentsLost = 0
+        """Segments that could not be moved into place (listed as gaps)"""
+
+        self.filePrefix = None
 
         self._destinationDirectory = destdir
 
@@ -225,34 +637,125 @@ class HTTPLiveSegmenter(KNOutlet):
         else:
             self._tempdir = tempdir
 
-        self._protocol = SegmenterProtocol()
-        self._protocol.factory = self
+        self.supervisor = KNProcessSupervisor(self,SegmenterProtocol,standby=standby)
+        """Restarts the segmenter process when it dies"""
 
+    @property
+    def _protocol(self):
+        return self.supervisor.active
 
-        
-    def _start(self):
-        """All preparations done. Start the process"""
+    def _prepare(self):
+        """Find the objects we belong to and set up the index file"""
         self.httpStream = self._findObjectInInletChainOfClass(HTTPLiveStream)
         variant = self._findObjectInInletChainOfClass(HTTPLiveVariantStream)
         channel = self._findObjectInInletChainOfClass(Channel)
         if not channel:
             raise(Exception('Cant find channel'))
-        if self.segmenterbin is None:
-            self._setSegmenterbin(channel.config['paths']['segmenterbin'])
 
         # Fileprefix
         valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
         filePrefix = "%s-%s-" % (channel.slug,variant.name)
-        filePrefix = ''.join(c for c in filePrefix if c in valid_chars)
-        self.log.debug("FilePrefix: '%s'" % filePrefix)
+        self.filePrefix = ''.join(c for c in filePrefix if c in valid_chars)
+        self.log.debug("FilePrefix: '%s'" % self.filePrefix)
 
+        if self.m3u8 is not None:
+            # Started again. Continue the playlist.
+            self.m3u8.addDiscontinuity()
+            return channel
 
-        self.m3u8 = HTTPLiveStreamM3U8(self._destinationDirectory,self)
-        
-        args = ["live_segmenter","10",self._tempdir,filePrefix,filePrefix]
-        self.cmdline = "%s %s" % (self.segmenterbin, " ".join(args))
+        # Continue where the other segmenters of the stream are (see HTTPLiveStream.lastIndex)
+        startIndex = self.httpStream.lastIndex
+        if self.httpStream.segmentsPublished:
+            startIndex += 1
+        self.m3u8 = HTTPLiveStreamM3U8(self._destinationDirectory,self,startIndex=startIndex,segmentLength=self.segmentLength,
+                                       segmentPrefix='s-%s' % self.httpStream.runId)
+        self.m3u8.segmenttitle = channel.name
+        self.m3u8.writeToDisk = self.writeToDisk
+        self.m3u8.store = self.store
+        self.m3u8.diskIO = self.diskIO
+        if self.store is not None:
+            self.store.maxSegments = self.m3u8.maxSegments + 3
+        elif self.index is not None:
+            # The segments are still on disk. A store would not have them.
+            self.m3u8.restore(self.index.tail(self.m3u8.maxSegments))
+        return channel
+
+    def openIndex(self):
+        """Blocking (once, at startup). Open the segment index in the destination directory if we write to disk.
+        Return the newest record in it or None."""
+        if self.index is None and self.writeToDisk:
+            self.index = HTTPLiveSegmentIndex(os.path.join(self._destinationDirectory,'segments.idx')).open()
+            if self.index.truncatedBytes:
+                self.log.warning('Cut off %d bytes of a torn record at the end of %s' % (self.index.truncatedBytes,self.index.filename))
+        if self.index is None:
+            return None
+        return self.index.last
+
+    def _indexSegment(self,segment,size):
+        """Add a published segment to the segment index. Queued behind the move of the segment."""
+        if self.index is None:
+            return
+        d = deferToDiskIO(self.diskIO,self._destinationDirectory,'index',self.index.append,segment.index,segment.timestamp - float(segment.length),
+                          float(segment.length),size,str(segment),segment.keyframe,segment.discontinuity)
+        d.addErrback(self._diskIOFailed,'Indexing %s' % segment)
+
+    def _diskIOFailed(self,failure,what):
+        self.log.error('%s failed: %s' % (what,failure.getErrorMessage()))
+
+    def _segmentLost(self,failure,segment):
+        """segment could not be moved into place. It is listed as a gap, not indexed and not recorded."""
+        self.segmentsLost += 1
+        self.log.error('Could not publish %s: %s' % (segment,failure.getErrorMessage()))
+        self.m3u8.markGap(segment)
+        self.m3u8.writeIndexFile()
+
+    def _start(self):
+        """All preparations done. Start the process"""
+        channel = self._prepare()
+        if self.segmenterbin is None:
+            self._setSegmenterbin(channel.config['paths']['segmenterbin'])
+
+        self.args = ["live_segmenter",str(self.segmentLength),self._tempdir,self.filePrefix,self.filePrefix]
+        self.cmdline = "%s %s" % (self.segmenterbin, " ".join(self.args))
+        self.supervisor.start()
+
+    def stop(self):
+        self.supervisor.stop()
+        super(HTTPLiveSegmenter, self).stop()
+
+    def spawnProcess(self,protocol):
+        """Called by our supervisor"""
         self.log.debug("Spawning Process: %s" % self.cmdline)
-        reactor.spawnProcess(self._protocol,self.segmenterbin,args)
+        reactor.spawnProcess(protocol,self.segmenterbin,self.args)
+
+    def processRestarted(self):
+        """The segment the dead process was working on is lost. Numbering continues in our playlist."""
+        self.m3u8.addDiscontinuity()
+
+    def streamDiscontinuity(self):
+        """The encoder feeding us restarted"""
+        if self.m3u8 is not None:
+            self.m3u8.addDiscontinuity()
+
+    def getStats(self):
+        """Return our counters and the segments produced with their durations"""
+        stats = super(HTTPLiveSegmenter,self).getStats()
+        stats.update(self._protocol.getStats())
+        if self.m3u8 is not None:
+            stats.update(self.m3u8.getStats())
+        stats['bandwidthPeak'] = self.bandwidth.peak
+        stats['bandwidthAverage'] = self.bandwidth.average
+        stats['codecs'] = self.probe.codecString
+        stats['resolution'] = self.probe.resolution
+        if self.index is not None:
+            stats['indexRecords'] = len(self.index)
+        stats['segmentsLost'] = self.segmentsLost
+        return stats
+
+    def segmentMeasured(self,size,duration):
+        """A segment of size bytes and duration seconds was published"""
+        self.bandwidth.addSegment(size,duration)
+        self.httpStream.segmentMeasured(self)
 
     def _setSegmenterbin(self,segmenterbin):
         if os.path.exists(segmenterbin):
@@ -265,22 +768,567 @@ class HTTPLiveSegmenter(KNOutlet):
         if not self.running:
             raise(Exception("Process not running"))
         else:
+            if not self.probe.done:
+                self.probe.feed(data)
             self._protocol.writeData(data)
     
     def segmentReady(self,startindex,lastindex,end,encodingprofile,duration):
         """A segment is ready for transfer"""
         #umts-00000001.ts
-        duration = float(duration)
-        
-        self.httpStream.setLastIndex(int(lastindex))
         filename = "%s-%08d.ts" % (encodingprofile,int(lastindex))
         sourcefile = os.path.abspath("%s%s%s" % (self._tempdir,os.path.sep,filename))
-        destfile = os.path.abspath("%s%s%s" % (self._destinationDirectory,os.path.sep,self.m3u8.addSegment(duration)))
-        self.log.debug("Moving file %s to %s" % (sourcefile,destfile))
-        
-        #FIXME: This is propably a blocking call!
-        shutil.move(sourcefile,destfile)
+        self.publishSegment(sourcefile,float(duration))
+
+    def publishSegment(self,sourcefile,duration):
+        """Move the finished segment sourcefile to the destination directory and/or the store and update the index file.
+        The file operations run in the disk I/O pool. The index file is written after the segment is in place."""
+        segment = self.m3u8.addSegment(duration)
+        self.httpStream.setLastIndex(segment.index)
+        destfile = os.path.abspath("%s%s%s" % (self._destinationDirectory,os.path.sep,segment))
+        d = deferToDiskIO(self.diskIO,self._destinationDirectory,'move',self._moveSegment,sourcefile,destfile)
+        def _moved((size,data)):
+            if data is not None:
+                self.store.addSegment(str(segment),data)
+            self._segmentPublished(segment,size,duration,data)
+        d.addCallbacks(_moved,self._segmentLost,errbackArgs=(segment,))
+        return d
+
+    def _segmentPublished(self,segment,size,duration,data):
+        """segment is in place. List it in the playlist, the index and the recordings."""
         self.m3u8.writeIndexFile()
+        self._indexSegment(segment,size)
+        for recorder in self.recorders:
+            recorder.segmentPublished(segment,data)
+        self.segmentMeasured(size,duration)
+
+    def _moveSegment(self,sourcefile,destfile):
+        """Blocking. Return the size of sourcefile and its content if we have a store (else None). Move it to destfile or remove it."""
+        size = os.path.getsize(sourcefile)
+        data = None
+        if self.store is not None:
+            with open(sourcefile,'rb') as segmentFile:
+                data = segmentFile.read()
+        if self.writeToDisk:
+            self.log.debug("Moving file %s to %s" % (sourcefile,destfile))
+            shutil.move(sourcefile,destfile)
+        else:
+            os.remove(sourcefile)
+        return size, data
+
+
+class HTTPLiveNativeSegmenter(HTTPLiveSegmenter):
+    """Cuts mpeg-ts streams in chunks without an external segmenter process.
+
+    Segments are cut at the first keyframe (video) or PES start (audio only streams) after
+    segmentLength seconds. Every segment starts with the current PAT and PMT. Segments are
+    written to a temporary file in the destination directory and renamed when they are done.
+    Durations are taken from the PTS of the stream.
+
+    File writes are collected until writeSize bytes are pending and handed to the disk I/O pool.
+
+    With partLength (low latency HLS) segments are published in parts while they are in progress.
+    A part ends at the first PES start of the cut PID where the next frame would make it longer than
+    partLength seconds. Parts only go to the store.
+
+    With a clock (:class:`HTTPLiveSegmentClock`) segments are cut at the first keyframe in a new cell
+    of the PTS grid of the clock instead, and numbered by their cell. Cells without a segment (the
+    encoder restarted, a GOP longer than a cell) get a gap entry in the playlist, so every number
+    keeps its position.
+    """
+
+    writeSize = 262144
+
+    def __init__(self,name="Unknown segmenter",destdir=None,segmentLength=10,store=None,writeToDisk=True,partLength=None,clock=None):
+        super(HTTPLiveNativeSegmenter, self).__init__(name=name,destdir=destdir,segmentLength=segmentLength,store=store,writeToDisk=writeToDisk)
+        if partLength is not None and store is None:
+            raise Exception('Parts need a store')
+        self.partLength = partLength
+        """Maximum duration of a part in seconds or None"""
+        self.clock = clock
+        """The :class:`HTTPLiveSegmentClock` of the stream or None"""
+        self.indexGaps = 0
+        """Cells without a segment (aligned segments only)"""
+        self._segmentCell = None
+        self._segmentIndex = None
+        self._generation = 0
+        self._timelineJumped = False
+        self._ptsBase = 0
+        self._lastKeyframePTS = None
+        self._parser = TSParser()
+        self._remainder = ''
+        self._segmentFile = None
+        self._segmentData = None
+        self._segmentFileName = None
+        self._pendingWrites = []
+        self._pendingBytes = 0
+        self._segmentStartPTS = None
+        self._segmentKeyframe = False
+        """What the parser saw at the start of the current segment"""
+        self._segmentNumber = 0
+        self._partData = None
+        self._partStartPTS = None
+        self._partIndependent = False
+        self._lastPTS = None
+        self._frameDuration = 0
+        self._segmentBytes = 0
+
+    def _start(self):
+        self._prepare()
+        if self.partLength is not None:
+            self.m3u8.partTarget = self.partLength
+            self.store.maxParts = int(math.ceil(4 * self.segmentLength / self.partLength))
+            self.store.holdTime = 3 * self.segmentLength
+
+    def getStats(self):
+        stats = super(HTTPLiveNativeSegmenter,self).getStats()
+        # There is no process
+        for key in stats.keys():
+            if key.startswith('process'):
+                del stats[key]
+        return stats
+
+    def stop(self):
+        if self._segmentStartPTS is not None and self._parser.lastPTS is not None:
+            self._finishSegment(self._parser.lastPTS)
+        super(HTTPLiveNativeSegmenter, self).stop()
+
+    def streamDiscontinuity(self):
+        """The encoder feeding us restarted. Finish the current segment, the next one starts at the next keyframe of the new stream."""
+        if self._segmentStartPTS is not None and self._parser.lastPTS is not None:
+            self._finishSegment(self._parser.lastPTS)
+        self._segmentStartPTS = None
+        self._lastPTS = None
+        self._parser = TSParser()
+        self._remainder = ''
+        super(HTTPLiveNativeSegmenter, self).streamDiscontinuity()
+
+    def dataReceived(self,data):
+        """Parse the stream packet by packet and write it to the current segment"""
+        if not self.running:
+            raise(Exception("Process not running"))
+        if not self.probe.done:
+            self.probe.feed(data)
+        if self._remainder:
+            data = self._remainder + data
+            self._remainder = ''
+
+        parser = self._parser
+        length = len(data)
+        offset = 0
+        runStart = 0
+        while offset + TS_PACKET_SIZE <= length:
+            if data[offset] != SYNC_BYTE:
+                # Lost sync. Skip to the next sync byte
+                self._write(data[runStart:offset])
+                offset = data.find(SYNC_BYTE, offset + 1)
+                if offset == -1:
+                    return
+                runStart = offset
+                continue
+
+            pid = parser.parsePacket(data, offset)
+            if pid == parser.cutPid and parser.pts is not None:
+                if parser.keyframe and (self._segmentStartPTS is None or self._cutDue(parser.pts)):
+                    start = self.clock is None or self._alignedIndex(parser.pts) is not None
+                    if self._segmentStartPTS is not None and (start or self._timelineJumped):
+                        self._write(data[runStart:offset])
+                        runStart = offset
+                        if self._timelineJumped or ptsDiff(parser.pts, self._lastPTS) >= PTS_CLOCK:
+                            # The timestamps jumped. The segment ends with its last frame.
+                            self._finishSegment((self._lastPTS + self._frameDuration) % PTS_WRAP)
+                            self._segmentStartPTS = None
+                        else:
+                            self._finishSegment(parser.pts)
+                    if self._timelineJumped:
+                        self.m3u8.addDiscontinuity()
+                        self._timelineJumped = False
+                    if start:
+                        runStart = offset
+                        self._startSegment(parser.pts, parser.keyframe)
+                elif self.partLength is not None and self._partStartPTS is not None and self._partDue(parser.pts):
+                    self._write(data[runStart:offset])
+                    runStart = offset
+                    self._finishPart(parser.pts)
+                    self._startPart(parser.pts, parser.keyframe)
+                if self._lastPTS is not None:
+                    duration = ptsDiff(parser.pts, self._lastPTS)
+                    if 0 < duration < PTS_CLOCK:
+                        self._frameDuration = duration
+                self._lastPTS = parser.pts
+            offset += TS_PACKET_SIZE
+
+        self._write(data[runStart:offset])
+        if offset < length:
+            self._remainder = data[offset:]
+
+    def _cutDue(self,pts):
+        """True if a segment should start with the keyframe at pts"""
+        if self.clock is not None:
+            return self._cell(pts) != self._segmentCell
+        return ptsDiff(pts, self._segmentStartPTS) >= self.segmentLength * PTS_CLOCK
+
+    def _alignedIndex(self,pts):
+        """Return the media sequence number of a segment starting with the keyframe at pts or None if no
+        segment may start there (yet). Follow the clock to a new generation when the timestamps jumped."""
+        cell = self._cell(pts)
+        # The next number of our playlist
+        nextIndex = self.m3u8.lastIndex + (1 if self._segmentStartPTS is not None else 0)
+        generation, index = self.clock.indexFor(cell,self._generation)
+        if index is not None and self.m3u8.segments and index < nextIndex:
+            if index == nextIndex - 1:
+                # The cell of our last segment (the encoder restarted within it). Wait for the next one.
+                return None
+            # The timestamps went back
+            generation, index = self.clock.indexFor(cell,self._generation + 1)
+        if generation != self._generation:
+            self.log.warning('Timestamps jumped to cell %d. Following generation %d of the segment clock.' % (cell,generation))
+            self._generation = generation
+            self._timelineJumped = True
+            self._segmentCell = None
+        if index is None:
+            return None
+        self._segmentCell = cell
+        self._segmentIndex = index
+        return index
+
+    def _cell(self,pts):
+        """The cell of the clock the keyframe at pts is in. The PTS is unwrapped first, like ffmpeg does."""
+        if self._lastKeyframePTS is not None and pts < self._lastKeyframePTS and self._lastKeyframePTS - pts > PTS_WRAP // 2:
+            self._ptsBase += PTS_WRAP
+        self._lastKeyframePTS = pts
+        return (self._ptsBase + pts) // self.clock.cellTicks
+
+    def _write(self,data):
+        if data:
+            self._segmentBytes += len(data)
+            if self._segmentFile is not None:
+                self._pendingWrites.append(data)
+                self._pendingBytes += len(data)
+                if self._pendingBytes >= self.writeSize:
+                    self._flushWrites()
+            if self._segmentData is not None:
+                self._segmentData.append(data)
+            if self._partData is not None:
+                self._partData.append(data)
+
+    def _flushWrites(self):
+        if self._pendingWrites:
+            self._diskIO('write',self._segmentFile.write,''.join(self._pendingWrites)).addErrback(self._diskIOFailed,'Writing %s' % self._segmentFileName)
+            self._pendingWrites = []
+            self._pendingBytes = 0
+
+    def _diskIO(self,opName,func,*args):
+        return deferToDiskIO(self.diskIO,self._destinationDirectory,opName,func,*args)
+
+    def _startSegment(self,pts,keyframe):
+        self._segmentNumber += 1
+        self._segmentStartPTS = pts
+        self._segmentKeyframe = keyframe
+        self._segmentBytes = 0
+        if self.clock is not None:
+            # Numbered by the clock. Set before the parts of the segment are named.
+            if self.m3u8.segments and self._segmentIndex > self.m3u8.lastIndex:
+                self.indexGaps += self._segmentIndex - self.m3u8.lastIndex
+                self.m3u8.addGaps(self._segmentIndex,self.clock.segmentLength)
+            else:
+                self.m3u8.lastIndex = self._segmentIndex
+        if self.writeToDisk:
+            self._segmentFileName = os.path.join(self._destinationDirectory,".%s%08d.ts.part" % (self.filePrefix,self._segmentNumber))
+            self._segmentFile = HTTPLiveSegmentFile(self._segmentFileName)
+            self._diskIO('open',self._segmentFile.open).addErrback(self._diskIOFailed,'Opening %s' % self._segmentFileName)
+        if self.store is not None:
+            self._segmentData = []
+        if self.partLength is not None:
+            self._startPart(pts, True)
+        # Make every segment decodable on its own
+        self._write(self._parser.patPacket + self._parser.pmtPacket)
+
+    def _partDue(self,pts):
+        """True if the part in progress would get longer than partLength with the frame at pts"""
+        return ptsDiff(pts, self._partStartPTS) + self._frameDuration > self.partLength * PTS_CLOCK
+
+    def _startPart(self,pts,independent):
+        self._partStartPTS = pts
+        self._partIndependent = independent
+        self._partData = []
+
+    def _finishPart(self,pts,publish=True):
+        """Hand the part in progress to the store. Update the playlist in the store if publish is set."""
+        data = ''.join(self._partData)
+        duration = ptsDiff(pts, self._partStartPTS) / float(PTS_CLOCK)
+        self._partData = None
+        self._partStartPTS = None
+        if not data:
+            return
+        part = self.m3u8.addPart(duration, self._partIndependent)
+        self.store.addPart(str(part),data)
+        if publish:
+            self.m3u8.writePartialIndex()
+
+    def _finishSegment(self,pts):
+        if self._partData is not None:
+            # The playlist is written with the segment
+            self._finishPart(pts,publish=False)
+        duration = ptsDiff(pts, self._segmentStartPTS) / float(PTS_CLOCK)
+        sourcefile = data = None
+        if self._segmentFile is not None:
+            self._flushWrites()
+            self._diskIO('close',self._segmentFile.close).addErrback(self._diskIOFailed,'Closing %s' % self._segmentFileName)
+            sourcefile = self._segmentFile
+            self._segmentFile = None
+        if self._segmentData is not None:
+            data = ''.join(self._segmentData)
+            self._segmentData = None
+        self.publishSegment(sourcefile,duration,data)
+
+    def publishSegment(self,sourcefile,duration,data=None):
+        """Hand the finished segment to the store and/or rename sourcefile (a :class:`HTTPLiveSegmentFile`,
+        same directory, no copy). The segment is listed in the index file when it is in place."""
+        segment = self.m3u8.addSegment(duration)
+        segment.keyframe = self._segmentKeyframe
+        self.httpStream.setLastIndex(segment.index)
+        size = self._segmentBytes
+        if sourcefile is None:
+            self.store.addSegment(str(segment),data)
+            self._segmentPublished(segment,size,duration,data)
+            return
+        # Queued behind the writes of the segment
+        d = self._diskIO('move',sourcefile.moveTo,os.path.join(self._destinationDirectory,str(segment)))
+        def _moved(ignored):
+            if data is not None:
+                self.store.addSegment(str(segment),data)
+            self._segmentPublished(segment,size,duration,data)
+        d.addCallbacks(_moved,self._segmentLost,errbackArgs=(segment,))
+
+
+class HTTPLiveRecording(object):
+    """The recording of an episode by a :class:`HTTPLiveStream`. Every variant records into
+    directory/<variant>/ (see :class:`HTTPLiveVariantRecording`), the master playlist of the
+    stream is copied to directory/index.m3u8 when the recording stops."""
+    implements(IKNRecording)
+
+    def __init__(self,stream,episode,directory):
+        super(HTTPLiveRecording, self).__init__()
+        self.stream = stream
+        self.episode = episode
+        self.directory = directory
+        self.variants = []
+        """The :class:`HTTPLiveVariantRecording` objects"""
+        self.remuxJob = None
+        """The :class:`remux.KNRemuxJob` remuxing the recording or None"""
+        self.log = logging.getLogger('[%s] %s' % (self.__class__.__name__,episode))
+
+    def start(self):
+        """Create the directories (blocking, once) and start recording every variant"""
+        for variant in self.stream.variants:
+            directory = os.path.join(self.directory,variant.name)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            recording = HTTPLiveVariantRecording(variant.name,variant.segmenter,directory,self.episode.title)
+            recording.start()
+            self.variants.append(recording)
+
+    def stop(self):
+        """Return a Deferred that fires with self when every variant finished its playlist"""
+        d = defer.DeferredList([recording.stop() for recording in self.variants])
+        def _finished(results):
+            if self.stream.master.playlist is not None:
+                return deferToDiskIO(self.stream.master.diskIO,self.directory,'playlist',replaceFile,self.directory,
+                                     self.stream.master.filename,self.stream.master.playlist)
+        def _failed(failure):
+            self.log.error('Could not write %s: %s' % (self.stream.master.filename,failure.getErrorMessage()))
+        d.addCallback(_finished)
+        d.addErrback(_failed)
+        d.addCallback(lambda _: self.log.info('Recorded %d segments' % sum([len(recording.m3u8.segments) for recording in self.variants])))
+        d.addCallback(lambda _: self)
+        return d
+
+    def getStats(self):
+        return dict([(recording.name,recording.getStats()) for recording in self.variants])
+
+
+class HTTPLiveVariantRecording(object):
+    """Records the segments a segmenter publishes from start to stop into directory.
+
+    The segments are hard linked (no copy, the file system counts the references). Only if the
+    segments are not on disk (storage 'memory') or can't be linked they are written. The playlist
+    is an EVENT playlist while the recording runs and is turned into a VOD playlist when it stops.
+    The segment in progress at start and at stop is part of the recording.
+    """
+
+    def __init__(self,name,segmenter,directory,title=None):
+        super(HTTPLiveVariantRecording, self).__init__()
+        self.name = name
+        """Name of the variant"""
+        self.segmenter = segmenter
+        self.directory = directory
+        self.title = title
+        self.m3u8 = None
+        """The :class:`HTTPLiveStreamM3U8` (EVENT, then VOD) of the recording"""
+        self.startIndex = None
+        """Media sequence number of the first segment"""
+        self.stopIndex = None
+        """Media sequence number of the last segment. Set by :meth:`stop`."""
+        self.linked = 0
+        self.written = 0
+        """Segments that had to be written (no file to link)"""
+        self.failed = 0
+        self.finished = defer.Deferred()
+        self._timeout = None
+        self.log = logging.getLogger('[%s] %s' % (self.__class__.__name__,directory))
+
+    def start(self):
+        segmenter = self.segmenter
+        # The segment in progress gets m3u8.lastIndex
+        self.startIndex = segmenter.m3u8.lastIndex
+        self.m3u8 = HTTPLiveStreamM3U8(self.directory,self,startIndex=self.startIndex,segmentLength=segmenter.segmentLength,
+                                       playlistType='EVENT',segmentPrefix=segmenter.m3u8.segmentPrefix)
+        self.m3u8.segmenttitle = self.title
+        self.m3u8.diskIO = segmenter.diskIO
+        segmenter.recorders.append(self)
+
+    def stop(self):
+        """Finish with the segment in progress. Return a Deferred that fires when the VOD playlist is written."""
+        if self.stopIndex is None:
+            self.stopIndex = self.segmenter.m3u8.lastIndex
+            if not self.segmenter.running:
+                self._finish()
+            else:
+                # It may never be published (process dies, stream stops)
+                self._timeout = reactor.callLater(2 * self.segmenter.segmentLength,self._finish)
+        return self.finished
+
+    def segmentPublished(self,segment,data):
+        """Called by the segmenter. data is the content of the segment if it is in a store."""
+        if segment.index < self.startIndex or (self.stopIndex is not None and segment.index > self.stopIndex):
+            return
+        source = os.path.join(self.segmenter._destinationDirectory,str(segment))
+        target = os.path.join(self.directory,str(segment))
+        # Queued behind the move of the segment
+        d = deferToDiskIO(self.segmenter.diskIO,self.segmenter._destinationDirectory,'link',self._link,
+                          source if self.segmenter.writeToDisk else None,target,data)
+        def _done(result):
+            if isinstance(result,Failure):
+                # Not in the recording. The next segment lists it as a gap.
+                self.failed += 1
+                self.log.error('Could not record %s: %s' % (segment,result.getErrorMessage()))
+                return
+            if result is True:
+                self.linked += 1
+            elif result is False:
+                self.written += 1
+            else:
+                self.failed += 1
+                self.log.error('Could not record %s: unexpected result %r' % (segment,result))
+                return
+            self._addSegment(segment)
+        d.addBoth(_done)
+        if self.stopIndex is not None and segment.index >= self.stopIndex:
+            d.addBoth(lambda _: self._finish())
+
+    def _link(self,source,target,data):
+        """Blocking. Hard link source to target. Write data to target if that is not possible. Return True if linked."""
+        if source is not None:
+            try:
+                os.link(source,target)
+                return True
+            except OSError, err:
+                if err.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK) or data is None:
+                    raise
+        with open(target,'wb') as segmentFile:
+            segmentFile.write(data)
+        return False
+
+    def _addSegment(self,segment):
+        m3u8 = self.m3u8
+        # Same names as the live segments. Numbers without a segment (not published, not recorded) are gaps.
+        if m3u8.segments and segment.index > m3u8.lastIndex:
+            m3u8.addGaps(segment.index,segment.length)
+        else:
+            m3u8.lastIndex = segment.index
+        if segment.discontinuity and m3u8.segments:
+            m3u8.addDiscontinuity()
+        m3u8.addSegment(segment.length,segment.timestamp)
+        m3u8.writeIndexFile()
+
+    def _finish(self):
+        if self.finished.called or self.m3u8.ended:
+            return
+        if self._timeout is not None and self._timeout.active():
+            self._timeout.cancel()
+        self._timeout = None
+        if self in self.segmenter.recorders:
+            self.segmenter.recorders.remove(self)
+        self.m3u8.finish('VOD')
+        # Fires after the playlist write queued in front of it
+        d = deferToDiskIO(self.m3u8.diskIO,self.directory,'playlist',lambda: None)
+        d.addBoth(lambda _: self.finished.callback(self))
+
+    def getStats(self):
+        return {
+            'startIndex': self.startIndex,
+            'stopIndex': self.stopIndex,
+            'segments': len(self.m3u8.segments) if self.m3u8 is not None else 0,
+            'linked': self.linked,
+            'written': self.written,
+            'failed': self.failed,
+        }
+
+
+class HTTPLiveSegmentFile(object):
+    """A segment file written by the disk I/O pool. All methods block.
+
+    After the first error the file is removed and the other operations do nothing, :meth:`moveTo` fails."""
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.error = None
+        """The first error, the segment is incomplete"""
+        self._file = None
+
+    def open(self):
+        self._run(self._open)
+
+    def write(self,data):
+        self._run(self._file.write,data)
+
+    def close(self):
+        self._run(self._close)
+
+    def moveTo(self,destfile):
+        """Rename the complete file to destfile"""
+        if self.error is not None:
+            raise IOError('%s is incomplete: %s' % (self.filename,self.error))
+        os.rename(self.filename,destfile)
+
+    def _open(self):
+        self._file = open(self.filename,'wb')
+
+    def _close(self):
+        self._file.close()
+        self._file = None
+
+    def _run(self,func,*args):
+        if self.error is not None:
+            return
+        try:
+            func(*args)
+        except EnvironmentError, err:
+            self.error = err
+            self._discard()
+            raise
+
+    def _discard(self):
+        try:
+            if self._file is not None:
+                self._file.close()
+        except EnvironmentError:
+            pass
+        self._file = None
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
 
 class SegmenterProtocol(KNProcessProtocol):
     factory = None
@@ -302,8 +1350,18 @@ class SegmenterProtocol(KNProcessProtocol):
 
 
 class HTTPLiveStreamM3U8(object):
-    """Representation of a HTTPLive Stream indexfile"""
-    def __init__(self, dstPath, httplivestreamvariant, startIndex=1, maxSegments=10, urlPrefix=None, filename="stream.m3u8", segmentLength=10, segmentPrefix="s", allowCache=False,version=3,extKey=None,datetime=datetime.time()):
+    """Representation of a HTTPLive Stream indexfile
+
+    Live playlists (playlistType None) are a sliding window over the last maxSegments segments.
+    'EVENT' and 'VOD' playlists keep every segment. Their index file is only appended to.
+    The playlist lines of a segment are rendered once when the segment is added.
+
+    Low latency HLS (partTarget set, live playlists only): the segment in progress is published part
+    by part (EXT-X-PART) to the store, with a preload hint for the next part. The parts of the
+    segments of the last three target durations are listed too. The index file on disk is the plain
+    playlist, it is written per segment.
+    """
+    def __init__(self, dstPath, httplivestreamvariant, startIndex=1, maxSegments=10, urlPrefix=None, filename="stream.m3u8", segmentLength=10, segmentPrefix="s", allowCache=False,version=3,extKey=None,datetime=datetime.time(),playlistType=None):
         super(HTTPLiveStreamM3U8, self).__init__()
         self.dstPath = dstPath
         self.httplivestreamvariant = httplivestreamvariant
@@ -317,13 +1375,55 @@ class HTTPLiveStreamM3U8(object):
         self.maxSegments = maxSegments
         self.startIndex = startIndex
         self.urlPrefix = urlPrefix
+        self.playlistType = playlistType
+        """None (live, sliding window), 'EVENT' or 'VOD'"""
         
         self.lastIndex = self.startIndex
         self.segmenttitle = None
 
+        self.store = None
+        """A :class:`HTTPLiveSegmentStore` the rendered playlist is handed to"""
+        self.writeToDisk = True
+        """Write the playlist to dstPath"""
+        self.diskIO = None
+        """The :class:`knive.diskio.KNDiskIOPool` index files are written in. None writes them right away."""
+
+        self.targetDuration = int(segmentLength)
+        """Never decreases. Players don't expect it to change."""
+
         self.logger = logging.getLogger('[%s]' % (self.__class__.__name__))
 
-        self.segments = []
+        if playlistType is None:
+            self.segments = deque(maxlen=maxSegments)
+        else:
+            self.segments = []
+        self.ended = False
+
+        self._unwritten = []
+        """Segments not yet written to the index file (append only playlists)"""
+        self._rewrite = True
+        """The next write of an append only playlist has to write everything"""
+        self._rendered = None
+        """The rendered playlist of an append only playlist (only kept if there is a store)"""
+
+        self.discontinuitySequence = 0
+        """Discontinuities that slid out of the playlist (EXT-X-DISCONTINUITY-SEQUENCE)"""
+        self.discontinuities = 0
+        self._discontinuity = False
+
+        self.partTarget = None
+        """Maximum duration of a part in seconds (low latency HLS). None: no parts."""
+        self.parts = []
+        """The :class:`HTTPLiveStreamPart` objects of the segment in progress"""
+
+        self.segmentCount = 0
+        """Segments added since creation. Not limited by maxSegments."""
+        self.gaps = 0
+        """Gap entries added"""
+        self.segmentDurationTotal = 0.0
+        self.segmentDurationMin = None
+        self.segmentDurationMax = None
+        self.segmentDurationLast = None
         
     def setParent(self,parent):
         """set self.parent and also inherit the lastIndex"""
@@ -332,68 +1432,257 @@ class HTTPLiveStreamM3U8(object):
             # print parent
             self.lastIndex = self.httplivestreamvariant._findObjectInInletChainOfClass(HTTPLiveStream).lastIndex
         self.segmenttitle = self.httplivestreamvariant._findObjectInInletChainOfClass(Channel).name
+
+    @property
+    def appendOnly(self):
+        return self.playlistType is not None
+
+    def addDiscontinuity(self):
+        """The next segment does not continue the previous one (new encoder process, new timestamps)"""
+        if not self._discontinuity:
+            self._discontinuity = True
+            self.discontinuities += 1
         
-    def addSegment(self,segmentLength=10):
-        """Add a segment to the stream and return the filename of the the segment"""
+    def restore(self,records):
+        """List the segments of records (:class:`segmentindex.HTTPLiveSegmentRecord`, from before a restart) in front of the new ones"""
+        for number, record in enumerate(records):
+            if number:
+                # Numbers without a record keep their position
+                for index in range(records[number - 1].index + 1,record.index):
+                    end = record.timestamp - (record.index - index - 1) * record.duration
+                    segment = HTTPLiveStreamSegment(index,"%s-%d.ts" % (self.segmentPrefix,index),record.duration,end)
+                    segment.gap = True
+                    segment.render(self.segmenttitle,self.urlPrefix)
+                    self.segments.append(segment)
+                    if self.appendOnly:
+                        self._unwritten.append(segment)
+            segment = HTTPLiveStreamSegment(record.index,record.filename,record.duration,record.end)
+            segment.discontinuity = record.discontinuity
+            segment.render(self.segmenttitle,self.urlPrefix)
+            self.segments.append(segment)
+            if self.appendOnly:
+                self._unwritten.append(segment)
+        if records:
+            self.addDiscontinuity()
+
+    def addSegment(self,segmentLength=10,timestamp=None,gap=False):
+        """Add a segment to the stream and return the filename of the the segment. A gap is a placeholder
+        for a segment that does not exist (EXT-X-GAP)."""
         segmentName = "%s-%d.ts" % (self.segmentPrefix, self.lastIndex)
-        segment = HTTPLiveStreamSegment(self.lastIndex,segmentName,self.segmentLength,time.time())
+        if timestamp is None:
+            timestamp = time.time()
+        segment = HTTPLiveStreamSegment(self.lastIndex,segmentName,segmentLength,timestamp)
+        segment.gap = gap
+        if not gap:
+            segment.discontinuity = self._discontinuity
+            self._discontinuity = False
+            segment.parts = self.parts
+            self.parts = []
+        segment.render(self.segmenttitle,self.urlPrefix)
         self.logger.debug("Segment name: %s Segment Length: %.1f Segment Time: %s " % (segment,float(segment.length),segment.iso8601()))
+        if not self.appendOnly and len(self.segments) == self.maxSegments and self.segments[0].discontinuity:
+            self.discontinuitySequence += 1
         self.segments.append(segment)
+        if self.appendOnly:
+            self._unwritten.append(segment)
+        if gap:
+            self.gaps += 1
+            self.lastIndex += 1
+            return segment
+        duration = float(segmentLength)
+        self.segmentCount += 1
+        self.segmentDurationTotal += duration
+        if self.segmentDurationMin is None or duration < self.segmentDurationMin:
+            self.segmentDurationMin = duration
+        if self.segmentDurationMax is None or duration > self.segmentDurationMax:
+            self.segmentDurationMax = duration
+        self.segmentDurationLast = duration
         self.lastIndex += 1
+        targetDuration = int(round(float(segmentLength)))
+        if targetDuration > self.targetDuration:
+            self.targetDuration = targetDuration
+            # The header of an append only playlist has to be rewritten
+            self._rewrite = True
         return(segment)
-        
-    def writeIndexFile(self):
-        """Write a current representation of the object to a file in self.dstPath + self.filename"""
-        
-        fd, m3u8tmpfilename = tempfile.mkstemp(suffix=".m3u8")
-        m3u8tmp = os.fdopen(fd, "w+b")
-        os.fchmod(fd,0664)
-        m3u8tmp.write("#EXTM3U\n")
-        m3u8tmp.write("#EXT-X-VERSION:%s\n" % (self.version))
-        m3u8tmp.write("#EXT-X-TARGETDURATION:%d\n" % int(self.segmentLength))
+
+    def addGaps(self,index,segmentLength):
+        """Skip the media sequence numbers up to index. Players count segments by their position in
+        the playlist, so every skipped number gets a gap entry. A live playlist gets at most maxSegments."""
+        count = index - self.lastIndex
+        if not self.appendOnly and count > self.maxSegments:
+            self.lastIndex = index - self.maxSegments
+            count = self.maxSegments
+        now = time.time()
+        while self.lastIndex < index:
+            count -= 1
+            self.addSegment(segmentLength,now - count * float(segmentLength),gap=True)
+
+    def markGap(self,segment):
+        """segment won't exist after all (it could not be written). List it as a gap."""
+        segment.gap = True
+        segment.render(self.segmenttitle,self.urlPrefix)
+        self.gaps += 1
+
+    @property
+    def lowLatency(self):
+        return self.partTarget is not None and not self.appendOnly
+
+    @property
+    def nextPartName(self):
+        """Filename of the next part (the preload hint)"""
+        return "%s-%d.%d.ts" % (self.segmentPrefix, self.lastIndex, len(self.parts))
+
+    def addPart(self,duration,independent=False):
+        """Add a part to the segment in progress and return it"""
+        part = HTTPLiveStreamPart(self.nextPartName,duration,independent)
+        part.render(self.urlPrefix)
+        self.parts.append(part)
+        return part
+
+    def getStats(self):
+        """Return the number of segments produced and their durations in seconds"""
+        stats = {
+            'segments': self.segmentCount,
+            'segmentDurationSum': self.segmentDurationTotal,
+            'targetDuration': self.targetDuration,
+            'discontinuities': self.discontinuities,
+            'gaps': self.gaps,
+        }
+        if self.segmentCount:
+            stats['segmentDurationAvg'] = self.segmentDurationTotal / self.segmentCount
+            stats['segmentDurationMin'] = self.segmentDurationMin
+            stats['segmentDurationMax'] = self.segmentDurationMax
+            stats['segmentDurationLast'] = self.segmentDurationLast
+        return stats
+
+    def renderHeader(self,lowLatency=False):
+        """Return the tags in front of the first segment"""
+        lines = []
+        lines.append("#EXTM3U\n")
+        if lowLatency:
+            lines.append("#EXT-X-VERSION:%s\n" % max(self.version,6))
+        else:
+            lines.append("#EXT-X-VERSION:%s\n" % (self.version))
+        lines.append("#EXT-X-TARGETDURATION:%d\n" % self.targetDuration)
+        if lowLatency:
+            lines.append("#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=%.3f\n" % (3 * self.partTarget))
+            lines.append("#EXT-X-PART-INF:PART-TARGET=%.3f\n" % self.partTarget)
+        if self.playlistType:
+            lines.append("#EXT-X-PLAYLIST-TYPE:%s\n" % self.playlistType)
         if self.allowCache:
-            m3u8tmp.write("#EXT-X-ALLOW-CACHE:YES\n")
+            lines.append("#EXT-X-ALLOW-CACHE:YES\n")
         else:
-            m3u8tmp.write("#EXT-X-ALLOW-CACHE:NO\n")
-        
-        # EXT-X-MEDIASEQUENCE
-        # For sliding-window (live) streams this is the lastIndex - 3.
-        # For timeshift it is the firstIndex since start
-        # For non-sliding-window it's the firstIndex
-
-        # Disabled.. let's assume users can navigate to the beginning of a file if they want to
-        # mediasequence = 1
-        # if self.parent.findParentOfType(HTTPLiveStream).slidingWindow:
-        #     self.logger.debug("Sliding window stream. Current last index: %s" % self.lastIndex)
-        #     mediasequence = self.lastIndex - 3
-        # else:
-        #     mediasequence = self.startIndex
-        mediasequence = 1
-        mediasequence = self.lastIndex - 3
-        
-        if(mediasequence < 1):
-            mediasequence = 1
-        m3u8tmp.write("#EXT-X-MEDIA-SEQUENCE:%d\n" % int(mediasequence))
-        
-        
-        for segment in self.segments[(self.maxSegments*-1):]:
-            m3u8tmp.write("#EXT-X-PROGRAM-DATE-TIME:%s\n" % (segment.iso8601()))
-            m3u8tmp.write("#EXTINF:%0.2f,%s\n" % (float(segment.length), self.segmenttitle))
-            if self.urlPrefix is not None:
-                m3u8tmp.write("%s/" % self.urlPrefix)
-            m3u8tmp.write("%s\n" % (segment.filename))
-        
+            lines.append("#EXT-X-ALLOW-CACHE:NO\n")
+        # EXT-X-MEDIA-SEQUENCE is the index of the first segment in the playlist
+        if self.segments:
+            mediasequence = self.segments[0].index
+        else:
+            mediasequence = self.lastIndex
+        lines.append("#EXT-X-MEDIA-SEQUENCE:%d\n" % int(mediasequence))
+        if self.discontinuitySequence:
+            lines.append("#EXT-X-DISCONTINUITY-SEQUENCE:%d\n" % self.discontinuitySequence)
+        return ''.join(lines)
         
-        m3u8tmp.close()
-        destfile = "%s%s%s" % (self.dstPath,os.path.sep,self.filename)
-        self.logger.debug("Moving %s to %s" % (m3u8tmpfilename,destfile))
-        shutil.move(m3u8tmpfilename,destfile)
-        ##EXTM3U
-        #EXT-X-TARGETDURATION:7
-        #EXT-X-MEDIA-SEQUENCE:0
-        #EXTINF:7,    
-        #fileSequence0.ts
-        #EXT-X-ENDLIST
+    def render(self,lowLatency=False):
+        """Return the current representation of the object as m3u8 text. With lowLatency the parts
+        of the recent segments, the parts of the segment in progress and the preload hint."""
+        if not lowLatency:
+            playlist = self.renderHeader() + ''.join([segment.line for segment in self.segments])
+        else:
+            lines = []
+            # Parts of the segments of the last three target durations
+            partsFrom = 3 * self.targetDuration
+            for segment in reversed(self.segments):
+                if partsFrom > 0:
+                    lines.append(segment.lineWithParts)
+                    partsFrom -= float(segment.length)
+                else:
+                    lines.append(segment.line)
+            lines.reverse()
+            if self._discontinuity and self.parts:
+                lines.append("#EXT-X-DISCONTINUITY\n")
+            playlist = self.renderHeader(lowLatency=True) + ''.join(lines) + ''.join([part.line for part in self.parts])
+            if not self.ended:
+                playlist += '#EXT-X-PRELOAD-HINT:TYPE=PART,URI="%s"\n' % self._uri(self.nextPartName)
+        if self.ended:
+            playlist += "#EXT-X-ENDLIST\n"
+        return playlist
+
+    def _uri(self,filename):
+        if self.urlPrefix is not None:
+            return "%s/%s" % (self.urlPrefix,filename)
+        return filename
+
+    def writeIndexFile(self):
+        """Write a current representation of the object to a file in self.dstPath + self.filename
+        and/or hand it to self.store"""
+        if self.appendOnly:
+            self._appendToIndexFile()
+            return
+        playlist = self.render()
+        if self.store is not None:
+            if self.lowLatency:
+                self.writePartialIndex()
+            else:
+                self.store.setPlaylist(self.filename,playlist)
+        if self.writeToDisk:
+            deferToDiskIO(self.diskIO,self.dstPath,'playlist',self._replaceIndexFile,playlist).addErrback(self._writeFailed)
+
+    def writePartialIndex(self):
+        """Hand the low latency playlist to the store (after a part was added). Requests held for it are answered."""
+        self.store.setPlaylist(self.filename,self.render(lowLatency=True),msn=self.lastIndex,parts=len(self.parts),
+                               preloadHint=None if self.ended else self.nextPartName)
+
+    def finish(self,playlistType=None):
+        """No more segments will be added. Add #EXT-X-ENDLIST. With playlistType the type changes (EVENT -> VOD)."""
+        if not self.ended:
+            self.ended = True
+            if playlistType is not None and playlistType != self.playlistType:
+                self.playlistType = playlistType
+                self._rewrite = True
+            self.writeIndexFile()
+
+    def _replaceIndexFile(self,playlist):
+        """Atomically replace the index file"""
+        replaceFile(self.dstPath,self.filename,playlist)
+
+    def _appendToIndexFile(self):
+        """Write only what is new since the last call. The first call (or a change of the header) writes everything."""
+        if self._rewrite:
+            self._rewrite = False
+            self._unwritten = []
+            playlist = self.render()
+            if self.store is not None:
+                self._rendered = playlist
+                self.store.setPlaylist(self.filename,playlist)
+            if self.writeToDisk:
+                deferToDiskIO(self.diskIO,self.dstPath,'playlist',self._replaceIndexFile,playlist).addErrback(self._writeFailed)
+            return
+
+        tail = ''.join([segment.line for segment in self._unwritten])
+        self._unwritten = []
+        if self.ended:
+            tail += "#EXT-X-ENDLIST\n"
+        if not tail:
+            return
+        if self.store is not None:
+            self._rendered += tail
+            self.store.setPlaylist(self.filename,self._rendered)
+        if self.writeToDisk:
+            deferToDiskIO(self.diskIO,self.dstPath,'playlist',self._appendToFile,tail).addErrback(self._writeFailed)
+
+    def _writeFailed(self,failure):
+        self.logger.error('Could not write %s%s%s: %s' % (self.dstPath,os.path.sep,self.filename,failure.getErrorMessage()))
+        if self.appendOnly:
+            # Something is missing in the file now. Write all of it next time.
+            self._rewrite = True
+
+    def _appendToFile(self,tail):
+        fd = os.open("%s%s%s" % (self.dstPath,os.path.sep,self.filename),os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd,tail)
+        finally:
+            os.close(fd)
 
 
 class HTTPLiveStreamSegment(object):
@@ -404,11 +1693,216 @@ class HTTPLiveStreamSegment(object):
         self.filename = filename
         self.length = length
         self.timestamp = timestamp
+        self.discontinuity = False
+        """Rendered with EXT-X-DISCONTINUITY in front"""
+        self.gap = False
+        """A placeholder for a segment that does not exist. Rendered with EXT-X-GAP in front."""
+        self.keyframe = False
+        """The segmenter cut in front of a keyframe. Unknown (False) for external segmenters."""
+        self.parts = []
+        """The :class:`HTTPLiveStreamPart` objects of this segment (low latency HLS)"""
+        self.line = None
+        """The lines of this segment in a playlist. See :meth:`render`"""
+        self.lineWithParts = None
+        """:attr:`line` with the EXT-X-PART lines of the parts of this segment in front"""
         
     def __str__(self):
         return str(self.filename)
         
     def iso8601(self):
         return time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime(self.timestamp))
+
+    def render(self,title=None,urlPrefix=None):
+        """Render (and keep) the playlist lines of this segment"""
+        if title is None:
+            title = ''
+        if urlPrefix is not None:
+            uri = "%s/%s" % (urlPrefix,self.filename)
+        else:
+            uri = self.filename
+        line = "#EXT-X-PROGRAM-DATE-TIME:%s\n#EXTINF:%0.3f,%s\n%s\n" % (self.iso8601(),float(self.length),title,uri)
+        tag = "#EXT-X-DISCONTINUITY\n" if self.discontinuity else ''
+        if self.gap:
+            tag += "#EXT-X-GAP\n"
+        self.line = tag + line
+        self.lineWithParts = tag + ''.join([part.line for part in self.parts]) + line
+        return self.line
+
+
+class HTTPLiveStreamPart(object):
+    """A part of a segment (low latency HLS). Parts are published while their segment is still in progress."""
+    def __init__(self, filename, length, independent=False):
+        super(HTTPLiveStreamPart, self).__init__()
+        self.filename = filename
+        self.length = length
+        self.independent = independent
+        """Starts with a keyframe"""
+        self.line = None
+
+    def __str__(self):
+        return str(self.filename)
+
+    def render(self,urlPrefix=None):
+        if urlPrefix is not None:
+            uri = "%s/%s" % (urlPrefix,self.filename)
+        else:
+            uri = self.filename
+        self.line = '#EXT-X-PART:DURATION=%0.5f,URI="%s"%s\n' % (float(self.length),uri,',INDEPENDENT=YES' if self.independent else '')
+        return self.line
         
-      
+
+
+class HTTPLiveSegmentStore(object):
+    """Recent segments and the current playlist of a variant, kept in memory.
+
+    A bounded ring. When a segment is added the oldest one is dropped once
+    maxSegments is exceeded. WebKnive serves directly from here.
+
+    Low latency HLS: the parts of recent segments are kept as well (up to maxParts). Requests for a
+    playlist update that does not exist yet (blocking playlist reload) and for the part announced in the
+    preload hint are held as Deferreds until it exists or for up to holdTime seconds.
+    """
+
+    holdTime = 30.0
+    """Seconds a request is held at most. Three target durations is what the spec asks for."""
+
+    def __init__(self, maxSegments=13):
+        """
+        Kwargs:
+            maxSegments: Number of segments to keep. Should be a little larger than the playlist window
+                         so clients fetching the oldest segment of a playlist still find it.
+        """
+        super(HTTPLiveSegmentStore, self).__init__()
+        self.maxSegments = maxSegments
+        self.segments = OrderedDict()
+        """Segment filenames mapped to their data"""
+        self.maxParts = 0
+        self.parts = OrderedDict()
+        """Part filenames mapped to their data"""
+        self.playlists = {}
+        """Playlist filenames mapped to the rendered playlist"""
+        self.positions = {}
+        """Playlist filenames mapped to (media sequence number of the segment in progress, number of its parts)"""
+        self.preloadHint = None
+        """Filename of the next part"""
+        self.bytesStored = 0
+
+        self._playlistWaiters = {}
+        """Playlist filenames mapped to a heap of (msn, part, number, Deferred)"""
+        self._partWaiters = {}
+        """Part filenames mapped to a list of Deferreds"""
+        self._expiry = deque()
+        """(deadline, Deferred) of every held request. In order of their deadline."""
+        self._expiryCall = None
+        self._waiterNumber = 0
+
+    def addSegment(self, filename, data):
+        self.segments[filename] = data
+        self.bytesStored += len(data)
+        while len(self.segments) > self.maxSegments:
+            oldName, oldData = self.segments.popitem(last=False)
+            self.bytesStored -= len(oldData)
+
+    def addPart(self, filename, data):
+        """Store a part and hand it to the requests waiting for it"""
+        self.parts[filename] = data
+        self.bytesStored += len(data)
+        while len(self.parts) > self.maxParts:
+            oldName, oldData = self.parts.popitem(last=False)
+            self.bytesStored -= len(oldData)
+        for d in self._partWaiters.pop(filename, []):
+            if not d.called:
+                d.callback(data)
+
+    def setPlaylist(self, filename, data, msn=None, parts=0, preloadHint=None):
+        """Replace a playlist. msn and parts tell how far it goes (see :attr:`positions`).
+        Requests waiting for that (or less) get the playlist."""
+        self.playlists[filename] = data
+        if msn is None:
+            return
+        self.positions[filename] = (msn, parts)
+        self.preloadHint = preloadHint
+        waiters = self._playlistWaiters.get(filename)
+        while waiters and waiters[0][:2] < (msn, parts):
+            d = heapq.heappop(waiters)[3]
+            if not d.called:
+                d.callback(data)
+
+    def get(self, filename):
+        """Return the segment, part or playlist called filename or None"""
+        data = self.segments.get(filename)
+        if data is None:
+            data = self.parts.get(filename)
+        if data is None:
+            data = self.playlists.get(filename)
+        return data
+
+    def waitForPlaylist(self, filename, msn, part=None):
+        """Return a Deferred firing with the playlist once it contains segment msn (or part of it) or
+        with None after :attr:`holdTime`. Return None if msn is too far in the future (more than two
+        segments ahead of the last one, the spec asks for a 400 then)."""
+        position = self.positions.get(filename)
+        if position is None:
+            return None
+        if part is None:
+            # The whole segment
+            part = sys.maxint
+        if (msn, part) < position:
+            return defer.succeed(self.playlists[filename])
+        if msn > position[0] + 1:
+            return None
+        d = defer.Deferred()
+        self._waiterNumber += 1
+        heapq.heappush(self._playlistWaiters.setdefault(filename, []), (msn, part, self._waiterNumber, d))
+        self._hold(d)
+        return d
+
+    def waitForPart(self, filename):
+        """Return a Deferred firing with the part once it exists (or with None after :attr:`holdTime`).
+        Only the part announced in the preload hint can be waited for. For others return None."""
+        data = self.parts.get(filename)
+        if data is not None:
+            return defer.succeed(data)
+        if filename != self.preloadHint:
+            return None
+        d = defer.Deferred()
+        self._partWaiters.setdefault(filename, []).append(d)
+        self._hold(d)
+        return d
+
+    def _hold(self, d):
+        self._expiry.append((time.time() + self.holdTime, d))
+        if self._expiryCall is None:
+            self._expiryCall = reactor.callLater(self.holdTime, self._expire)
+
+    def _expire(self):
+        """Answer the requests held for too long with None. Forget the ones that got their answer."""
+        self._expiryCall = None
+        now = time.time()
+        expiry = self._expiry
+        while expiry and (expiry[0][0] <= now or expiry[0][1].called):
+            d = expiry.popleft()[1]
+            if not d.called:
+                d.callback(None)
+        # Answered playlist requests stay in their heap until the playlist passes them (never more
+        # than two segments). Waiters for parts that won't come are dropped.
+        for filename in self._partWaiters.keys():
+            if filename != self.preloadHint:
+                for d in self._partWaiters.pop(filename):
+                    if not d.called:
+                        d.callback(None)
+        if expiry:
+            self._expiryCall = reactor.callLater(max(expiry[0][0] - now, 0.1), self._expire)
+
+    @property
+    def heldRequests(self):
+        return len([entry for entry in self._expiry if not entry[1].called])
+
+    def getStats(self):
+        return {
+            'segments': len(self.segments),
+            'maxSegments': self.maxSegments,
+            'parts': len(self.parts),
+            'bytesStored': self.bytesStored,
+            'heldRequests': self.heldRequests,
+        }
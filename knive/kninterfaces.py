@@ -54,6 +54,9 @@ class IKNOutlet(IKNStreamObject):
     def setInlet(inlet):
         """Register a data sender (Inlet) with us. Inlet has to be of type IKNOutlet"""
 
+    def streamDiscontinuity():
+        """The stream we receive restarted (e.g. the encoder producing it was restarted)."""
+
 
         
 
@@ -69,7 +72,7 @@ class IKNInlet(IKNStreamObject):
         """Remove an outlet from us."""
         
     def getStats():
-        """Return a string with statistics about data flow (bits p second?)"""
+        """Return a dictionary with counters of this object (bytes and chunks sent, queued bytes of our outlets, ...)"""
 
     def outletStarted(outlet):
         """One of our outlets is ready to receive data."""
@@ -25,18 +25,68 @@ keepfiles = integer(min=0,max=1000,default=3)
 [webservice]
 enabled=boolean(default=False)
 port=integer(min=1024,max=65000,default=8000)
+accessLog=boolean(default=True)
+
+[diskio]
+# Threads moving segments, writing playlists and syncing files
+threads=integer(min=1,max=64,default=4)
+
+[remux]
+# Remuxing recorded episodes to MP4/M4A (see outlet option remux)
+processes=integer(min=1,max=16,default=1)
+nice=integer(min=0,max=19,default=19)
+# Share of all CPUs the remux processes may use together. They are paused when they use more.
+cpuShare=float(min=0.01,max=1.0,default=0.25)
+retries=integer(min=0,max=10,default=2)
 
 [channels]
     [[__many__]]
     name=string(min=3,max=30)
     slug=string(min=3,max=30)
     url=string(min=3,max=100,default='http://example.com')
+    # Flow control between the objects of a channel. When an outlet (e.g. an encoder)
+    # can not keep up, data is queued up to queueHighWatermark bytes. Then either the
+    # source is paused ('pause') or whole TS packets are dropped ('drop').
+    overflowPolicy=option('pause','drop',default='pause')
+    queueHighWatermark=integer(min=65536,default=4194304)
+    queueLowWatermark=integer(min=0,default=1048576)
+    # Send whole TS packets in batches of rechunkPackets packets (or after rechunkMaxDelay
+    # seconds) instead of every fragment the source received
+    rechunk=boolean(default=True)
+    rechunkPackets=integer(min=1,default=348)
+    rechunkMaxDelay=float(min=0,default=0.05)
 
     [[[outlets]]]
         [[[[__many__]]]]
         type=option('HTTPLive','FileArchiver')
-        publishURL=string
+        publishURL=string(default=None)
         outputLocation=string
+        segmenter=option('live_segmenter','native',default='live_segmenter')
+        segmentLength=integer(min=1,max=60,default=10)
+        encoding=option('per-variant','shared',default='per-variant')
+        storage=option('disk','memory','both',default='disk')
+        # Keep a pre-spawned standby process for every encoder and segmenter process.
+        # Crashed processes are restarted with exponential backoff either way.
+        standby=boolean(default=False)
+        # Low latency HLS: publish parts of up to partLength seconds (segmenter native, storage memory or both)
+        lowLatency=boolean(default=False)
+        partLength=float(min=0.1,max=10.0,default=1.0)
+        # Remux every recorded episode to a single file: mp4 (audio and video) or m4a (audio only)
+        remux=option('none','mp4','m4a',default='none')
+        # The quality that is remuxed (default: the first)
+        remuxQuality=string(default=None)
+        alignSegments=boolean(default=False)
+        # FileArchiver: the stream is appended to outputLocation/<filename><suffix>
+        filename=string(default=None)
+        suffix=string(default='.ts')
+        keepFiles=integer(min=0,default=5)
+        # Written in blocks of flushSize bytes, what is left every flushInterval seconds.
+        # More than maxBufferedBytes not yet written pause the source.
+        flushSize=integer(min=4096,default=1048576)
+        flushInterval=float(min=0.1,default=1.0)
+        maxBufferedBytes=integer(min=65536,default=16777216)
+        fsyncPolicy=option('none','interval','flush',default='interval')
+        fsyncInterval=float(min=0.1,default=5.0)
             [[[[[__many__]]]]]
             vcodec=string(default=None)
             acodec=string(default=None)
@@ -47,10 +97,19 @@ port=integer(min=1024,max=65000,default=8000)
             f=string(default=mpegts)
 
     [[[source]]]
-    type=option('kniveTCPSource', 'kniveFileSource', 'kniveIcecastSource')
+    type=option('kniveTCPSource', 'kniveUDPSource', 'kniveFileSource', 'kniveIcecastSource')
     listenAddress=string(default='0.0.0.0')
     listenPort=integer(default=3333)
-    sharedSecret=string(min=5)
+    # Required for kniveTCPSource (publishers authenticate with it)
+    sharedSecret=string(min=5,default=None)
+    # Seconds without data from the primary publisher before a standby takes over
+    failoverTimeout=float(min=0.1,default=2.0)
+    # kniveUDPSource: join this multicast group (unicast if not set)
+    multicastGroup=string(default=None)
+    # kniveUDPSource: SO_RCVBUF in bytes (capped by net.core.rmem_max on Linux)
+    receiveBuffer=integer(min=65536,default=8388608)
+    # kniveUDPSource: hold up to reorderWindow datagrams that arrived out of order
+    reorderWindow=integer(min=0,max=1000,default=8)
 
 
 
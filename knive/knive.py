@@ -15,8 +15,14 @@ from validate   import Validator
 
 from channel    import Channel
 from tcpts      import TCPTSServer
+from udpts      import UDPTSServer
+from rechunker  import TSRechunker
 from httplive   import HTTPLiveStream
+from files      import FileWriter
 from kninterfaces   import IKNInlet
+from stats          import KNStatsCollector
+import diskio
+import remux
 
 from twisted.application        import service
 from twisted.python.log         import *
@@ -31,10 +37,19 @@ class Knive(service.MultiService):
         self.config = None
         self.log = logging.getLogger('Knive')
         self.loadConfig()
+        diskio.getPool().setMaxThreads(self.config['diskio']['threads'])
+        remux.getQueue().configure(ffmpegbin=self.config['paths']['ffmpegbin'],
+                                   maxProcesses=self.config['remux']['processes'],
+                                   nice=self.config['remux']['nice'],
+                                   cpuShare=self.config['remux']['cpuShare'],
+                                   retries=self.config['remux']['retries'])
         
         self.channels = []
         """List of available channels."""
 
+        self.statsCollector = KNStatsCollector(self)
+        """Samples the counters of every channel. See :meth:`getStats`"""
+
     def printOutlets(self,object,t=2,r=1):
         if r>10:
             Exception("Maximum recursion depth")
@@ -48,15 +63,18 @@ class Knive(service.MultiService):
         """Start the service"""
         self.log.debug('Starting channels')
         service.MultiService.startService(self)
+        self.statsCollector.start()
         for channel in self.channels:
             self.log.info('Starting channel %s' % channel)
             self.printOutlets(channel)
             channel.start()
 
     def stopService(self):
+        self.statsCollector.stop()
         for channel in self.channels:
             channel.stop()
-        service.MultiService.stopService()
+        remux.getQueue().stop()
+        service.MultiService.stopService(self)
 
     def createChannelFromConfig(self,configObject):
         channel = Channel(configObject['name'],self.config)
@@ -69,14 +87,42 @@ class Knive(service.MultiService):
         # ================
 
         if configObject['source']['type'] == 'kniveTCPSource':
-            channel.inlet = TCPTSServer(
+            if not configObject['source']['sharedSecret']:
+                # Publishers authenticate with it
+                print 'Channel %s: a kniveTCPSource needs a sharedSecret' % channel.slug
+                sys.exit(1)
+            source = TCPTSServer(
                                                 secret=configObject['source']['sharedSecret'],
-                                                port=configObject['source']['listenPort']
+                                                port=configObject['source']['listenPort'],
+                                                failoverTimeout=configObject['source']['failoverTimeout']
+                                            )
+        elif configObject['source']['type'] == 'kniveUDPSource':
+            source = UDPTSServer(
+                                                name='%s source' % channel.slug,
+                                                hostname=configObject['source']['listenAddress'],
+                                                port=configObject['source']['listenPort'],
+                                                multicastGroup=configObject['source']['multicastGroup'],
+                                                receiveBuffer=configObject['source']['receiveBuffer'],
+                                                reorderWindow=configObject['source']['reorderWindow'],
+                                                batchPackets=configObject['rechunkPackets'],
+                                                maxDelay=configObject['rechunkMaxDelay']
                                             )
         else:
             print "Unknown Inlet Type %s" % knive.config['stream']['inlet']
             sys.exit(1)
 
+        if configObject['rechunk'] and not isinstance(source,UDPTSServer):
+            # UDPTSServer sends whole packets in batches itself
+            rechunker = TSRechunker(
+                                                name='%s rechunker' % channel.slug,
+                                                batchPackets=configObject['rechunkPackets'],
+                                                maxDelay=configObject['rechunkMaxDelay']
+                                            )
+            rechunker.inlet = source
+            channel.inlet = rechunker
+        else:
+            channel.inlet = source
+
         # ===============
         # = Set outlets =
         # ===============
@@ -85,7 +131,21 @@ class Knive(service.MultiService):
             outletConfig = configObject['outlets'][outletsectionname]
             if outletConfig['type'] == 'HTTPLive': 
                 try:
-                    httplivestream = HTTPLiveStream(channel=channel,destdir=outletConfig['outputLocation'],publishURL=outletConfig['publishURL'])
+                    httplivestream = HTTPLiveStream(
+                                                    channel=channel,
+                                                    destdir=outletConfig['outputLocation'],
+                                                    publishURL=outletConfig['publishURL'],
+                                                    segmenter=outletConfig['segmenter'],
+                                                    segmentLength=outletConfig['segmentLength'],
+                                                    encoding=outletConfig['encoding'],
+                                                    storage=outletConfig['storage'],
+                                                    standby=outletConfig['standby'],
+                                                    lowLatency=outletConfig['lowLatency'],
+                                                    partLength=outletConfig['partLength'],
+                                                    remux=None if outletConfig['remux'] == 'none' else outletConfig['remux'],
+                                                    remuxQuality=outletConfig['remuxQuality'],
+                                                    alignSegments=outletConfig['alignSegments']
+                                                )
                     channel.addOutlet(httplivestream)
                 except Exception, err:
                     logging.exception(err)
@@ -97,14 +157,22 @@ class Knive(service.MultiService):
                 
                 
 
-            elif outletConfig['type'] == 'StreamArchiver':
-                
-                archiver = files.FileWriter(
-                                                    knive.config[outletsectionname]['outputdir'],
-                                                    suffix=knive.config[outletsectionname]['suffix'],
-                                                    keepFiles=knive.config[outletsectionname]['keepfiles'],
-                                                    filename=knive.config[outletsectionname]['filename']
+            elif outletConfig['type'] == 'FileArchiver':
+                try:
+                    archiver = FileWriter(
+                                                    outletConfig['outputLocation'],
+                                                    filename=outletConfig['filename'] or channel.slug,
+                                                    suffix=outletConfig['suffix'],
+                                                    keepFiles=outletConfig['keepFiles'],
+                                                    flushSize=outletConfig['flushSize'],
+                                                    flushInterval=outletConfig['flushInterval'],
+                                                    maxBufferedBytes=outletConfig['maxBufferedBytes'],
+                                                    fsyncPolicy=outletConfig['fsyncPolicy'],
+                                                    fsyncInterval=outletConfig['fsyncInterval']
                                                 )
+                except Exception, err:
+                    logging.exception(err)
+                    sys.exit(1)
                 channel.addOutlet(archiver)
             elif outletConfig['type'] == 'MEncoder':
                 mplayer = mplayer.Player(binary=knive.config[outletsectionname]['mplayerbin'])
@@ -112,6 +180,12 @@ class Knive(service.MultiService):
             else:
                 self.log.error('Unknown outlet type %s' % outletsectionname)
 
+        channel.inlet.setFlowControl(
+                                        highWatermark=configObject['queueHighWatermark'],
+                                        lowWatermark=configObject['queueLowWatermark'],
+                                        overflowPolicy=configObject['overflowPolicy']
+                                    )
+
         self.addChannel(channel)
 
 
@@ -132,6 +206,43 @@ class Knive(service.MultiService):
             if self.running:
                 channel.start()
 
+    def getVariantStream(self,channelSlug,qualityName):
+        """Return the :class:`httplive.HTTPLiveVariantStream` of a quality of a channel or None"""
+        for channel in self.channels:
+            if channel.slug != channelSlug:
+                continue
+            for outlet in channel.outlets:
+                if isinstance(outlet,HTTPLiveStream):
+                    for variant in outlet.variants:
+                        if variant.name == qualityName:
+                            return variant
+        return None
+
+    def getSegmentStore(self,channelSlug,qualityName):
+        """Return the :class:`httplive.HTTPLiveSegmentStore` of a quality of a channel or None"""
+        variant = self.getVariantStream(channelSlug,qualityName)
+        if variant is None:
+            return None
+        return variant.store
+
+    def getMasterPlaylist(self,channelSlug):
+        """Return the master playlist (index.m3u8) of the HTTPLive outlet of a channel or None"""
+        for channel in self.channels:
+            if channel.slug != channelSlug:
+                continue
+            for outlet in channel.outlets:
+                if isinstance(outlet,HTTPLiveStream):
+                    return outlet.master.playlist
+        return None
+
+    def getRemuxStats(self):
+        """Return the state of the remux queue and its jobs. See :class:`remux.KNRemuxQueue`"""
+        return remux.getQueue().getStats()
+
+    def getStats(self):
+        """Return the stats of every object of every channel with rates. See :class:`stats.KNStatsCollector`"""
+        return self.statsCollector.getStats()
+
     def removeChannel(self,channel):
         if channel in self.channels:
             if self.running:
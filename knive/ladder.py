@@ -0,0 +1,231 @@
+#
+# ladder.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""How many channels of a quality ladder can this host encode?
+
+Encodes a clip with the encoder arguments of every quality of a channel (as configured in
+knive.conf) as fast as possible. Measures how much faster than real time every encoder is
+and how much CPU time it needs per second of video. From the CPU time of the whole ladder
+and the number of CPUs follows the number of channels the host can sustain.
+
+Usage: kniveServ.py benchmark-ladder [--channel slug] [--clip file.ts] [--verify] ...
+
+Without --clip a test clip is generated with ffmpeg (testsrc2, h264, AAC). A recording of
+real content gives more realistic numbers: noise and motion cost encoder time.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from ffmpeg import FFMpegProgressParser, encoderArgumentList
+
+
+def makeClip(ffmpegbin, filename, duration=30, size='1280x720', rate=25, bitrate='6M'):
+    """Generate a h264/AAC MPEG-TS test clip"""
+    args = [ffmpegbin, '-y', '-nostats', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'testsrc2=size=%s:rate=%d' % (size, rate),
+            '-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=48000',
+            '-t', str(duration),
+            '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', bitrate, '-g', str(rate * 2),
+            '-c:a', 'aac', '-b:a', '128k',
+            '-f', 'mpegts', filename]
+    subprocess.check_call(args)
+    return filename
+
+
+class EncoderRun(object):
+    """One ffmpeg process encoding clip to every output in outputs (lists of ffmpeg arguments)"""
+
+    def __init__(self, ffmpegbin, clip, outputs, name):
+        self.name = name
+        self.args = [ffmpegbin, '-y', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1', '-i', clip]
+        for output in outputs:
+            self.args.extend(output)
+            self.args.append(os.devnull)
+        self.progress = None
+        self.process = None
+        self.started = None
+        self.wallTime = None
+        self.cpuTime = None
+        self.returncode = None
+
+    def start(self):
+        self.started = time.time()
+        self.process = subprocess.Popen(self.args, stdin=open(os.devnull), stdout=subprocess.PIPE)
+
+    def wait(self):
+        """Read the progress until ffmpeg is done. Blocks."""
+        parser = FFMpegProgressParser(self._progressReceived)
+        for line in iter(self.process.stdout.readline, ''):
+            parser.feed(line)
+        pid, status, usage = os.wait4(self.process.pid, 0)
+        self.wallTime = time.time() - self.started
+        self.cpuTime = usage.ru_utime + usage.ru_stime
+        self.returncode = self.process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+    def _progressReceived(self, progress):
+        self.progress = progress
+
+    @property
+    def mediaTime(self):
+        """Seconds of video encoded"""
+        if self.progress is None or not self.progress.outTime:
+            return 0.0
+        return self.progress.outTime
+
+    @property
+    def speed(self):
+        """How much faster than real time"""
+        return self.mediaTime / self.wallTime if self.wallTime else 0.0
+
+    @property
+    def cpuPerSecond(self):
+        """CPU seconds per second of video. 1.0 keeps one CPU busy in real time."""
+        return self.cpuTime / self.mediaTime if self.mediaTime else float('inf')
+
+
+def runAll(runs):
+    """Start every run at once and wait for all of them"""
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.wait()
+    return runs
+
+
+def ladderOutputs(channelConfig):
+    """Return [(name, [outputs])] for every encoder process a channel runs. outputs are ffmpeg argument lists."""
+    encoders = []
+    for outletName in channelConfig['outlets']:
+        outletConfig = channelConfig['outlets'][outletName]
+        if outletConfig['type'] != 'HTTPLive':
+            continue
+        qualities = [(name, encoderArgumentList(dict(outletConfig[name]))) for name in outletConfig.sections]
+        if not qualities:
+            continue
+        if outletConfig['encoding'] == 'shared':
+            encoders.append(('+'.join([name for name, args in qualities]), [args for name, args in qualities]))
+        else:
+            encoders.extend([(name, [args]) for name, args in qualities])
+    return encoders
+
+
+def benchmarkChannel(ffmpegbin, clip, channelConfig, cpus, headroom=0.8, verify=False):
+    """Encode clip with every encoder of the channel one after the other. Return the number of channels this host can sustain."""
+    encoders = ladderOutputs(channelConfig)
+    if not encoders:
+        print "  No HTTPLive qualities configured"
+        return 0
+
+    print "  %-24s %8s %8s %10s %8s %6s" % ('encoder', 'speed', 'fps', 'cpu/s', 'cpus', 'drop')
+    cpuPerSecond = 0.0
+    slowest = None
+    for name, outputs in encoders:
+        run = runAll([EncoderRun(ffmpegbin, clip, outputs, name)])[0]
+        if run.returncode != 0:
+            print "  %-24s failed (exit code %s): %s" % (name, run.returncode, ' '.join(run.args))
+            return 0
+        progress = run.progress
+        print "  %-24s %7.2fx %8.1f %10.2f %8.2f %6s" % (name, run.speed, progress.fps or 0, run.cpuPerSecond,
+                                                        run.cpuTime / run.wallTime, progress.dropFrames)
+        cpuPerSecond += run.cpuPerSecond
+        if slowest is None or run.speed < slowest.speed:
+            slowest = run
+
+    channels = int(math.floor(cpus * headroom / cpuPerSecond)) if cpuPerSecond else 0
+    print "  Ladder needs %.2f CPUs in real time. %d CPUs at %d%% leave room for %d channel(s)." % (
+        cpuPerSecond, cpus, headroom * 100, channels)
+    if slowest.speed < 1.0:
+        print "  %s alone is slower than real time (%.2fx). The ladder can not be encoded live on this host." % (slowest.name, slowest.speed)
+        channels = 0
+
+    if verify and channels:
+        channels = verifyChannels(ffmpegbin, clip, encoders, channels)
+    return channels
+
+
+def verifyChannels(ffmpegbin, clip, encoders, channels):
+    """Run the encoders of channels channels at the same time. Every encoder has to stay faster than real time.
+    Fewer channels are tried until that works."""
+    while channels:
+        runs = []
+        for channel in range(channels):
+            runs.extend([EncoderRun(ffmpegbin, clip, outputs, name) for name, outputs in encoders])
+        runAll(runs)
+        slowest = min(runs, key=lambda run: run.speed)
+        print "  Verify: %d channel(s) at once, slowest encoder %s at %.2fx" % (channels, slowest.name, slowest.speed)
+        if slowest.speed >= 1.0 and all([run.returncode == 0 for run in runs]):
+            return channels
+        channels -= 1
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='kniveServ.py benchmark-ladder',
+                                     description='Measure how many channels of the configured quality ladders this host can encode in real time.')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'knive.conf'),
+                        help='knive configuration file (default: knive.conf)')
+    parser.add_argument('--channel', action='append', help='slug or section name of a channel (default: every channel)')
+    parser.add_argument('--clip', help='MPEG-TS clip to encode (default: generate one)')
+    parser.add_argument('--duration', type=int, default=30, help='seconds of the generated clip')
+    parser.add_argument('--size', default='1280x720', help='resolution of the generated clip')
+    parser.add_argument('--headroom', type=float, default=0.8, help='share of the CPUs encoders may use')
+    parser.add_argument('--cpus', type=int, default=multiprocessing.cpu_count(), help='CPUs of the host (default: %(default)s)')
+    parser.add_argument('--verify', action='store_true', help='run the estimated number of channels at once to confirm it')
+    options = parser.parse_args(argv)
+
+    # Validated configuration with defaults
+    import knive
+    config = knive.Knive(options.config).config
+    ffmpegbin = config['paths']['ffmpegbin']
+
+    clip = options.clip
+    if clip is None:
+        clip = os.path.join(tempfile.gettempdir(), 'knive-ladder-%s-%ds.ts' % (options.size, options.duration))
+        if not os.path.exists(clip):
+            print "Generating %d s test clip %s" % (options.duration, clip)
+            makeClip(ffmpegbin, clip, duration=options.duration, size=options.size)
+
+    results = {}
+    for sectionName in config['channels']:
+        channelConfig = config['channels'][sectionName]
+        if options.channel and sectionName not in options.channel and channelConfig['slug'] not in options.channel:
+            continue
+        print "Channel %s (%s)" % (channelConfig['name'], channelConfig['slug'])
+        results[channelConfig['slug']] = benchmarkChannel(ffmpegbin, clip, channelConfig, options.cpus,
+                                                          headroom=options.headroom, verify=options.verify)
+    if not results:
+        print "No channel found"
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,418 @@
+#
+# mpegts.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Minimal MPEG-TS parsing. Just enough to find programs, elementary streams,
+timestamps, random access points and the codecs of the streams.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from foundation import TS_PACKET_SIZE
+
+SYNC_BYTE = '\x47'
+PID_PAT = 0x0000
+PID_NULL = 0x1fff
+
+PTS_CLOCK = 90000
+"""PTS/DTS ticks per second"""
+PTS_WRAP = 1 << 33
+
+VIDEO_STREAM_TYPES = {
+    0x01: 'mpeg1video',
+    0x02: 'mpeg2video',
+    0x10: 'mpeg4',
+    0x1b: 'h264',
+    0x24: 'hevc',
+}
+AUDIO_STREAM_TYPES = {
+    0x03: 'mp3',
+    0x04: 'mp3',
+    0x0f: 'aac',
+    0x11: 'aac-latm',
+    0x81: 'ac3',
+}
+
+
+def ptsDiff(later, earlier):
+    """Difference between two PTS values in ticks, aware of the 33 bit wrap around"""
+    return (later - earlier) % PTS_WRAP
+
+
+def parseTimestamp(data, offset):
+    """Decode the 5 byte PTS/DTS at offset"""
+    return (((ord(data[offset]) >> 1) & 0x07) << 30 |
+            ord(data[offset + 1]) << 22 |
+            (ord(data[offset + 2]) >> 1) << 15 |
+            ord(data[offset + 3]) << 7 |
+            ord(data[offset + 4]) >> 1)
+
+
+def encodeTimestamp(marker, ts):
+    """Encode ts as 5 byte PTS/DTS field. marker is 0x2 (PTS only), 0x3 (PTS) or 0x1 (DTS)"""
+    return ''.join((
+        chr((marker << 4) | (((ts >> 30) & 0x07) << 1) | 1),
+        chr((ts >> 22) & 0xff),
+        chr((((ts >> 15) & 0x7f) << 1) | 1),
+        chr((ts >> 7) & 0xff),
+        chr(((ts & 0x7f) << 1) | 1),
+    ))
+
+
+def isKeyframePayload(streamType, data, start, end):
+    """Look for an IDR (h264) or IRAP (hevc) NAL unit in data[start:end]."""
+    pos = data.find('\x00\x00\x01', start, end)
+    while pos != -1 and pos + 3 < end:
+        nal = ord(data[pos + 3])
+        if streamType == 0x1b:
+            if nal & 0x1f == 5:
+                return True
+        elif streamType == 0x24:
+            if 16 <= (nal >> 1) & 0x3f <= 21:
+                return True
+        else:
+            return False
+        pos = data.find('\x00\x00\x01', pos + 3, end)
+    return False
+
+
+class TSParser(object):
+    """Incrementally parses TS packets and keeps track of the program structure.
+
+    After :meth:`parsePacket` the attributes pid, unitStart, pts and keyframe
+    describe the packet just parsed. pts is only set for packets starting a PES.
+    """
+
+    def __init__(self):
+        super(TSParser, self).__init__()
+        self.pmtPid = None
+        self.pcrPid = None
+        self.streams = {}
+        """Elementary PIDs mapped to their stream_type"""
+        self.videoPid = None
+        self.audioPid = None
+
+        self.patPacket = None
+        """The last PAT packet seen. Segments have to start with it."""
+        self.pmtPacket = None
+        """The last PMT packet seen."""
+
+        self.pid = None
+        self.unitStart = False
+        self.pts = None
+        self.keyframe = False
+        self.lastPCR = None
+        self.lastPTS = None
+
+    @property
+    def ready(self):
+        """True once PAT and PMT have been seen"""
+        return self.pmtPacket is not None
+
+    @property
+    def cutPid(self):
+        """The PID that decides where a stream can be cut. Video if there is any, audio otherwise."""
+        if self.videoPid is not None:
+            return self.videoPid
+        return self.audioPid
+
+    def parsePacket(self, data, offset=0):
+        """Parse the packet starting at data[offset]. Returns the PID."""
+        b1 = ord(data[offset + 1])
+        pid = ((b1 & 0x1f) << 8) | ord(data[offset + 2])
+        self.pid = pid
+        self.unitStart = unitStart = bool(b1 & 0x40)
+        self.pts = None
+        self.keyframe = False
+
+        b3 = ord(data[offset + 3])
+        payload = offset + 4
+        randomAccess = False
+        if b3 & 0x20:
+            # Adaptation field
+            adaptationLength = ord(data[payload])
+            if adaptationLength:
+                flags = ord(data[payload + 1])
+                randomAccess = bool(flags & 0x40)
+                if flags & 0x10 and pid == self.pcrPid:
+                    self.lastPCR = (ord(data[payload + 2]) << 25 | ord(data[payload + 3]) << 17 |
+                                    ord(data[payload + 4]) << 9 | ord(data[payload + 5]) << 1 |
+                                    ord(data[payload + 6]) >> 7)
+            payload += adaptationLength + 1
+        if not b3 & 0x10:
+            return pid
+        end = offset + TS_PACKET_SIZE
+
+        if pid == PID_PAT:
+            if unitStart:
+                self._parsePAT(data, payload, end)
+                self.patPacket = data[offset:end]
+        elif pid == self.pmtPid:
+            if unitStart:
+                self._parsePMT(data, payload, end)
+                self.pmtPacket = data[offset:end]
+        elif unitStart and pid in self.streams and payload + 9 <= end and data[payload:payload + 3] == '\x00\x00\x01':
+            headerEnd = payload + 9 + ord(data[payload + 8])
+            if headerEnd > end:
+                # PES header continues in the next packet of this PID. We don't follow it: no PTS.
+                headerEnd = end
+            elif ord(data[payload + 7]) & 0x80:
+                self.pts = self.lastPTS = parseTimestamp(data, payload + 9)
+            if pid == self.videoPid:
+                self.keyframe = randomAccess or isKeyframePayload(self.streams[pid], data, headerEnd, end)
+            else:
+                self.keyframe = True
+        return pid
+
+    def _parsePAT(self, data, pos, end):
+        pos += ord(data[pos]) + 1  # pointer_field
+        sectionLength = ((ord(data[pos + 1]) & 0x0f) << 8) | ord(data[pos + 2])
+        sectionEnd = min(pos + 3 + sectionLength - 4, end)
+        pos += 8
+        while pos + 4 <= sectionEnd:
+            program = (ord(data[pos]) << 8) | ord(data[pos + 1])
+            if program != 0:
+                self.pmtPid = ((ord(data[pos + 2]) & 0x1f) << 8) | ord(data[pos + 3])
+                return
+            pos += 4
+
+    def _parsePMT(self, data, pos, end):
+        pos += ord(data[pos]) + 1
+        sectionLength = ((ord(data[pos + 1]) & 0x0f) << 8) | ord(data[pos + 2])
+        sectionEnd = min(pos + 3 + sectionLength - 4, end)
+        self.pcrPid = ((ord(data[pos + 8]) & 0x1f) << 8) | ord(data[pos + 9])
+        programInfoLength = ((ord(data[pos + 10]) & 0x0f) << 8) | ord(data[pos + 11])
+        pos += 12 + programInfoLength
+        streams = {}
+        videoPid = audioPid = None
+        while pos + 5 <= sectionEnd:
+            streamType = ord(data[pos])
+            pid = ((ord(data[pos + 1]) & 0x1f) << 8) | ord(data[pos + 2])
+            streams[pid] = streamType
+            if videoPid is None and streamType in VIDEO_STREAM_TYPES:
+                videoPid = pid
+            elif audioPid is None and streamType in AUDIO_STREAM_TYPES:
+                audioPid = pid
+            pos += 5 + (((ord(data[pos + 3]) & 0x0f) << 8) | ord(data[pos + 4]))
+        self.streams = streams
+        self.videoPid = videoPid
+        self.audioPid = audioPid
+
+
+class _BitReader(object):
+    """Reads bits and Exp-Golomb codes (H.264) from a string"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def bits(self, count):
+        value = 0
+        for i in xrange(count):
+            value = (value << 1) | ((ord(self.data[self.pos >> 3]) >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.bits(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        if value & 1:
+            return (value + 1) // 2
+        return -(value // 2)
+
+
+def parseH264SPS(data):
+    """Parse a H.264 sequence parameter set (data starts after the NAL header byte).
+    Return (profile_idc, constraint flags, level_idc, width, height). Raises IndexError if data is too short."""
+    data = data.replace('\x00\x00\x03', '\x00\x00')
+    reader = _BitReader(data)
+    profile = reader.bits(8)
+    constraints = reader.bits(8)
+    level = reader.bits(8)
+    reader.ue()  # seq_parameter_set_id
+    chromaFormat = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chromaFormat = reader.ue()
+        if chromaFormat == 3:
+            reader.bits(1)  # separate_colour_plane_flag
+        reader.ue()  # bit_depth_luma_minus8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.bits(1)  # qpprime_y_zero_transform_bypass_flag
+        if reader.bits(1):  # seq_scaling_matrix_present_flag
+            for i in xrange(8 if chromaFormat != 3 else 12):
+                if reader.bits(1):
+                    size = 16 if i < 6 else 64
+                    last = following = 8
+                    for j in xrange(size):
+                        if following:
+                            following = (last + reader.se() + 256) % 256
+                        last = following or last
+    reader.ue()  # log2_max_frame_num_minus4
+    pocType = reader.ue()
+    if pocType == 0:
+        reader.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif pocType == 1:
+        reader.bits(1)
+        reader.se()
+        reader.se()
+        for i in xrange(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.bits(1)  # gaps_in_frame_num_value_allowed_flag
+    widthInMbs = reader.ue() + 1
+    heightInMapUnits = reader.ue() + 1
+    frameMbsOnly = reader.bits(1)
+    if not frameMbsOnly:
+        reader.bits(1)  # mb_adaptive_frame_field_flag
+    reader.bits(1)  # direct_8x8_inference_flag
+    width = widthInMbs * 16
+    height = (2 - frameMbsOnly) * heightInMapUnits * 16
+    if reader.bits(1):  # frame_cropping_flag
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        cropX = 2 if chromaFormat in (1, 2) else 1
+        cropY = (2 if chromaFormat == 1 else 1) * (2 - frameMbsOnly)
+        width -= cropX * (left + right)
+        height -= cropY * (top + bottom)
+    return profile, constraints, level, width, height
+
+
+class TSProbe(object):
+    """Finds the codecs of the streams of a TS (as RFC 6381 strings, like the CODECS attribute of
+    a HLS master playlist wants them) and the resolution of the video.
+
+    Feed it the stream until :attr:`done`. Gives up after maxBytes. Knows H.264 (from the SPS),
+    AAC (from the ADTS header), MP3 and AC-3.
+    """
+
+    maxBytes = 16777216
+
+    def __init__(self):
+        super(TSProbe, self).__init__()
+        self.parser = TSParser()
+        self.codecs = {}
+        """Elementary PIDs mapped to their codec string"""
+        self.width = None
+        self.height = None
+        self.bytesProbed = 0
+        self.done = False
+        self._pes = {}
+        """PIDs mapped to the payload collected from their current PES"""
+        self._remainder = ''
+
+    @property
+    def codecString(self):
+        """The codecs of every audio and video stream, video first ('avc1.64001f,mp4a.40.2').
+        None as long as one of them is unknown."""
+        streams = self.parser.streams
+        pids = sorted([pid for pid in streams if streams[pid] in VIDEO_STREAM_TYPES],
+                      key=lambda pid: pid) + sorted([pid for pid in streams if streams[pid] in AUDIO_STREAM_TYPES])
+        if not pids or [pid for pid in pids if pid not in self.codecs]:
+            return None
+        return ','.join([self.codecs[pid] for pid in pids])
+
+    @property
+    def resolution(self):
+        if self.width is None:
+            return None
+        return '%dx%d' % (self.width, self.height)
+
+    def feed(self, data):
+        if self.done:
+            return
+        self.bytesProbed += len(data)
+        if self._remainder:
+            data = self._remainder + data
+            self._remainder = ''
+        parser = self.parser
+        offset = 0
+        length = len(data)
+        while offset + TS_PACKET_SIZE <= length:
+            if data[offset] != SYNC_BYTE:
+                offset = data.find(SYNC_BYTE, offset + 1)
+                if offset == -1:
+                    return
+                continue
+            pid = parser.parsePacket(data, offset)
+            if pid in parser.streams and pid not in self.codecs:
+                self._collect(data, offset, pid)
+            offset += TS_PACKET_SIZE
+        self._remainder = data[offset:]
+        if self.codecString is not None or self.bytesProbed > self.maxBytes:
+            self.done = True
+
+    def _collect(self, data, offset, pid):
+        b3 = ord(data[offset + 3])
+        if not b3 & 0x10:
+            return
+        payload = offset + 4
+        if b3 & 0x20:
+            payload += ord(data[payload]) + 1
+        end = offset + TS_PACKET_SIZE
+        if self.parser.unitStart:
+            if data[payload:payload + 3] != '\x00\x00\x01' or payload + 9 > end:
+                return
+            self._pes[pid] = [data[payload + 9 + ord(data[payload + 8]):end]]
+        elif pid in self._pes:
+            self._pes[pid].append(data[payload:end])
+        else:
+            return
+        pes = ''.join(self._pes[pid])
+        codec = self._probe(pid, self.parser.streams[pid], pes)
+        if codec is not None:
+            self.codecs[pid] = codec
+            del self._pes[pid]
+        elif len(pes) > 4096:
+            # Not in this PES. Try the next one.
+            del self._pes[pid]
+
+    def _probe(self, pid, streamType, pes):
+        """Return the codec string for the start of a PES payload or None if it isn't in there (yet)"""
+        if streamType == 0x1b:
+            pos = pes.find('\x00\x00\x01')
+            while pos != -1 and pos + 4 < len(pes):
+                if ord(pes[pos + 3]) & 0x1f == 7:
+                    end = pes.find('\x00\x00\x01', pos + 4)
+                    if end == -1:
+                        if len(pes) - pos < 256:
+                            return None  # Wait for more of the SPS
+                        end = len(pes)
+                    try:
+                        profile, constraints, level, width, height = parseH264SPS(pes[pos + 4:end])
+                    except IndexError:
+                        return None
+                    if pid == self.parser.videoPid:
+                        self.width, self.height = width, height
+                    return 'avc1.%02x%02x%02x' % (profile, constraints, level)
+                pos = pes.find('\x00\x00\x01', pos + 3)
+        elif streamType == 0x0f:
+            if len(pes) >= 3 and pes[0] == '\xff' and ord(pes[1]) & 0xf0 == 0xf0:
+                # ADTS profile is the MPEG-4 audio object type minus one
+                return 'mp4a.40.%d' % ((ord(pes[2]) >> 6) + 1)
+        elif streamType in (0x03, 0x04):
+            return 'mp4a.40.34'
+        elif streamType == 0x81:
+            return 'ac-3'
+        return None
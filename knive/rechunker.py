@@ -0,0 +1,176 @@
+#
+# rechunker.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Whole TS packets in large batches.
+
+TCP hands us whatever arrived: often small fragments that split packets. Every fragment
+would cost a call per outlet and edge. :class:`TSRechunker` sits between a source and the
+channel, resynchronizes on the sync byte and sends whole packets in batches.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from twisted.internet import reactor
+
+from foundation import KNDistributor, TS_PACKET_SIZE
+from mpegts     import SYNC_BYTE, PID_NULL
+
+
+class TSRechunker(KNDistributor):
+    """Collect whole TS packets and send them in batches of batchPackets packets or after maxDelay seconds.
+
+    Bytes in front of a sync byte are dropped (counted in syncLossBytes). A sync byte is only
+    trusted if the next packet starts with a sync byte too. Continuity counter errors are
+    counted per PID when checkContinuity is set.
+    """
+
+    def __init__(self, name='TSRechunker', batchPackets=348, maxDelay=0.05, checkContinuity=True):
+        super(TSRechunker, self).__init__(name=name)
+        self.batchPackets = batchPackets
+        """348 packets are 65424 bytes"""
+        self.maxDelay = maxDelay
+        self.checkContinuity = checkContinuity
+
+        self.syncLosses = 0
+        self.syncLossBytes = 0
+        self.continuityErrors = {}
+        """PIDs mapped to the number of continuity counter errors"""
+
+        self._remainder = ''
+        self._batch = []
+        self._batchPackets = 0
+        self._timer = None
+        self._counters = {}
+
+    def dataReceived(self, data):
+        if self._remainder:
+            data = self._remainder + data
+            self._remainder = ''
+        length = len(data)
+        offset = 0
+        while offset < length:
+            if data[offset] != SYNC_BYTE:
+                offset = self._resync(data, offset)
+                if offset >= length:
+                    break
+            packets = (length - offset) // TS_PACKET_SIZE
+            if not packets:
+                break
+            end = offset + packets * TS_PACKET_SIZE
+            # Every packet of the run must start with a sync byte. Checked in one go.
+            syncBytes = data[offset:end:TS_PACKET_SIZE]
+            if syncBytes != SYNC_BYTE * packets:
+                packets = syncBytes.find(syncBytes.replace(SYNC_BYTE, '')[0])
+                end = offset + packets * TS_PACKET_SIZE
+            if self.checkContinuity:
+                self._checkContinuity(data, offset, end)
+            self._add(data[offset:end], packets)
+            offset = end
+        if offset < length:
+            self._remainder = data[offset:]
+
+    def _resync(self, data, offset):
+        """Return the offset of the next trusted sync byte or len(data) (the rest is kept for the next call)"""
+        self.syncLosses += 1
+        length = len(data)
+        start = offset
+        while True:
+            offset = data.find(SYNC_BYTE, offset + 1)
+            if offset == -1:
+                self.syncLossBytes += length - start
+                return length
+            if offset + TS_PACKET_SIZE >= length:
+                # Can't verify yet. Wait for more data.
+                self.syncLossBytes += offset - start
+                self._remainder = data[offset:]
+                return length
+            if data[offset + TS_PACKET_SIZE] == SYNC_BYTE:
+                self.syncLossBytes += offset - start
+                return offset
+
+    def _checkContinuity(self, data, offset, end):
+        counters = self._counters
+        for pos in xrange(offset, end, TS_PACKET_SIZE):
+            flags = ord(data[pos + 3])
+            if not flags & 0x10:
+                # No payload. The counter doesn't change.
+                continue
+            pid = ((ord(data[pos + 1]) & 0x1f) << 8) | ord(data[pos + 2])
+            if pid == PID_NULL:
+                continue
+            counter = flags & 0x0f
+            last = counters.get(pid)
+            counters[pid] = counter
+            if last is None or counter == (last + 1) & 0x0f or counter == last:
+                continue
+            if flags & 0x20 and ord(data[pos + 4]) and ord(data[pos + 5]) & 0x80:
+                # discontinuity_indicator
+                continue
+            self.continuityErrors[pid] = self.continuityErrors.get(pid, 0) + 1
+
+    def _add(self, data, packets):
+        if not packets:
+            return
+        self._batch.append(data)
+        self._batchPackets += packets
+        if self._batchPackets >= self.batchPackets:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.maxDelay, self._timeout)
+
+    def _timeout(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Send what is collected"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._batch:
+            if len(self._batch) == 1:
+                data = self._batch[0]
+            else:
+                data = ''.join(self._batch)
+            self._batch = []
+            self._batchPackets = 0
+            self.sendDataToAllOutlets(data)
+
+    def streamDiscontinuity(self):
+        """The stream restarts. Send what is collected, drop a partial packet of the old stream."""
+        self.flush()
+        if self._remainder:
+            self.syncLossBytes += len(self._remainder)
+            self._remainder = ''
+        self._counters = {}
+        super(TSRechunker, self).streamDiscontinuity()
+
+    def _willStop(self):
+        self.flush()
+
+    def getStats(self):
+        stats = super(TSRechunker, self).getStats()
+        stats['syncLosses'] = self.syncLosses
+        stats['syncLossBytes'] = self.syncLossBytes
+        stats['continuityErrors'] = sum(self.continuityErrors.values())
+        stats['continuityErrorsByPid'] = dict([('0x%04x' % pid, errors) for pid, errors in self.continuityErrors.items()])
+        return stats
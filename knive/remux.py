@@ -0,0 +1,350 @@
+#
+# remux.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Remux recorded episodes to a single MP4/M4A file in the background.
+
+Jobs run ffmpeg with ``-c copy`` (no encoding) on the VOD playlist of an episode. They are
+queued in a :class:`KNRemuxQueue`: at most maxProcesses at a time, niced, and paused with
+SIGSTOP whenever they use more than cpuShare of the CPUs of the host, so they never take more
+than that from the live encoders. Failed jobs are retried.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from twisted.internet       import reactor, task
+from twisted.python         import procutils
+
+from foundation import KNProcessProtocol
+from ffmpeg     import FFMpegProgressParser
+from diskio     import getPool, deferToDiskIO
+
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+_queue = None
+
+
+class KNRemuxJob(object):
+    """Remux playlist (a local VOD playlist) to output. duration (seconds) is used for the progress."""
+
+    def __init__(self, name, playlist, output, format='mp4', duration=None):
+        self.name = name
+        self.playlist = playlist
+        self.output = output
+        self.format = format
+        """'mp4' (audio and video) or 'm4a' (audio only)"""
+        self.duration = duration
+        self.state = 'queued'
+        """'queued', 'running', 'done' or 'failed'"""
+        self.attempts = 0
+        self.error = None
+        """The last line ffmpeg wrote to stderr in the last failed attempt"""
+        self.outTime = 0.0
+        self.cpuTime = 0.0
+        """CPU seconds of all attempts"""
+        self.size = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.protocol = None
+        self.cmdline = None
+        self._cpuSample = 0.0
+
+    @property
+    def temporaryOutput(self):
+        return "%s.part" % self.output
+
+    @property
+    def progress(self):
+        """0.0 - 1.0"""
+        if self.state == 'done':
+            return 1.0
+        if not self.duration:
+            return 0.0
+        return min(self.outTime / self.duration, 1.0)
+
+    def arguments(self, ffmpegbin):
+        if self.format == 'mp4':
+            streams = ['-map', '0:v?', '-map', '0:a?']
+        else:
+            streams = ['-map', '0:a?', '-vn']
+        return ([ffmpegbin, '-y', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1', '-i', self.playlist] + streams +
+                ['-c', 'copy', '-threads', '1', '-movflags', '+faststart', '-f', 'mp4', self.temporaryOutput])
+
+    def getStats(self):
+        return {
+            'name': self.name,
+            'format': self.format,
+            'output': self.output,
+            'state': self.state,
+            'progress': self.progress,
+            'attempts': self.attempts,
+            'error': self.error,
+            'size': self.size,
+            'cpuTime': self.cpuTime,
+            'queued': self.queued,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class RemuxProtocol(KNProcessProtocol):
+    """Reads the progress of a remuxing ffmpeg from STDOUT"""
+
+    def __init__(self, queue, job):
+        KNProcessProtocol.__init__(self, name=job.name)
+        self.factory = job
+        self.queue = queue
+        self.job = job
+        self.parser = FFMpegProgressParser(self._progressReceived)
+
+    def makeConnection(self, transport):
+        # The CPU time of the process is gone from /proc once it is reaped. Take the last sample
+        # right before that, the process is a zombie then.
+        reapProcess = transport.reapProcess
+        def _reapProcess():
+            if transport.pid is not None:
+                self.queue._sampleJob(self.job)
+            reapProcess()
+        transport.reapProcess = _reapProcess
+        KNProcessProtocol.makeConnection(self, transport)
+
+    def connectionMade(self):
+        self.starts += 1
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self.parser.feed(data)
+
+    def _progressReceived(self, progress):
+        if progress.outTime is not None:
+            self.job.outTime = progress.outTime
+
+    def processEnded(self, reason):
+        self.queue.jobEnded(self.job, reason.value.exitCode, self._lastLogLine)
+
+
+class KNRemuxQueue(object):
+    """Runs :class:`KNRemuxJob` objects one after the other in up to maxProcesses ffmpeg processes"""
+
+    interval = 0.5
+    """Seconds between two samples of the CPU time of the running jobs"""
+
+    def __init__(self, ffmpegbin='/usr/bin/ffmpeg', maxProcesses=1, nice=19, cpuShare=0.25, retries=2, retryDelay=30.0):
+        super(KNRemuxQueue, self).__init__()
+        self.log = logging.getLogger('[%s]' % (self.__class__.__name__))
+        self.ffmpegbin = ffmpegbin
+        self.maxProcesses = maxProcesses
+        self.nice = nice
+        self.cpuShare = cpuShare
+        """Share of all CPUs the running jobs may use together"""
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.cpus = multiprocessing.cpu_count()
+        self.jobs = []
+        """Every job since start, oldest first"""
+        self.running = []
+        self.paused = False
+        """The running jobs are stopped (SIGSTOP) because they used more than their CPU share"""
+        self.pauses = 0
+        self._queue = []
+        self._resumeCall = None
+        self._sampler = task.LoopingCall(self._sample)
+        self._clockTicks = float(os.sysconf('SC_CLK_TCK')) if hasattr(os, 'sysconf') else 100.0
+
+    def configure(self, ffmpegbin=None, maxProcesses=None, nice=None, cpuShare=None, retries=None):
+        for name, value in (('ffmpegbin', ffmpegbin), ('maxProcesses', maxProcesses), ('nice', nice),
+                            ('cpuShare', cpuShare), ('retries', retries)):
+            if value is not None:
+                setattr(self, name, value)
+
+    def add(self, job):
+        """Queue job. Return it."""
+        self.log.info('Queued %s -> %s' % (job.name, job.output))
+        self.jobs.append(job)
+        self._queue.append(job)
+        self._next()
+        return job
+
+    def _next(self):
+        while self._queue and len(self.running) < self.maxProcesses:
+            self._run(self._queue.pop(0))
+
+    def _run(self, job):
+        job.state = 'running'
+        job.attempts += 1
+        job.started = time.time()
+        job.outTime = 0.0
+        job._cpuSample = 0.0
+        args = job.arguments(self.ffmpegbin)
+        executable = self.ffmpegbin
+        nice = procutils.which('nice')
+        if self.nice and nice:
+            args = ['nice', '-n', str(self.nice)] + args
+            executable = nice[0]
+        job.cmdline = ' '.join(args)
+        job.protocol = RemuxProtocol(self, job)
+        self.running.append(job)
+        self.log.debug('Running %s' % job.cmdline)
+        reactor.spawnProcess(job.protocol, executable, args)
+        if not self._sampler.running:
+            self._sampler.start(self.interval, now=False)
+
+    def jobEnded(self, job, exitCode, lastLine):
+        """Called by the protocol of job"""
+        if job in self.running:
+            self.running.remove(job)
+        job.protocol = None
+        if not self.running:
+            self._resume()
+            if self._sampler.running:
+                self._sampler.stop()
+        d = deferToDiskIO(getPool(), job.output, 'remux', self._moveOutput, job, exitCode == 0)
+        d.addErrback(self._moveFailed, job)
+        d.addCallback(self._jobFinished, job, exitCode, lastLine)
+
+    def _moveOutput(self, job, success):
+        """Blocking. Move the output of a successful attempt in place (return its size) or remove it."""
+        if success and os.path.exists(job.temporaryOutput):
+            os.rename(job.temporaryOutput, job.output)
+            return os.path.getsize(job.output)
+        if os.path.exists(job.temporaryOutput):
+            os.remove(job.temporaryOutput)
+        return None
+
+    def _moveFailed(self, failure, job):
+        """The output could not be moved in place. The attempt failed."""
+        self.log.error('Could not move %s to %s: %s' % (job.temporaryOutput, job.output, failure.getErrorMessage()))
+        return None
+
+    def _jobFinished(self, size, job, exitCode, lastLine):
+        if size is not None:
+            job.size = size
+            job.state = 'done'
+            job.finished = time.time()
+            self.log.info('Remuxed %s to %s (%d bytes) in %.1f s' % (job.name, job.output, job.size, job.finished - job.started))
+        else:
+            job.error = lastLine or 'exit code %s' % exitCode
+            if job.attempts <= self.retries:
+                job.state = 'queued'
+                delay = self.retryDelay * job.attempts
+                self.log.warning('Remuxing %s failed (%s). Retrying in %.0f seconds.' % (job.name, job.error, delay))
+                reactor.callLater(delay, self._retry, job)
+            else:
+                job.state = 'failed'
+                job.finished = time.time()
+                self.log.error('Remuxing %s failed (%s). Giving up after %d attempts.' % (job.name, job.error, job.attempts))
+        self._next()
+
+    def _retry(self, job):
+        if job.state == 'queued' and job not in self._queue:
+            self._queue.append(job)
+            self._next()
+
+    # CPU share
+
+    def _cpuTime(self, pid):
+        """CPU seconds used by pid so far (Linux). None if unknown."""
+        try:
+            with open('/proc/%d/stat' % pid) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            return None
+        # utime and stime are fields 14 and 15, the 12th and 13th after the command
+        return (int(fields[11]) + int(fields[12])) / self._clockTicks
+
+    def _sampleJob(self, job):
+        """Add the CPU time job used since the last sample to job.cpuTime. Return it."""
+        transport = job.protocol.transport if job.protocol is not None else None
+        if transport is None or transport.pid is None:
+            return 0.0
+        # nice execs ffmpeg, the pid stays the same
+        cpuTime = self._cpuTime(transport.pid)
+        if cpuTime is None:
+            return 0.0
+        used = max(cpuTime - job._cpuSample, 0.0)
+        job._cpuSample = cpuTime
+        job.cpuTime += used
+        return used
+
+    def _sample(self):
+        """Pause the running jobs for as long as they used more than their share of the CPUs"""
+        if self.paused:
+            return
+        used = sum([self._sampleJob(job) for job in self.running])
+        allowed = self.interval * self.cpus * self.cpuShare
+        if used > allowed:
+            self._signal(signal.SIGSTOP)
+            self.paused = True
+            self.pauses += 1
+            self._resumeCall = reactor.callLater(self.interval * (used / allowed - 1), self._resume)
+
+    def _resume(self):
+        if self._resumeCall is not None and self._resumeCall.active():
+            self._resumeCall.cancel()
+        self._resumeCall = None
+        if self.paused:
+            self.paused = False
+            self._signal(signal.SIGCONT)
+
+    def _signal(self, signalNumber):
+        # signalProcess only knows the names of a few signals
+        for job in self.running:
+            transport = job.protocol.transport
+            if transport is not None and transport.pid is not None:
+                try:
+                    transport.signalProcess(signalNumber)
+                except Exception, err:
+                    self.log.debug('Could not signal %s: %s' % (job.name, err))
+
+    def stop(self):
+        """Kill the running jobs. They are not retried."""
+        self._queue = []
+        self._resume()
+        for job in list(self.running):
+            job.attempts = self.retries + 1
+            transport = job.protocol.transport
+            if transport is not None and transport.pid is not None:
+                transport.signalProcess('KILL')
+
+    def getStats(self):
+        return {
+            'queued': len(self._queue),
+            'running': len(self.running),
+            'done': len([job for job in self.jobs if job.state == 'done']),
+            'failed': len([job for job in self.jobs if job.state == 'failed']),
+            'paused': self.paused,
+            'pauses': self.pauses,
+            'cpuShare': self.cpuShare,
+            'jobs': [job.getStats() for job in self.jobs],
+        }
+
+
+def getQueue():
+    """Return the remux queue shared by all objects of this process"""
+    global _queue
+    if _queue is None:
+        _queue = KNRemuxQueue()
+    return _queue
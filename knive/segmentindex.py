@@ -0,0 +1,178 @@
+#
+# segmentindex.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""A durable record of every segment a variant produced (for DVR, timeshift and restarts).
+
+The index is an append only file of fixed size records behind a short header. Records are
+written in the order of their media sequence numbers and wall clock times, so both are
+sorted and a lookup is a binary search over the file: O(log n) reads, nothing has to be
+loaded. A record torn by a crash is cut off when the index is opened.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from collections import namedtuple
+
+import bisect
+import os
+import struct
+import threading
+
+MAGIC = 'KNSIDX01'
+
+RECORD = struct.Struct('<QddIB3x64s')
+"""index, start time, duration, size, flags, filename"""
+
+FLAG_KEYFRAME = 0x01
+FLAG_DISCONTINUITY = 0x02
+
+
+class HTTPLiveSegmentRecord(namedtuple('HTTPLiveSegmentRecord', 'index timestamp duration size filename keyframe discontinuity')):
+    """A segment in a :class:`HTTPLiveSegmentIndex`. timestamp is the wall clock time the segment starts."""
+
+    __slots__ = ()
+
+    @property
+    def end(self):
+        return self.timestamp + self.duration
+
+
+class _Column(object):
+    """One field of every record as a sequence, for bisect"""
+
+    def __init__(self, index, field):
+        self.index = index
+        self.field = field
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, position):
+        return self.index[position][self.field]
+
+
+class HTTPLiveSegmentIndex(object):
+    """The segment index file of a variant.
+
+    :meth:`open` and :meth:`append` block (run them in the disk I/O pool). Lookups read a few
+    records, usually from the page cache, and are fine in the reactor thread. They only see
+    records whose :meth:`append` returned.
+    """
+
+    def __init__(self, filename):
+        super(HTTPLiveSegmentIndex, self).__init__()
+        self.filename = filename
+        self.count = 0
+        """Records in the file"""
+        self.truncatedBytes = 0
+        """Bytes of a torn record cut off by :meth:`open`"""
+        self._fd = None
+        self._lock = threading.Lock()
+        """Reads seek. Appends move the offset too."""
+
+    def open(self):
+        """Blocking. Open (or create) the file. Cut off a torn record at the end."""
+        self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            os.write(self._fd, MAGIC)
+            size = len(MAGIC)
+        elif self._read(0, len(MAGIC)) != MAGIC:
+            os.close(self._fd)
+            self._fd = None
+            raise Exception('%s is not a segment index' % self.filename)
+        self.truncatedBytes = (size - len(MAGIC)) % RECORD.size
+        if self.truncatedBytes:
+            size -= self.truncatedBytes
+            os.ftruncate(self._fd, size)
+        self.count = (size - len(MAGIC)) // RECORD.size
+        return self
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def append(self, index, timestamp, duration, size, filename, keyframe=True, discontinuity=False):
+        """Blocking. Add a segment. index and timestamp must not be smaller than those of the last record."""
+        if self.count:
+            last = self[-1]
+            if index <= last.index or timestamp < last.timestamp:
+                raise ValueError('Segment %d at %.3f does not follow segment %d at %.3f' % (index, timestamp, last.index, last.timestamp))
+        if len(filename) > 64:
+            raise ValueError('Segment filename %s is too long' % filename)
+        flags = (FLAG_KEYFRAME if keyframe else 0) | (FLAG_DISCONTINUITY if discontinuity else 0)
+        record = RECORD.pack(index, timestamp, duration, size, flags, filename)
+        with self._lock:
+            os.write(self._fd, record)
+        self.count += 1
+
+    def _read(self, offset, length):
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, length)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        index, timestamp, duration, size, flags, filename = RECORD.unpack(self._read(len(MAGIC) + position * RECORD.size, RECORD.size))
+        return HTTPLiveSegmentRecord(index, timestamp, duration, size, filename.rstrip('\x00'),
+                                     bool(flags & FLAG_KEYFRAME), bool(flags & FLAG_DISCONTINUITY))
+
+    @property
+    def last(self):
+        """The newest record or None"""
+        return self[-1] if self.count else None
+
+    def findIndex(self, index):
+        """Return the record of the segment with media sequence number index or None"""
+        position = bisect.bisect_left(_Column(self, 0), index)
+        if position < self.count:
+            record = self[position]
+            if record.index == index:
+                return record
+        return None
+
+    def findTime(self, timestamp):
+        """Return the record of the segment playing at wall clock time timestamp or None"""
+        position = bisect.bisect_right(_Column(self, 1), timestamp) - 1
+        if position < 0:
+            return None
+        record = self[position]
+        if timestamp >= record.end:
+            return None
+        return record
+
+    def between(self, start, end):
+        """Return the records of the segments playing between the wall clock times start and end"""
+        first = max(bisect.bisect_right(_Column(self, 1), start) - 1, 0)
+        last = bisect.bisect_left(_Column(self, 1), end)
+        return [record for record in [self[position] for position in xrange(first, last)] if record.end > start]
+
+    def tail(self, count):
+        """Return the newest count records, oldest first"""
+        return [self[position] for position in xrange(max(self.count - count, 0), self.count)]
@@ -0,0 +1,197 @@
+#
+# stats.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the 
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, 
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION 
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Counters of every object of a channel, rates and export.
+
+Objects only count (bytes and chunks, see :meth:`foundation.KNStreamObject.getStats`).
+:class:`KNStatsCollector` samples the counters once a second to calculate rates over
+1, 10 and 60 seconds and aggregates everything per channel. :func:`renderPrometheus`
+turns the result into the Prometheus text format.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from twisted.internet import task
+
+from collections import deque
+from kninterfaces import IKNInlet
+import diskio
+
+import re
+import time
+
+RATE_WINDOWS = (1, 10, 60)
+"""Windows (seconds) rates are calculated for"""
+
+RATE_COUNTERS = ('bytesIn', 'chunksIn', 'bytesOut', 'chunksOut')
+"""Counters of :meth:`getStats` rates are calculated for"""
+
+
+class KNRateMeter(object):
+    """Rate of a counter over the last seconds. Feed it with :meth:`sample` about once a second."""
+
+    def __init__(self, windows=RATE_WINDOWS):
+        self.windows = windows
+        self.samples = deque(maxlen=max(windows) + 1)
+
+    def sample(self, now, total):
+        self.samples.append((now, total))
+
+    def rate(self, seconds):
+        """Per second increase of the counter over the last seconds (or as much of it as we have)"""
+        if len(self.samples) < 2:
+            return 0.0
+        lastTime, lastTotal = self.samples[-1]
+        firstTime, firstTotal = self.samples[max(0, len(self.samples) - 1 - seconds)]
+        if lastTime <= firstTime:
+            return 0.0
+        return (lastTotal - firstTotal) / (lastTime - firstTime)
+
+    def rates(self):
+        return dict([('%ds' % seconds, self.rate(seconds)) for seconds in self.windows])
+
+
+class KNStatsCollector(object):
+    """Samples the stats of every object of every channel of a :class:`knive.Knive`"""
+
+    def __init__(self, knive, interval=1):
+        self.knive = knive
+        self.interval = interval
+        self.meters = {}
+        """(node path, counter) mapped to :class:`KNRateMeter`"""
+        self._loop = task.LoopingCall(self.sample)
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self.interval)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def walk(self, channel):
+        """Return (path, object) for every object in the graph of channel, starting at its source"""
+        nodes = []
+        root = channel
+        while getattr(root, 'inlet', None) is not None:
+            root = root.inlet
+
+        def _walk(node, path):
+            path = "%s/%s" % (path, node.name) if path else str(node.name)
+            nodes.append((path, node))
+            if IKNInlet.providedBy(node):
+                for outlet in node.outlets:
+                    _walk(outlet, path)
+        _walk(root, '')
+        return nodes
+
+    def sample(self):
+        """Feed the counters of every object to its rate meters"""
+        now = time.time()
+        for channel in self.knive.channels:
+            for path, node in self.walk(channel):
+                stats = node.getStats()
+                for counter in RATE_COUNTERS:
+                    if counter in stats:
+                        key = (channel.slug, path, counter)
+                        meter = self.meters.get(key)
+                        if meter is None:
+                            meter = self.meters[key] = KNRateMeter()
+                        meter.sample(now, stats[counter])
+
+    def getStats(self):
+        """Return a dictionary with the stats of every object per channel, the totals of every channel
+        and the stats of the disk I/O pool"""
+        channels = {}
+        for channel in self.knive.channels:
+            nodes = []
+            for path, node in self.walk(channel):
+                stats = node.getStats()
+                stats['path'] = path
+                for counter in RATE_COUNTERS:
+                    meter = self.meters.get((channel.slug, path, counter))
+                    if meter is not None:
+                        for window, rate in meter.rates().items():
+                            stats['%sRate%s' % (counter, window)] = rate
+                nodes.append(stats)
+            source = nodes[0]
+            channels[channel.slug] = {
+                'name': channel.name,
+                'running': bool(channel.running),
+                'bytesIn': source.get('bytesOut', 0),
+                'bytesInRate10s': source.get('bytesOutRate10s', 0.0),
+                'segments': sum([stats.get('segments', 0) for stats in nodes]),
+                'processRestarts': sum([stats.get('processRestarts', 0) for stats in nodes]),
+                'queuedBytes': sum([stats.get('queuedBytes', 0) for stats in nodes]),
+                'droppedBytes': sum([stats.get('droppedBytes', 0) for stats in nodes]),
+                'nodes': nodes,
+            }
+        return {'time': time.time(), 'channels': channels, 'diskio': diskio.getPool().getStats()}
+
+
+_reWords = re.compile('([a-z0-9])([A-Z])')
+
+
+def metricName(key):
+    """bytesInRate10s -> bytes_in_rate10s"""
+    return _reWords.sub(r'\1_\2', key).lower()
+
+
+def _labels(labels):
+    return ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels])
+
+
+def _isNumber(value):
+    return type(value) in (int, long, float, bool)
+
+
+def renderPrometheus(stats):
+    """Render the result of :meth:`KNStatsCollector.getStats` in the Prometheus text format"""
+    samples = {}
+
+    def _add(name, labels, value):
+        if labels:
+            name = '%s{%s}' % (name, _labels(labels))
+        samples.setdefault(name.split('{')[0], []).append('%s %s' % (name, repr(float(value))))
+
+    for slug, channel in sorted(stats['channels'].items()):
+        for key, value in sorted(channel.items()):
+            if _isNumber(value):
+                _add('knive_channel_' + metricName(key), [('channel', slug)], value)
+        for node in channel['nodes']:
+            labels = [('channel', slug), ('node', node['path']), ('class', node['class'])]
+            for key, value in sorted(node.items()):
+                if _isNumber(value):
+                    _add('knive_node_' + metricName(key), labels, value)
+
+    pool = stats['diskio']
+    _add('knive_diskio_pending', [], pool['pending'])
+    _add('knive_diskio_threads', [], pool['threads'])
+    for opName, operation in sorted(pool['operations'].items()):
+        for key, value in sorted(operation.items()):
+            _add('knive_diskio_' + metricName(key), [('op', opName)], value)
+
+    lines = []
+    for name in sorted(samples):
+        lines.append('# TYPE %s untyped' % name)
+        lines.extend(samples[name])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,198 @@
+#
+# supervisor.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Keep the external process of a stream object (ffmpeg, live_segmenter) running.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from twisted.internet import reactor
+
+import logging
+import time
+
+
+class KNProcessSupervisor(object):
+    """Spawns the process of owner and restarts it when it ends while owner is running.
+
+    owner spawns a process with ``owner.spawnProcess(protocol)``. It is told about a
+    restart with ``owner.processRestarted()`` and about a crash with ``owner.processCrashed()``
+    (both optional).
+
+    Restarts are delayed by minDelay seconds, doubling with every crash up to maxDelay. The
+    delay is reset once a process ran for resetAfter seconds.
+
+    With standby, a second process is spawned and left waiting for input. When the active
+    process dies the standby takes over right away (no exec, no loading of libraries) and a
+    new standby is spawned after the backoff delay.
+    """
+
+    minDelay = 0.5
+    maxDelay = 30.0
+    resetAfter = 60.0
+
+    def __init__(self, owner, protocolClass, standby=False):
+        self.owner = owner
+        self.protocolClass = protocolClass
+        self.useStandby = standby
+        self.log = logging.getLogger('[%s] %s' % (self.__class__.__name__, getattr(owner, 'name', owner)))
+
+        self.active = self._newProtocol()
+        """The protocol of the process we feed. Exists (unspawned) before :meth:`start`."""
+        self.standby = None
+        """The protocol of the waiting standby process or None"""
+
+        self.running = False
+        self.starts = 0
+        self.crashes = 0
+        self.restarts = 0
+        self.failovers = 0
+        """Restarts served by the standby"""
+        self.delay = self.minDelay
+        """Delay of the next restart"""
+        self._activeSince = None
+        self._restartCall = None
+        self._standbyCall = None
+        self._shutdownTrigger = None
+
+    def _newProtocol(self):
+        protocol = self.protocolClass()
+        protocol.factory = self.owner
+        protocol.supervisor = self
+        return protocol
+
+    def _spawn(self, standby=False):
+        protocol = self._newProtocol()
+        protocol.standby = standby
+        self.starts += 1
+        self.owner.spawnProcess(protocol)
+        return protocol
+
+    def start(self):
+        """Spawn the process (and the standby)"""
+        self.running = True
+        if self._shutdownTrigger is None:
+            # Processes end when the reactor stops. That's no reason to restart them.
+            self._shutdownTrigger = reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        self.active = self._spawn()
+        self._activeSince = time.time()
+        if self.useStandby:
+            self.standby = self._spawn(standby=True)
+
+    def stop(self):
+        """The owner stops. Close STDIN of the active process, it finishes what it has. Kill the standby."""
+        self.running = False
+        if self._shutdownTrigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            except (ValueError, KeyError):
+                pass
+            self._shutdownTrigger = None
+        for call in (self._restartCall, self._standbyCall):
+            if call is not None and call.active():
+                call.cancel()
+        self._restartCall = self._standbyCall = None
+        if self.standby is not None:
+            self._kill(self.standby)
+            self.standby = None
+        transport = self.active.transport
+        if transport is not None and transport.pid is not None:
+            transport.closeStdin()
+
+    def _kill(self, protocol):
+        transport = protocol.transport
+        if transport is not None and transport.pid is not None:
+            try:
+                transport.signalProcess('KILL')
+            except Exception, err:
+                self.log.debug('Could not kill process: %s' % err)
+
+    def processEnded(self, protocol, reason):
+        """Called by the protocol of every process we spawned"""
+        if not self.running:
+            return
+        if protocol is self.standby:
+            self.log.warn('Standby process ended: %s' % reason.value)
+            self.standby = None
+            self._scheduleStandby()
+            return
+        if protocol is not self.active:
+            return
+
+        if reason.value.exitCode or reason.value.signal is not None:
+            self.crashes += 1
+            if hasattr(self.owner, 'processCrashed'):
+                self.owner.processCrashed()
+        if self._activeSince is not None and time.time() - self._activeSince >= self.resetAfter:
+            self.delay = self.minDelay
+
+        if self.standby is not None and self.standby.transport is not None and self.standby.transport.pid is not None:
+            self.log.warn('Process ended (%s). Standby takes over.' % reason.value)
+            self.active = self.standby
+            self.standby = None
+            self.active.activate()
+            self.failovers += 1
+            self._restarted()
+            self._scheduleStandby()
+        else:
+            self.log.warn('Process ended (%s). Restarting in %.1f seconds.' % (reason.value, self.delay))
+            self._restartCall = reactor.callLater(self.delay, self._restart)
+            self._backoff()
+
+    def _backoff(self):
+        self.delay = min(self.delay * 2, self.maxDelay)
+
+    def _restart(self):
+        self._restartCall = None
+        if not self.running:
+            return
+        self.active = self._spawn()
+        self._restarted()
+        if self.useStandby and self.standby is None and self._standbyCall is None:
+            self._scheduleStandby()
+
+    def _restarted(self):
+        self.restarts += 1
+        self._activeSince = time.time()
+        if hasattr(self.owner, 'processRestarted'):
+            self.owner.processRestarted()
+
+    def _scheduleStandby(self):
+        if not self.useStandby or self._standbyCall is not None:
+            return
+        self._standbyCall = reactor.callLater(self.delay, self._spawnStandby)
+        self._backoff()
+
+    def _spawnStandby(self):
+        self._standbyCall = None
+        if self.running and self.standby is None:
+            self.standby = self._spawn(standby=True)
+
+    def getStats(self):
+        return {
+            'processStarts': self.starts,
+            'processRestarts': self.restarts,
+            'processCrashes': self.crashes,
+            'processFailovers': self.failovers,
+            'processStandby': self.standby is not None,
+            'processRestartDelay': self.delay,
+        }
@@ -20,7 +20,8 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
-from foundation import KNOutlet, KNInlet
+from foundation import KNOutlet, KNInlet, TS_PACKET_SIZE
+from mpegts     import TSParser, SYNC_BYTE
 
 from twisted.internet.protocol      import ReconnectingClientFactory, ServerFactory
 from twisted.protocols              import basic
@@ -30,9 +31,69 @@ from twisted.python                 import log
 from twisted.internet               import reactor
 from twisted.internet.interfaces    import ILoggingContext
 from twisted.internet.defer         import Deferred 
+from twisted.internet               import task
+
+from stats      import KNRateMeter
+
+from collections import deque
 
 import hashlib
+import mmap
+import os
 import random
+import struct
+import time
+
+FRAME_HEADER = struct.Struct('!cQdI')
+"""TCPTS 0.2 frame header: type ('D' data, 'A' ack), sequence number, send time (seconds since epoch), payload length"""
+FRAME_DATA = 'D'
+FRAME_ACK = 'A'
+
+
+class TCPTSFrameReader(object):
+    """Mixin for protocols speaking TCPTS 0.2. Feed raw data to :meth:`framedDataReceived`.
+    :meth:`frameReceived` is called for every complete frame. Partial frames are only joined
+    once they are complete."""
+
+    _pending = None
+    _pendingBytes = 0
+    _needed = FRAME_HEADER.size
+
+    def framedDataReceived(self,data):
+        if self._pending is None:
+            self._pending = []
+        self._pending.append(data)
+        self._pendingBytes += len(data)
+        if self._pendingBytes < self._needed:
+            return
+        if len(self._pending) == 1:
+            data = self._pending[0]
+        else:
+            data = ''.join(self._pending)
+        length = len(data)
+        offset = 0
+        needed = FRAME_HEADER.size
+        while length - offset >= FRAME_HEADER.size:
+            kind, seq, timestamp, payloadLength = FRAME_HEADER.unpack_from(data,offset)
+            needed = FRAME_HEADER.size + payloadLength
+            if length - offset < needed:
+                break
+            start = offset + FRAME_HEADER.size
+            offset += needed
+            needed = FRAME_HEADER.size
+            self.frameReceived(kind,seq,timestamp,data[start:offset])
+        if offset < length:
+            self._pending = [data[offset:]]
+        else:
+            self._pending = []
+        self._pendingBytes = length - offset
+        self._needed = needed
+
+    def sendFrame(self,kind,seq,timestamp,payload=''):
+        self.transport.writeSequence([FRAME_HEADER.pack(kind,seq,timestamp,len(payload)),payload])
+
+    def frameReceived(self,kind,seq,timestamp,payload):
+        raise(NotImplementedError)
 
 class TCPTSClientFactory(ReconnectingClientFactory):
     """docstring for TCPTransportFactory"""
@@ -40,6 +101,37 @@ class TCPTSClientFactory(ReconnectingClientFactory):
     initialDelay = .1
     secret = None
     maxDelay = 8
+    protocol = None
+
+    protocolVersion = '0.2'
+    """Falls back to '0.1' if the server doesn't know 0.2"""
+    maxUnackedBytes = 16777216
+    """Frames sent but not acknowledged by the server are kept for a resend after a reconnect"""
+
+    def __init__(self):
+        self.sessionId = hashlib.sha1('%s%s' % (random.random(),time.time())).hexdigest()[:16]
+        """Identifies us to the server across reconnects"""
+        self.sequence = 0
+        """Sequence number of the last frame sent"""
+        self.unacked = deque()
+        """(sequence, timestamp, payload) of frames not acknowledged yet"""
+        self.unackedBytes = 0
+        self.lostFrames = 0
+        """Frames dropped from unacked before the server acknowledged them"""
+        self.resentFrames = 0
+
+    def frameSent(self,seq,timestamp,payload):
+        self.unacked.append((seq,timestamp,payload))
+        self.unackedBytes += len(payload)
+        while self.unackedBytes > self.maxUnackedBytes:
+            self.unackedBytes -= len(self.unacked.popleft()[2])
+            self.lostFrames += 1
+
+    def acknowledged(self,seq):
+        """The server has everything up to seq"""
+        unacked = self.unacked
+        while unacked and unacked[0][0] <= seq:
+            self.unackedBytes -= len(unacked.popleft()[2])
 
     def clientConnectionFailed(self, connector, reason):
         log.err('connection failed: %s' % reason)
@@ -60,17 +152,197 @@ class TCPTSClientFactory(ReconnectingClientFactory):
         self.protocol.factory = self
         return self.protocol
 
+    @property
+    def ready(self):
+        """True if we are connected and authenticated"""
+        return self.protocol is not None and self.protocol.connectionEstablished and self.protocol.state == 99
+
     def sendData(self,data):
         if self.protocol.connectionEstablished:
             self.protocol.sendData(data)
                 
         
+class TCPTSSpillRing(object):
+    """A ring buffer in a memory mapped file. If it is full the oldest whole TS packets are dropped.
+    The rest of a packet that was read in part already is kept, so no packet is torn."""
+
+    def __init__(self,filename,size):
+        self.filename = filename
+        self.size = size - size % TS_PACKET_SIZE
+        self._file = open(filename,'w+b')
+        self._file.truncate(self.size)
+        self._map = mmap.mmap(self._file.fileno(),self.size)
+        self.head = 0
+        self.used = 0
+        self.headPhase = 0
+        """Position of the oldest byte in its TS packet"""
+        self.droppedBytes = 0
+
+    def _get(self,pos,length):
+        pos %= self.size
+        first = min(length,self.size - pos)
+        data = self._map[pos:pos + first]
+        if first < length:
+            data += self._map[0:length - first]
+        return data
+
+    def _put(self,pos,data):
+        pos %= self.size
+        length = len(data)
+        first = min(length,self.size - pos)
+        self._map[pos:pos + first] = data[:first]
+        if first < length:
+            self._map[0:length - first] = data[first:]
+
+    def write(self,data,phase=0):
+        """Append data. phase is the position of data[0] in its TS packet."""
+        if not self.used:
+            self.headPhase = phase
+        overflow = self.used + len(data) - self.size
+        if overflow > 0:
+            # Drop whole packets behind the rest of the packet that is read in part.
+            # Positions count from the head, data follows what we hold.
+            keep = -self.headPhase % TS_PACKET_SIZE
+            drop = overflow + -overflow % TS_PACKET_SIZE
+            self.droppedBytes += drop
+            if keep + drop <= self.used:
+                self._put(self.head + drop,self._get(self.head,keep))
+                self.head = (self.head + drop) % self.size
+                self.used -= drop
+            elif keep >= self.used:
+                data = data[:keep - self.used] + data[keep + drop - self.used:]
+            else:
+                data = data[keep + drop - self.used:]
+                self.used = keep
+        self._put(self.head + self.used,data)
+        self.used += len(data)
+
+    def read(self,maxBytes):
+        length = min(maxBytes,self.used)
+        data = self._get(self.head,length)
+        self.head = (self.head + length) % self.size
+        self.used -= length
+        self.headPhase = (self.headPhase + length) % TS_PACKET_SIZE
+        return data
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        os.remove(self.filename)
+
+
+class TCPTSBacklog(object):
+    """Outbound data that could not be sent yet. Oldest data first.
+
+    New data is kept in memory. When more than memoryBytes are kept, the oldest data moves
+    to the spill ring (if there is one) or whole TS packets of it are dropped, like
+    :meth:`foundation.KNEdge._dropPackets` does.
+    """
+
+    def __init__(self,memoryBytes=33554432,spillFile=None,spillBytes=268435456):
+        self.memoryBytes = memoryBytes
+        self.memory = deque()
+        self.memoryUsed = 0
+        self.spill = None
+        if spillFile:
+            self.spill = TCPTSSpillRing(spillFile,spillBytes)
+        self.droppedBytes = 0
+        self.drainedBytes = 0
+        self._alignment = 0
+        """Bytes of the stream passed to us (appended or bypassed) modulo TS_PACKET_SIZE"""
+
+    def __len__(self):
+        if self.spill is not None:
+            return self.memoryUsed + self.spill.used
+        return self.memoryUsed
+
+    def bypass(self,length):
+        """length bytes of the stream were sent without going through the backlog"""
+        self._alignment = (self._alignment + length) % TS_PACKET_SIZE
+
+    def append(self,data):
+        self.memory.append(data)
+        self.memoryUsed += len(data)
+        self._alignment = (self._alignment + len(data)) % TS_PACKET_SIZE
+        if self.spill is None:
+            if self.memoryUsed > self.memoryBytes:
+                self._dropPackets(self.memoryUsed - self.memoryBytes)
+            return
+        while self.memoryUsed > self.memoryBytes:
+            phase = (self._alignment - self.memoryUsed) % TS_PACKET_SIZE
+            old = self.memory.popleft()
+            self.memoryUsed -= len(old)
+            self.spill.write(old,phase)
+
+    def _dropPackets(self,excess):
+        """Drop whole TS packets (at least excess bytes if there are enough) from the oldest data in memory.
+        The rest of a packet that was read in part already and the newest partial packet are kept."""
+        keep = (self.memoryUsed - self._alignment) % TS_PACKET_SIZE
+        drop = min(excess + -excess % TS_PACKET_SIZE,self.memoryUsed - keep - self._alignment)
+        if drop <= 0:
+            return
+        head = self._take(keep)
+        self._take(drop)
+        if head:
+            self.memory.appendleft(head)
+            self.memoryUsed += len(head)
+        self.droppedBytes += drop
+
+    def _take(self,length):
+        """Remove and return the oldest length bytes in memory"""
+        pieces = []
+        while length > 0:
+            data = self.memory.popleft()
+            if len(data) > length:
+                self.memory.appendleft(data[length:])
+                data = data[:length]
+            pieces.append(data)
+            length -= len(data)
+            self.memoryUsed -= len(data)
+        return ''.join(pieces)
+
+    def read(self,maxBytes):
+        """Return up to maxBytes of the oldest data"""
+        if self.spill is not None and self.spill.used:
+            data = self.spill.read(maxBytes)
+        elif self.memory:
+            data = self.memory.popleft()
+            if len(data) > maxBytes:
+                self.memory.appendleft(data[maxBytes:])
+                data = data[:maxBytes]
+            self.memoryUsed -= len(data)
+        else:
+            data = ''
+        self.drainedBytes += len(data)
+        return data
+
+    def getStats(self):
+        stats = {
+            'backlogBytes': len(self),
+            'memoryBytes': self.memoryUsed,
+            'memoryLimit': self.memoryBytes,
+            'drainedBytes': self.drainedBytes,
+            'droppedBytes': self.droppedBytes,
+        }
+        if self.spill is not None:
+            stats['spillBytes'] = self.spill.used
+            stats['spillLimit'] = self.spill.size
+            stats['droppedBytes'] += self.spill.droppedBytes
+        return stats
+
+
 class TCPTSClient(KNOutlet):
-    """Connect to a simple TCP Server accepting Mpeg-TS Data after a simple handshake auth"""
+    """Connect to a simple TCP Server accepting Mpeg-TS Data after a simple handshake auth
+
+    While the link is down (or the backlog is not empty) data goes to a :class:`TCPTSBacklog`.
+    After a reconnect the backlog is sent at drainFactor times the rate we receive data at
+    (at least minDrainRate bytes/s) until we caught up.
+    """
     implements(ILoggingContext)
+
+    drainInterval = 0.1
     
-    
-    def __init__(self, hostname,port,secret='12345'):
+    def __init__(self, hostname,port,secret='12345',backlogMemoryBytes=33554432,spillFile=None,spillBytes=268435456,drainFactor=2.0,minDrainRate=125000):
         super(TCPTSClient,self).__init__(name="%s:%s" % (hostname,port))
         self.hostname = hostname
         self.port = port
@@ -78,6 +350,14 @@ class TCPTSClient(KNOutlet):
         self.factory.service = self
         self.factory.secret = secret
         self.connection = internet.TCPClient(self.hostname, self.port, self.factory)
+
+        self.backlog = TCPTSBacklog(memoryBytes=backlogMemoryBytes,spillFile=spillFile,spillBytes=spillBytes)
+        self.drainFactor = drainFactor
+        self.minDrainRate = minDrainRate
+        self.bytesReceived = 0
+        self._inputRate = KNRateMeter()
+        self._lastSample = 0
+        self._drainLoop = task.LoopingCall(self._drain)
         
     def logPrefix(self):
         """docstring for logPrefix"""
@@ -86,6 +366,7 @@ class TCPTSClient(KNOutlet):
     def _start(self):
         """docstring for startService"""
         self.connection.startService()
+        self._drainLoop.start(self.drainInterval)
         defer = Deferred()
         
         def _checkRunning():
@@ -105,10 +386,52 @@ class TCPTSClient(KNOutlet):
                 
         _checkRunning()
         return defer
+
+    def stop(self):
+        if self._drainLoop.running:
+            self._drainLoop.stop()
+        self.connection.stopService()
+        if self.backlog.spill is not None:
+            self.backlog.spill.close()
+            self.backlog.spill = None
+        super(TCPTSClient,self).stop()
                 
     def dataReceived(self,data):
-        """docstring for dataReceived"""
-        self.factory.sendData(data)
+        """Send data or keep it in the backlog if the link is down or we are still catching up"""
+        self.bytesReceived += len(data)
+        if not len(self.backlog) and self.factory.ready:
+            self.backlog.bypass(len(data))
+            self.factory.sendData(data)
+        else:
+            self.backlog.append(data)
+
+    def _drain(self):
+        """Send a share of the backlog. Runs every drainInterval seconds."""
+        now = time.time()
+        if now - self._lastSample >= 1:
+            self._inputRate.sample(now,self.bytesReceived)
+            self._lastSample = now
+        if not len(self.backlog) or not self.factory.ready:
+            return
+        budget = int(max(self.drainFactor * self._inputRate.rate(10),self.minDrainRate) * self.drainInterval)
+        while budget > 0 and len(self.backlog):
+            data = self.backlog.read(budget)
+            budget -= len(data)
+            self.factory.sendData(data)
+
+    def getStats(self):
+        stats = super(TCPTSClient,self).getStats()
+        stats.update(self.backlog.getStats())
+        stats['connected'] = self.factory.ready
+        stats['inputRate'] = self._inputRate.rate(10)
+        stats['drainRate'] = max(self.drainFactor * stats['inputRate'],self.minDrainRate)
+        if len(self.backlog):
+            # Seconds until we caught up
+            stats['drainETA'] = len(self.backlog) / max(stats['drainRate'] - stats['inputRate'],1.0)
+        stats['unackedBytes'] = self.factory.unackedBytes
+        stats['lostFrames'] = self.factory.lostFrames
+        stats['resentFrames'] = self.factory.resentFrames
+        return stats
         
     def connectionFailed(self):
         """docstring for connectionFailed"""
@@ -118,10 +441,12 @@ class TCPTSClient(KNOutlet):
         """docstring for __str__"""
         return "%s ->%s:%s" % (self.__class__.__name__,self.hostname,self.port)
 
-class TCPTSClientProtocol(basic.LineReceiver):
+class TCPTSClientProtocol(basic.LineReceiver,TCPTSFrameReader):
     """docstring for TCPTSClientProtocol"""
+    state = 0
     challenge = None
     connectionEstablished = False
+    version = '0.1'
     
     def connectionMade(self):
         self.state = 0
@@ -132,7 +457,14 @@ class TCPTSClientProtocol(basic.LineReceiver):
     def sendData(self,data):
         """Sending of payload data after the connection is established and handshake is ready"""
         if self.state == 99:
-            self.transport.write(data)
+            if self.version == '0.1':
+                self.transport.write(data)
+            else:
+                factory = self.factory
+                factory.sequence += 1
+                timestamp = time.time()
+                self.sendFrame(FRAME_DATA,factory.sequence,timestamp,data)
+                factory.frameSent(factory.sequence,timestamp,data)
     
     def lineReceived(self,line):
         """docstring for lineReceived"""
@@ -146,18 +478,50 @@ class TCPTSClientProtocol(basic.LineReceiver):
         elif self.state == 1:
             log.msg("Secret: %s" % self.factory.secret)
             log.msg("Sending challenge reply: %s - %s - %s" % (line,self.factory.secret,hashlib.sha224(line + self.factory.secret).hexdigest()))
-            self.sendLine(hashlib.sha224(line + self.factory.secret).hexdigest())
+            reply = hashlib.sha224(line + self.factory.secret).hexdigest()
+            if self.factory.protocolVersion == '0.2':
+                # Servers knowing 0.2 answer 'Authenticated 0.2 <last sequence received>'
+                reply = '%s 0.2 %s' % (reply,self.factory.sessionId)
+            self.sendLine(reply)
             self.state = 2
         elif self.state == 2:
             if line == 'Authenticated':
                 log.msg("Autenticated")
                 self.state = 99
+            elif line.startswith('Authenticated 0.2 '):
+                log.msg("Autenticated (TCPTS 0.2)")
+                self.version = '0.2'
+                self.state = 99
+                self.setRawMode()
+                self.resume(int(line.split()[2]))
+            elif line != 'Wrong secret' and self.factory.protocolVersion == '0.2':
+                # Servers that only know 0.1 don't accept the appended fields ('Wrong reply!')
+                log.err("Server refused TCPTS 0.2. Reconnecting with 0.1")
+                self.factory.protocolVersion = '0.1'
+                self.transport.loseConnection()
             else:
                 log.err("Authentication not succesfull. Check secret on client/server")
                 reactor.stop()
         else:
             log.err("Unknown data received from server")
             self.transport.loseConnection()
+
+    def resume(self,seq):
+        """The server has everything up to seq. Send what it is missing."""
+        factory = self.factory
+        factory.acknowledged(seq)
+        for frameSeq, timestamp, payload in factory.unacked:
+            self.sendFrame(FRAME_DATA,frameSeq,timestamp,payload)
+            factory.resentFrames += 1
+        if factory.unacked:
+            log.msg("Resent %d frames from sequence %d" % (len(factory.unacked),factory.unacked[0][0]))
+
+    def rawDataReceived(self,data):
+        self.framedDataReceived(data)
+
+    def frameReceived(self,kind,seq,timestamp,payload):
+        if kind == FRAME_ACK:
+            self.factory.acknowledged(seq)
     
     def protocolMissmatch(self):
         """docstring for protocolMissmatch"""
@@ -165,14 +529,25 @@ class TCPTSClientProtocol(basic.LineReceiver):
         self.transport.loseConnection()
 
 
-class TCPTSServerProtocol(basic.LineReceiver):
-    """docstring for TCPTSServerProtocol"""
+class TCPTSServerProtocol(basic.LineReceiver,TCPTSFrameReader):
+    """docstring for TCPTSServerProtocol
+
+    The greeting stays 'TCPTS 0.1'. A client speaking 0.2 appends '0.2 <session id>' to its
+    challenge reply. Its payload is then framed (see FRAME_HEADER) and acknowledged.
+    A wrong secret is answered with 'Wrong secret'. Servers that only know 0.1 answer
+    'Wrong reply!' to both, so a 0.2 client only falls back to 0.1 on that.
+    """
     state = 0
     challenge = None        
+    session = None
+    """The :class:`TCPTSPublisherSession` of this connection once it is authenticated"""
+    version = '0.1'
+    sessionId = None
     
     def connectionMade(self):
         self.state = 0
         self.challenge = None
+        self.factory.protocols.append(self)
         self.sendLine('TCPTS 0.1')
         self.sendLine(self.createChallenge())
         self.state = 1
@@ -191,15 +566,25 @@ class TCPTSServerProtocol(basic.LineReceiver):
     def lineReceived(self,line):
         """docstring for lineReceived"""
         if self.state == 1:
-            if self.challengeAccepted(line):
+            fields = line.split()
+            if fields and self.challengeAccepted(fields[0]):
                 self.state = 2
                 log.msg("Handshake okay")
-                self.sendLine('Authenticated')
+                lastSeq = 0
+                if len(fields) == 3 and fields[1] == '0.2':
+                    self.version = '0.2'
+                    self.sessionId = fields[2]
+                    lastSeq = self.factory.service.resumeSequences.get(self.sessionId,0)
+                    self.sendLine('Authenticated 0.2 %d' % lastSeq)
+                else:
+                    self.sendLine('Authenticated')
                 self.state = 99
+                self.session = self.factory.service.publisherAuthenticated(self)
+                self.session.lastSeq = lastSeq
                 self.setRawMode()
             else:
                 log.err("Handshake not sucesfull. Check the secret(s) on client and server. They have to match")
-                self.sendLine('Wrong reply!')
+                self.sendLine('Wrong secret')
                 self.transport.loseConnection()
         else:
             log.err("Didn't expect data. Closing connection")
@@ -207,12 +592,177 @@ class TCPTSServerProtocol(basic.LineReceiver):
             
     def rawDataReceived(self,data):
         """handle the mpeg-ts data"""
-        self.factory.service.dataReceived(data)
+        if self.version == '0.1':
+            self.factory.service.publisherDataReceived(self.session,data)
+            return
+        lastSeq = self.session.lastSeq
+        self.framedDataReceived(data)
+        if self.session.lastSeq != lastSeq and self.state == 99:
+            # One ack for everything that arrived with this read
+            self.sendFrame(FRAME_ACK,self.session.lastSeq,time.time())
+
+    def frameReceived(self,kind,seq,timestamp,payload):
+        if kind != FRAME_DATA:
+            return
+        session = self.session
+        if seq <= session.lastSeq:
+            session.duplicateFrames += 1
+            return
+        if seq != session.lastSeq + 1:
+            session.missingFrames += seq - session.lastSeq - 1
+        session.lastSeq = seq
+        self.factory.service.resumeSequences[self.sessionId] = seq
+        session.frameReceived(timestamp)
+        self.factory.service.publisherDataReceived(session,payload)
+
+    def connectionLost(self,reason):
+        if self in self.factory.protocols:
+            self.factory.protocols.remove(self)
+        if self.session is not None:
+            self.factory.service.publisherLost(self.session)
+
+
+class TCPTSPublisherSession(object):
+    """An authenticated publisher of a :class:`TCPTSServer`.
+
+    The stream of a standby is not forwarded. It is parsed and everything since its last
+    keyframe (random access point) is kept, so it can take over at a keyframe right away.
+    """
+
+    maxBufferBytes = 8388608
+    """A GOP longer than this is not kept. The standby is not warm until the next keyframe."""
+
+    def __init__(self,protocol):
+        self.protocol = protocol
+        self.peer = str(protocol.transport.getPeer())
+        self.connectedSince = time.time()
+        self.lastDataTime = self.connectedSince
+        self.bytesReceived = 0
+        self.parser = TSParser()
+        self.gop = []
+        """Whole packets since the last keyframe"""
+        self.gopBytes = 0
+        self._inGop = False
+        self._remainder = ''
+
+        # TCPTS 0.2
+        self.sessionId = protocol.sessionId
+        self.lastSeq = 0
+        """Sequence number of the last frame received"""
+        self.frames = 0
+        self.duplicateFrames = 0
+        self.missingFrames = 0
+        self.latency = None
+        """Smoothed one way latency in seconds (includes the clock offset between publisher and us)"""
+        self.latencyMax = None
+        self.jitter = 0.0
+        """Interarrival jitter (RFC 3550) in seconds"""
+        self._lastTransit = None
+
+    def frameReceived(self,timestamp):
+        """A frame sent at timestamp (publisher clock) arrived"""
+        transit = time.time() - timestamp
+        self.frames += 1
+        if self._lastTransit is None:
+            self.latency = self.latencyMax = transit
+        else:
+            self.jitter += (abs(transit - self._lastTransit) - self.jitter) / 16
+            self.latency += (transit - self.latency) / 16
+            if transit > self.latencyMax:
+                self.latencyMax = transit
+        self._lastTransit = transit
+
+    @property
+    def warm(self):
+        """True if we can take over at a keyframe"""
+        return self._inGop and self.parser.ready
+
+    def bufferData(self,data):
+        """Keep data if it belongs to the GOP that started with the last keyframe"""
+        if self._remainder:
+            data = self._remainder + data
+            self._remainder = ''
+        parser = self.parser
+        length = len(data)
+        offset = 0
+        runStart = 0
+        while offset + TS_PACKET_SIZE <= length:
+            if data[offset] != SYNC_BYTE:
+                self._keep(data[runStart:offset])
+                offset = data.find(SYNC_BYTE,offset + 1)
+                if offset == -1:
+                    return
+                runStart = offset
+                continue
+            pid = parser.parsePacket(data,offset)
+            if parser.keyframe and pid == parser.cutPid:
+                # A new GOP. Forget the old one.
+                self.gop = []
+                self.gopBytes = 0
+                self._inGop = True
+                runStart = offset
+            offset += TS_PACKET_SIZE
+        self._keep(data[runStart:offset])
+        if offset < length:
+            self._remainder = data[offset:]
+
+    def _keep(self,data):
+        if data and self._inGop:
+            self.gop.append(data)
+            self.gopBytes += len(data)
+            if self.gopBytes > self.maxBufferBytes:
+                self.gop = []
+                self.gopBytes = 0
+                self._inGop = False
+
+    def takeBuffer(self):
+        """Return PAT, PMT and the buffered GOP followed by a partial packet we still hold. Empties the buffer."""
+        data = self.parser.patPacket + self.parser.pmtPacket + ''.join(self.gop) + self._remainder
+        self.gop = []
+        self.gopBytes = 0
+        self._inGop = False
+        self._remainder = ''
+        return data
+
+    def getStats(self):
+        stats = {
+            'peer': self.peer,
+            'version': self.protocol.version,
+            'connectedSince': self.connectedSince,
+            'lastDataTime': self.lastDataTime,
+            'bytesReceived': self.bytesReceived,
+            'warm': self.warm,
+            'gopBytes': self.gopBytes,
+        }
+        if self.sessionId is not None:
+            stats.update({
+                'sessionId': self.sessionId,
+                'lastSeq': self.lastSeq,
+                'frames': self.frames,
+                'duplicateFrames': self.duplicateFrames,
+                'missingFrames': self.missingFrames,
+                'latency': self.latency,
+                'latencyMax': self.latencyMax,
+                'jitter': self.jitter,
+            })
+        return stats
 
 class TCPTSServer(KNInlet):
-    """Create a simple TCP Server accepting Mpeg-TS Data after a handshake auth"""
+    """Create a simple TCP Server accepting Mpeg-TS Data after a handshake auth
+
+    Only one publisher, the primary, is forwarded. Publishers connecting while there is a
+    primary become standbys, ranked by the time they connected. The stream of a standby is
+    kept warm (see :class:`TCPTSPublisherSession`). If the primary disconnects or sends
+    nothing for failoverTimeout seconds the first warm standby takes over at its last keyframe.
+    A stalled primary becomes the last standby. The outlets keep running.
+    """
 
-    def __init__(self, name='Unknown',hostname="0.0.0.0",port=3333,secret='123467'):
+    failoverTimeout = 2.0
+    """Seconds without data from the primary before we switch to a standby"""
+    resumeTimeout = 60.0
+    """Seconds a TCPTS 0.2 publisher can reconnect and resume its session after it disconnected"""
+
+    def __init__(self, name='Unknown',hostname="0.0.0.0",port=3333,secret='123467',failoverTimeout=None,resumeTimeout=None):
         super(TCPTSServer, self).__init__(name=name)
         self.hostname = hostname
         self.port = port
@@ -220,6 +770,24 @@ class TCPTSServer(KNInlet):
         self.factory = TCPTSServerFactory(secret)
         self.factory.service = self
         self.connection = internet.TCPServer(self.port, self.factory)
+        self.paused = False
+
+        if failoverTimeout is not None:
+            self.failoverTimeout = failoverTimeout
+        if resumeTimeout is not None:
+            self.resumeTimeout = resumeTimeout
+        self.primary = None
+        """The :class:`TCPTSPublisherSession` we forward"""
+        self.standbys = []
+        """Ranked :class:`TCPTSPublisherSession` objects"""
+        self.failovers = 0
+        self.resumeSequences = {}
+        """TCPTS 0.2 session ids mapped to the sequence number of the last frame received"""
+        self._lostSessions = {}
+        """Session ids of disconnected TCPTS 0.2 publishers mapped to the time they disconnected"""
+        self._primarySessionId = None
+        """Session id of the last primary (None for TCPTS 0.1)"""
+        self._watchdog = task.LoopingCall(self._checkPrimary)
 
     def connectionFailed(self):
         self.log.err('Connection failed. Can not continue.')
@@ -231,15 +799,131 @@ class TCPTSServer(KNInlet):
 
     def _start(self):
         self.connection.startService()
+        self._watchdog.start(self.failoverTimeout / 4, now=False)
 
     def _willStop(self):
         """Stuff to be done before outlets get the stop command"""
+        if self._watchdog.running:
+            self._watchdog.stop()
         self.connection.stopService()
 
     def dataReceived(self,data):
         """The protocol writes data to this method. Overwrite it and do something meaningfull with it"""
         self.sendDataToAllOutlets(data)
 
+    # Publishers
+
+    def publisherAuthenticated(self,protocol):
+        """A publisher passed the handshake. Returns its session."""
+        session = TCPTSPublisherSession(protocol)
+        if session.sessionId is not None:
+            self._lostSessions.pop(session.sessionId,None)
+            # A publisher resuming its session takes the place of its old connection
+            for old in [self.primary] + self.standbys:
+                if old is not None and old.sessionId == session.sessionId:
+                    self.log.info('Publisher %s resumed session %s' % (session.peer,session.sessionId))
+                    old.protocol.session = None
+                    old.protocol.transport.loseConnection()
+                    if old is self.primary:
+                        self._setPrimary(session)
+                    else:
+                        self.standbys[self.standbys.index(old)] = session
+                    return session
+        if self.primary is None and not self.standbys:
+            self._setPrimary(session)
+        else:
+            self.standbys.append(session)
+            self.log.info('Publisher %s is standby #%d' % (session.peer,len(self.standbys)))
+        return session
+
+    def publisherDataReceived(self,session,data):
+        session.lastDataTime = time.time()
+        session.bytesReceived += len(data)
+        if session is self.primary:
+            self.dataReceived(data)
+        else:
+            session.bufferData(data)
+
+    def publisherLost(self,session):
+        if session.sessionId is not None:
+            self._lostSessions[session.sessionId] = time.time()
+        if session is self.primary:
+            self.log.warn('Primary publisher %s disconnected' % session.peer)
+            self.primary = None
+            self._failover()
+        elif session in self.standbys:
+            self.standbys.remove(session)
+            self.log.info('Standby publisher %s disconnected' % session.peer)
+
+    def _setPrimary(self,session):
+        if self.bytesOut and (session.sessionId is None or session.sessionId != self._primarySessionId):
+            # Not a resume of the stream we forwarded. Different timestamps and continuity counters from here.
+            self.streamDiscontinuity()
+        self._primarySessionId = session.sessionId
+        self.primary = session
+        session.lastDataTime = time.time()
+        self.log.info('Publisher %s is primary' % session.peer)
+        if self.paused:
+            session.protocol.transport.pauseProducing()
+
+    def _checkPrimary(self):
+        """Switch to a standby if the primary stalled. A paused primary doesn't stall.
+        Forget sessions that can't be resumed any more."""
+        self._expireSessions()
+        if self.paused:
+            return
+        if self.primary is None:
+            self._failover()
+        elif time.time() - self.primary.lastDataTime > self.failoverTimeout:
+            self._failover()
+
+    def _expireSessions(self):
+        expired = time.time() - self.resumeTimeout
+        for sessionId, lost in self._lostSessions.items():
+            if lost < expired:
+                del self._lostSessions[sessionId]
+                self.resumeSequences.pop(sessionId,None)
+
+    def _failover(self):
+        """Make the first warm standby the primary. Returns True if we switched."""
+        for session in self.standbys:
+            if session.warm:
+                break
+        else:
+            return False
+        self.standbys.remove(session)
+        stalled = self.primary
+        if stalled is not None:
+            self.log.warn('Primary publisher %s stalled' % stalled.peer)
+            self.standbys.append(stalled)
+        self.failovers += 1
+        self._setPrimary(session)
+        self.dataReceived(session.takeBuffer())
+        return True
+
+    def getStats(self):
+        stats = super(TCPTSServer, self).getStats()
+        stats['publishers'] = len([protocol for protocol in self.factory.protocols if protocol.state == 99])
+        stats['standbys'] = len(self.standbys)
+        stats['warmStandbys'] = len([session for session in self.standbys if session.warm])
+        stats['failovers'] = self.failovers
+        if self.primary is not None:
+            stats['primary'] = self.primary.getStats()
+        stats['standbySessions'] = [session.getStats() for session in self.standbys]
+        return stats
+
+    def pauseProducing(self):
+        """Our outlets can not keep up. Stop reading from the primary until they drained. Standbys are still read."""
+        self.paused = True
+        if self.primary is not None:
+            self.primary.protocol.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.primary is not None:
+            self.primary.lastDataTime = time.time()
+            self.primary.protocol.transport.resumeProducing()
+
 class TCPTSServerFactory(ServerFactory):
     """docstring for TCPTSServerFactory"""
     protocol = TCPTSServerProtocol
@@ -247,5 +931,6 @@ class TCPTSServerFactory(ServerFactory):
     def __init__(self,secret):
         """docstring for __init__"""
         self.secret = secret
+        self.protocols = []
         log.msg("%s running with secret: %s" % (self,self.secret))
 
@@ -0,0 +1,303 @@
+#
+# udpts.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""MPEG-TS over UDP (unicast or multicast) as sent by most hardware encoders.
+
+Usually 7 TS packets per datagram, optionally behind an RTP header. There is no head of
+line blocking like with TCP: a lost datagram is lost and counted, the stream goes on.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from foundation import KNInlet, TS_PACKET_SIZE
+from mpegts     import SYNC_BYTE, PID_NULL
+
+from twisted.internet.protocol      import DatagramProtocol
+from twisted.application            import internet
+from twisted.internet               import reactor
+
+import socket
+
+RTP_HEADER_SIZE = 12
+
+
+def counters(data):
+    """Yield (pid, continuity counter, flags, offset) of every packet in data that carries payload"""
+    for pos in xrange(0, len(data), TS_PACKET_SIZE):
+        flags = ord(data[pos + 3])
+        if not flags & 0x10:
+            continue
+        pid = ((ord(data[pos + 1]) & 0x1f) << 8) | ord(data[pos + 2])
+        if pid != PID_NULL:
+            yield pid, flags & 0x0f, flags, pos
+
+
+class UDPTSProtocol(DatagramProtocol):
+    """Hands every datagram to its :class:`UDPTSServer`"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def startProtocol(self):
+        service = self.service
+        sock = self.transport.getHandle()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, service.receiveBuffer)
+        # Linux doubles the value and caps it at net.core.rmem_max
+        actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if actual < service.receiveBuffer:
+            service.log.warning('Receive buffer is %d bytes instead of %d. Raise net.core.rmem_max.' % (actual, service.receiveBuffer))
+        service.receiveBufferActual = actual
+        if service.multicastGroup:
+            self.transport.joinGroup(service.multicastGroup, service.hostname)
+
+    def datagramReceived(self, data, address):
+        self.service.datagramReceived(data, address)
+
+
+class UDPTSServer(KNInlet):
+    """Receive MPEG-TS datagrams on port. Join multicastGroup if it is set.
+
+    Datagrams must hold whole TS packets (an RTP header in front is stripped). They are
+    checked against the continuity counters of their PIDs:
+
+    - A datagram that continues the stream is sent on.
+    - A datagram whose counters repeat the ones last sent is a duplicate and dropped.
+    - A datagram that does not is held back for up to reorderWindow datagrams, in case the
+      missing one is just late. If it shows up, the held datagrams follow in order
+      (counted as reordered). If the window overflows, the oldest held datagram is sent
+      anyway and the gap is counted as loss.
+
+    Datagrams are collected and sent in batches of batchPackets packets or after maxDelay
+    seconds, like :class:`rechunker.TSRechunker` does.
+
+    UDP can't be paused. Our own edges always drop whole packets when an outlet can't keep up
+    (overflowPolicy 'drop'), whatever the channel is configured to do. Edges further down may
+    pause, the pause ends here.
+    """
+
+    receiveBuffer = 8388608
+    """SO_RCVBUF in bytes. At 50 Mbit/s 8 MB are more than a second."""
+
+    def __init__(self, name='UDPTSServer', hostname='0.0.0.0', port=1234, multicastGroup=None,
+                 receiveBuffer=None, reorderWindow=8, batchPackets=348, maxDelay=0.05):
+        super(UDPTSServer, self).__init__(name=name)
+        self.hostname = hostname
+        self.port = port
+        self.multicastGroup = multicastGroup
+        if receiveBuffer is not None:
+            self.receiveBuffer = receiveBuffer
+        self.receiveBufferActual = None
+        self.reorderWindow = reorderWindow
+        self.batchPackets = batchPackets
+        self.maxDelay = maxDelay
+
+        self.protocol = UDPTSProtocol(self)
+        if multicastGroup:
+            self.connection = internet.MulticastServer(self.port, self.protocol, interface=self.hostname, listenMultiple=True)
+        else:
+            self.connection = internet.UDPServer(self.port, self.protocol, interface=self.hostname)
+
+        self.datagrams = 0
+        self.bytesReceived = 0
+        self.invalidDatagrams = 0
+        """Datagrams that are not whole TS packets"""
+        self.reorderedDatagrams = 0
+        self.lateDatagrams = 0
+        """Held datagrams sent before the gap in front of them was filled"""
+        self.duplicateDatagrams = 0
+        self.lostPackets = 0
+        """Estimated from the continuity counters"""
+        self.continuityErrors = {}
+        """PIDs mapped to the number of continuity counter errors"""
+
+        self._counters = {}
+        self._held = []
+        self._batch = []
+        self._batchPackets = 0
+        self._timer = None
+
+    def setFlowControl(self, highWatermark=None, lowWatermark=None, overflowPolicy=None):
+        """See :meth:`foundation.KNInlet.setFlowControl`. Our own edges keep dropping."""
+        super(UDPTSServer, self).setFlowControl(highWatermark, lowWatermark, overflowPolicy)
+        self._dropOnOverflow()
+
+    def _dropOnOverflow(self):
+        for edge in self.edges.values():
+            edge.setFlowControl(overflowPolicy='drop')
+
+    def _start(self):
+        # Outlets added after setFlowControl
+        self._dropOnOverflow()
+        self.connection.startService()
+
+    def _willStop(self):
+        self.connection.stopService()
+        while self._held:
+            self._send(self._held.pop(0))
+        self.flush()
+
+    def pauseProducing(self):
+        """UDP can't be paused. Our edges drop what does not fit in their queues."""
+        self.log.warning('Asked to pause. UDP can not be paused. Outlets will drop data.')
+
+    def datagramReceived(self, data, address):
+        self.datagrams += 1
+        self.bytesReceived += len(data)
+        if data[0] != SYNC_BYTE and len(data) > RTP_HEADER_SIZE and ord(data[0]) & 0xc0 == 0x80:
+            # RTP version 2. Skip the header and the CSRC list.
+            data = data[RTP_HEADER_SIZE + 4 * (ord(data[0]) & 0x0f):]
+        if not data or len(data) % TS_PACKET_SIZE or data[0:len(data):TS_PACKET_SIZE] != SYNC_BYTE * (len(data) // TS_PACKET_SIZE):
+            self.invalidDatagrams += 1
+            return
+
+        if self._repeats(data):
+            self.duplicateDatagrams += 1
+            return
+        if not self._held and self._fits(data) is not None:
+            self._send(data)
+        elif self._held and self._fillsGap(data):
+            self._send(data)
+            self._sendHeld()
+        elif self.reorderWindow:
+            self._held.append(data)
+            if self._timer is None:
+                self._timer = reactor.callLater(self.maxDelay, self._timeout)
+            if len(self._held) > self.reorderWindow:
+                self._giveUp()
+        else:
+            self._send(data)
+
+    def _fits(self, data, last=None):
+        """Return the counters after data if the counters of every packet in data continue
+        last (default: what we sent), otherwise None"""
+        if last is None:
+            last = self._counters
+        after = {}
+        for pid, counter, flags, pos in counters(data):
+            previous = after.get(pid, last.get(pid))
+            # A repeated counter (allowed once for a duplicate packet) is not good enough here:
+            # it is as likely to be a datagram 16 packets ahead
+            if previous is not None and counter != (previous + 1) & 0x0f:
+                return None
+            after[pid] = counter
+        return after
+
+    def _repeats(self, data):
+        """True if data ends with the same counter on every PID as what we sent last: a duplicate"""
+        after = self._fits(data, {})
+        if not after:
+            return False
+        for pid, counter in after.items():
+            if self._counters.get(pid) != counter:
+                return False
+        return True
+
+    def _fillsGap(self, data):
+        """True if data continues the stream and one of the held datagrams continues data.
+        The counters wrap after 16 packets, so after a loss a datagram may fit by chance."""
+        after = self._fits(data)
+        if after is None:
+            return False
+        last = self._counters.copy()
+        last.update(after)
+        for datagram in self._held:
+            if self._fits(datagram, last) is not None:
+                return True
+        return False
+
+    def _giveUp(self):
+        """Send the oldest held datagram although the gap in front of it is still open"""
+        self.lateDatagrams += 1
+        self._send(self._held.pop(0))
+        self._sendHeld(reordered=False)
+
+    def _sendHeld(self, reordered=True):
+        """Send held datagrams that fit now"""
+        found = True
+        while found and self._held:
+            found = False
+            for datagram in self._held:
+                if self._fits(datagram) is not None:
+                    self._held.remove(datagram)
+                    if reordered:
+                        self.reorderedDatagrams += 1
+                    self._send(datagram)
+                    found = True
+                    break
+
+    def _send(self, data):
+        last = self._counters
+        for pid, counter, flags, pos in counters(data):
+            previous = last.get(pid)
+            last[pid] = counter
+            if previous is None or counter == (previous + 1) & 0x0f or counter == previous:
+                continue
+            if flags & 0x20 and ord(data[pos + 4]) and ord(data[pos + 5]) & 0x80:
+                # discontinuity_indicator
+                continue
+            self.continuityErrors[pid] = self.continuityErrors.get(pid, 0) + 1
+            self.lostPackets += (counter - previous - 1) & 0x0f
+
+        self._batch.append(data)
+        self._batchPackets += len(data) // TS_PACKET_SIZE
+        if self._batchPackets >= self.batchPackets:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self.maxDelay, self._timeout)
+
+    def _timeout(self):
+        self._timer = None
+        if self._held:
+            # Nothing arrived to fill the gap in time
+            self._giveUp()
+        self.flush()
+
+    def flush(self):
+        """Send what is collected"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._batch:
+            data = ''.join(self._batch)
+            self._batch = []
+            self._batchPackets = 0
+            self.sendDataToAllOutlets(data)
+
+    def getStats(self):
+        stats = super(UDPTSServer, self).getStats()
+        stats['datagrams'] = self.datagrams
+        stats['bytesReceived'] = self.bytesReceived
+        stats['receiveBuffer'] = self.receiveBufferActual
+        stats['invalidDatagrams'] = self.invalidDatagrams
+        stats['reorderedDatagrams'] = self.reorderedDatagrams
+        stats['lateDatagrams'] = self.lateDatagrams
+        stats['duplicateDatagrams'] = self.duplicateDatagrams
+        stats['heldDatagrams'] = len(self._held)
+        stats['lostPackets'] = self.lostPackets
+        stats['continuityErrors'] = sum(self.continuityErrors.values())
+        stats['continuityErrorsByPid'] = dict([('0x%04x' % pid, errors) for pid, errors in self.continuityErrors.items()])
+        return stats
+
+    def __str__(self):
+        if self.multicastGroup:
+            return "%s <-%s:%s" % (self.__class__.__name__, self.multicastGroup, self.port)
+        return "%s <-%s:%s" % (self.__class__.__name__, self.hostname, self.port)
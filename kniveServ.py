@@ -25,6 +25,10 @@ import logging.handlers
 import os
 import sys
 
+if sys.argv[1:2] == ['benchmark-ladder']:
+    # Capacity planning. Doesn't start the server.
+    from knive.ladder import main
+    sys.exit(main(sys.argv[2:]))
 
 from knive.knive  import  makeKnive, KniveLogggingObserver
 # from knive  import streaming
@@ -80,7 +84,7 @@ rootLogger.addHandler(logfile)
 logging.info("Knive starting..")
 
 if knive.config['webservice']['enabled']:
-    webservice = web.WebKnive(port=knive.config['webservice']['port'],backend=knive)
+    webservice = web.WebKnive(port=knive.config['webservice']['port'],backend=knive,accessLog=knive.config['webservice']['accessLog'])
     webservice.setServiceParent(knive)
 
     # webLogging = logging.StreamHandler(webservice)
@@ -0,0 +1,399 @@
+#
+# hls.py
+# Copyright (c) 2012 Thorsten Philipp <kyrios@kyri0s.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Serves the playlists and segments of HTTPLive outlets to many players at once.
+
+All players of a channel ask for the same few objects: the playlists (about once per target
+duration) and the newest segments. So the response of every object is prepared once and shared
+by every request:
+
+- :class:`HLSObject` holds the body, a strong ETag, the Cache-Control header and for playlists
+  the gzip compressed body.
+- :class:`HLSObjectCache` keeps them. Objects of a segment store (storage 'memory' or 'both') are
+  valid as long as the store holds the same data. Objects read from outputLocation (storage 'disk')
+  are valid as long as os.stat of the file does not change. Files are read in the disk I/O pool.
+
+A request then costs a dictionary lookup, a few headers and the write of a shared string. Twisted
+hands the string to the socket without copying it.
+
+.. moduleauthor:: Thorsten Philipp <kyrios@kyri0s.de>
+
+"""
+
+from twisted.web            import server
+from twisted.web.resource   import Resource
+from twisted.internet       import defer
+
+from knive.diskio import getPool, deferToDiskIO
+
+from collections import OrderedDict
+
+import errno
+import logging
+import os
+import re
+import zlib
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/MP2T',
+    '.aac': 'audio/aac',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.m4a': 'audio/mp4',
+}
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def gzipData(data, level=6):
+    """Return data gzip compressed"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def parseRange(header, length):
+    """Return (first, last) byte of a Range header for a body of length bytes. None if the header
+    can't be used (several ranges or garbage, the whole body is sent then). False if it is
+    unsatisfiable."""
+    match = RANGE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The last bytes
+        first, last = max(length - int(last), 0), length - 1
+    else:
+        first = int(first)
+        last = min(int(last), length - 1) if last else length - 1
+    if first >= length or first > last:
+        return False
+    return first, last
+
+
+def etagMatches(header, etag):
+    """True if the If-None-Match header lists etag (weak comparison) or is '*'"""
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag or tag == 'W/' + etag:
+            return True
+    return False
+
+
+class HLSObject(object):
+    """The prepared response of a playlist or segment"""
+
+    minimumGzipSize = 512
+    """Smaller playlists are sent as they are"""
+
+    def __init__(self, data, contentType, cacheControl, compress=False, source=None):
+        """
+        Args:
+            data: The body
+            contentType: Content-Type header
+            cacheControl: Cache-Control header
+
+        Kwargs:
+            compress: Prepare a gzip compressed body as well (playlists)
+            source: What the object was made from. The cache compares it to find stale objects.
+        """
+        super(HLSObject, self).__init__()
+        self.data = data
+        self.contentType = contentType
+        self.cacheControl = cacheControl
+        self.source = source
+        self.etag = '"%x-%08x"' % (len(data), zlib.adler32(data) & 0xffffffff)
+        """Strong ETag from the length and the checksum of the body. Same body, same ETag (also after a restart)."""
+        self.gzipped = None
+        self.gzipEtag = None
+        if compress and len(data) >= self.minimumGzipSize:
+            self.gzipped = gzipData(data)
+            self.gzipEtag = self.etag[:-1] + '-gz"'
+
+    @property
+    def size(self):
+        return len(self.data) + (len(self.gzipped) if self.gzipped is not None else 0)
+
+
+class HLSObjectCache(object):
+    """Prepared responses of recent playlists and segments, least recently used first. Bounded by maxBytes.
+
+    Objects of a store share the data with the store, so they are cheap. Objects of files own it.
+    Concurrent requests for a file that is not cached wait for the same read.
+    """
+
+    maxBytes = 268435456
+    """256 MB. Holds the recent segments of a few dozen variants."""
+
+    def __init__(self, maxBytes=None):
+        super(HLSObjectCache, self).__init__()
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+        self.log = logging.getLogger('[%s]' % self.__class__.__name__)
+        self.objects = OrderedDict()
+        """Keys mapped to :class:`HLSObject`"""
+        self.bytesCached = 0
+        self.hits = 0
+        self.misses = 0
+        self.fileReads = 0
+        self.readErrors = 0
+        """Reads that failed for another reason than a missing file"""
+        self._reading = {}
+        """Paths mapped to the Deferreds waiting for their read"""
+
+    def _lookup(self, key, source):
+        obj = self.objects.pop(key, None)
+        if obj is None:
+            return None
+        if obj.source is not source and obj.source != source:
+            self.bytesCached -= obj.size
+            return None
+        self.objects[key] = obj
+        self.hits += 1
+        return obj
+
+    def _add(self, key, obj):
+        self.misses += 1
+        self.objects[key] = obj
+        self.bytesCached += obj.size
+        while self.bytesCached > self.maxBytes and len(self.objects) > 1:
+            oldKey, oldObj = self.objects.popitem(last=False)
+            self.bytesCached -= oldObj.size
+        return obj
+
+    def discard(self, key):
+        obj = self.objects.pop(key, None)
+        if obj is not None:
+            self.bytesCached -= obj.size
+
+    def get(self, key, data, contentType, cacheControl, compress=False):
+        """Return the object of data. Prepared again when data is not the data of the cached object."""
+        obj = self._lookup(key, data)
+        if obj is None:
+            obj = self._add(key, HLSObject(data, contentType, cacheControl, compress=compress, source=data))
+        return obj
+
+    def getFile(self, path, contentType, cacheControl, compress=False):
+        """Return a Deferred firing with the object of the file at path or with None if it does not exist"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.discard(path)
+            return defer.succeed(None)
+        source = (stat.st_ino, stat.st_size, stat.st_mtime)
+        obj = self._lookup(path, source)
+        if obj is not None:
+            return defer.succeed(obj)
+
+        d = defer.Deferred()
+        waiters = self._reading.get(path)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._reading[path] = [d]
+
+        def _read():
+            with open(path, 'rb') as f:
+                return f.read()
+
+        def _cache(data):
+            return self._add(path, HLSObject(data, contentType, cacheControl, compress=compress, source=source))
+
+        def _failed(failure):
+            if isinstance(failure.value, EnvironmentError) and failure.value.errno == errno.ENOENT:
+                # Deleted by the playlist rotation in the meantime
+                self.log.debug('Could not read %s: %s' % (path, failure.getErrorMessage()))
+            else:
+                self.readErrors += 1
+                self.log.error('Could not read %s: %s' % (path, failure.getErrorMessage()))
+            return None
+
+        def _answer(obj):
+            # Every request waiting for the file gets an answer, whatever happened
+            for waiter in self._reading.pop(path, []):
+                if not waiter.called:
+                    waiter.callback(obj)
+
+        self.fileReads += 1
+        read = deferToDiskIO(getPool(), path, 'read', _read)
+        read.addCallback(_cache)
+        read.addErrback(_failed)
+        read.addBoth(_answer)
+        return d
+
+    def getStats(self):
+        return {
+            'objects': len(self.objects),
+            'bytesCached': self.bytesCached,
+            'hits': self.hits,
+            'misses': self.misses,
+            'fileReads': self.fileReads,
+            'readErrors': self.readErrors,
+        }
+
+
+class WebLive(Resource):
+    """Serves segments and playlists of HTTPLive outlets.
+    URLs look like /live/<channel slug>/<quality>/<filename>. The master playlist is /live/<channel slug>/index.m3u8
+
+    With storage 'memory' or 'both' objects come from the segment store of the variant, with 'disk' (and
+    segments that left the store with 'both') from its directory in outputLocation.
+
+    Every response has a strong ETag (If-None-Match is answered with 304) and a Cache-Control header:
+    segments and parts never change, playlists change every segment (or part). Playlists are sent gzip
+    compressed to clients that accept it. Range requests get 206 (one range per request).
+
+    Low latency HLS: a playlist request with _HLS_msn (and _HLS_part) is held until the playlist
+    contains that segment (part). A request for the part in the preload hint is held until the part
+    exists. Held requests are Deferreds, they cost no thread. See :class:`knive.httplive.HTTPLiveSegmentStore`.
+    """
+
+    isLeaf = True
+
+    segmentCacheControl = 'public, max-age=31536000, immutable'
+    """Segment names are unique across restarts of a stream (see :attr:`knive.httplive.HTTPLiveStream.runId`)"""
+    playlistCacheControl = 'public, max-age=1'
+    """Live playlists change every target duration (every part with low latency HLS)"""
+    blockingPlaylistCacheControl = 'public, max-age=60'
+    """A blocking reload (_HLS_msn) URL always gets the same playlist"""
+    masterCacheControl = 'public, max-age=10'
+    errorCacheControl = 'no-cache'
+
+    def __init__(self, backend, cache=None):
+        Resource.__init__(self)
+        self.backend = backend
+        self.cache = cache if cache is not None else HLSObjectCache()
+
+    def _object(self, key, data, filename):
+        """The cached object of data (a segment, part or playlist called filename)"""
+        extension = os.path.splitext(filename)[1]
+        contentType = CONTENT_TYPES.get(extension, 'application/octet-stream')
+        if extension == '.m3u8':
+            return self.cache.get(key, data, contentType, self.playlistCacheControl, compress=True)
+        return self.cache.get(key, data, contentType, self.segmentCacheControl)
+
+    def render_GET(self, request):
+        if request.postpath[-1:] == ['index.m3u8'] and len(request.postpath) == 2:
+            slug = request.postpath[0]
+            data = self.backend.getMasterPlaylist(slug)
+            if data is None:
+                return self._error(request, 404, 'Not found')
+            obj = self.cache.get(('master', slug), data, CONTENT_TYPES['.m3u8'], self.masterCacheControl, compress=True)
+            return self._send(request, obj)
+
+        variant = None
+        if len(request.postpath) == 3:
+            slug, quality, filename = request.postpath
+            if not filename.startswith('.'):
+                variant = self.backend.getVariantStream(slug, quality)
+        if variant is None:
+            return self._error(request, 404, 'Not found')
+        store = variant.store
+
+        if store is not None:
+            if '_HLS_msn' in request.args and filename in store.playlists:
+                try:
+                    msn = int(request.args['_HLS_msn'][0])
+                    part = int(request.args['_HLS_part'][0]) if '_HLS_part' in request.args else None
+                except ValueError:
+                    return self._error(request, 400, 'Bad _HLS_msn or _HLS_part')
+                d = store.waitForPlaylist(filename, msn, part)
+                if d is None:
+                    return self._error(request, 400, 'Segment %d is too far in the future' % msn)
+                return self._respondLater(request, d, (id(store), filename), filename, self.blockingPlaylistCacheControl)
+            data = store.get(filename)
+            if data is not None:
+                return self._send(request, self._object((id(store), filename), data, filename))
+            d = store.waitForPart(filename)
+            if d is not None:
+                return self._respondLater(request, d, (id(store), filename), filename)
+
+        if variant.segmenter.writeToDisk and variant.destinationDirectory:
+            extension = os.path.splitext(filename)[1]
+            d = self.cache.getFile(os.path.join(variant.destinationDirectory, filename),
+                                   CONTENT_TYPES.get(extension, 'application/octet-stream'),
+                                   self.playlistCacheControl if extension == '.m3u8' else self.segmentCacheControl,
+                                   compress=extension == '.m3u8')
+            return self._respondLater(request, d)
+        return self._error(request, 404, 'Not found')
+
+    def _error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Cache-Control', self.errorCacheControl)
+        request.setHeader('Content-Type', 'text/plain')
+        return message
+
+    def _send(self, request, obj, cacheControl=None):
+        """Set the headers for obj and return the body (or the part of it the request asks for)"""
+        request.setHeader('Content-Type', obj.contentType)
+        request.setHeader('Cache-Control', cacheControl or obj.cacheControl)
+        request.setHeader('Accept-Ranges', 'bytes')
+        data, etag = obj.data, obj.etag
+        rangeHeader = request.getHeader('range')
+        if obj.gzipped is not None:
+            request.setHeader('Vary', 'Accept-Encoding')
+            if rangeHeader is None and 'gzip' in (request.getHeader('accept-encoding') or ''):
+                data, etag = obj.gzipped, obj.gzipEtag
+                request.setHeader('Content-Encoding', 'gzip')
+        request.setHeader('ETag', etag)
+
+        noneMatch = request.getHeader('if-none-match')
+        if noneMatch is not None and etagMatches(noneMatch, etag):
+            request.setResponseCode(304)
+            return ''
+        ifRange = request.getHeader('if-range')
+        if rangeHeader is not None and (ifRange is None or ifRange == etag):
+            byteRange = parseRange(rangeHeader, len(data))
+            if byteRange is False:
+                request.setResponseCode(416)
+                request.setHeader('Content-Range', 'bytes */%d' % len(data))
+                return ''
+            if byteRange is not None:
+                first, last = byteRange
+                request.setResponseCode(206)
+                request.setHeader('Content-Range', 'bytes %d-%d/%d' % (first, last, len(data)))
+                data = data[first:last + 1]
+        return data
+
+    def _respondLater(self, request, d, key=None, filename=None, cacheControl=None):
+        """Answer request when d fires with the data of filename (cached under key) or with an :class:`HLSObject`.
+        With None (held too long or not found) the answer is 503 (404 for files)."""
+        def _respond(result):
+            if result is None:
+                if key is None:
+                    body = self._error(request, 404, 'Not found')
+                else:
+                    body = self._error(request, 503, 'Not available yet')
+            else:
+                obj = result if key is None else self._object(key, result, filename)
+                body = self._send(request, obj, cacheControl)
+            request.setHeader('Content-Length', str(len(body)))
+            if request.method != 'HEAD':
+                request.write(body)
+            request.finish()
+        def _ignore(failure):
+            # The client went away, d was cancelled
+            failure.trap(defer.CancelledError)
+        request.notifyFinish().addErrback(lambda _: d.cancel())
+        d.addCallbacks(_respond, _ignore)
+        return server.NOT_DONE_YET
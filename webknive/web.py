@@ -10,14 +10,30 @@ from zope.interface                 import implements
 from twisted.internet.interfaces    import ILoggingContext
 
 import broadcast
+from hls import WebLive
+from knive.stats import renderPrometheus
 import logging
 import os
 import json
         
+class WebSite(Site):
+    """A Site that writes the access log only if accessLog is set. With thousands of players polling
+    playlists the log line of every request costs more than the request."""
+
+    accessLog = True
+
+    def log(self, request):
+        if self.accessLog:
+            Site.log(self, request)
+
+
 class WebKnive(service.Service):
     """Web(server) backend for Knive"""
 
-    def __init__(self, hostname="localhost", port=8002, resourcepath=None, backend=None):
+    backlog = 1024
+    """Pending connections. Low latency HLS players reconnect in bursts (at every part)."""
+
+    def __init__(self, hostname="localhost", port=8002, resourcepath=None, backend=None, accessLog=True):
         self.hostname = hostname
         self.port = port
         self.backend = backend
@@ -30,14 +46,21 @@ class WebKnive(service.Service):
          
         self.root = static.File(self.resourcepath)         
         self.root.putChild('data',WebData(self.backend))
+        self.root.putChild('live',WebLive(self.backend))
+        self.root.putChild('metrics',WebMetrics(self.backend))
+        self.root.putChild('stats',WebStats(self.backend))
+        self.root.putChild('remux',WebRemux(self.backend))
        
         #self.wsFact = broadcast.BroadcastServerFactory("ws://localhost:9002")
         # root.putChild("doc", static.File("/usr/share/doc"))
         # self.cometApi = Root('http://%s:%s/' % (self.hostname,self.port))
         
+        site = WebSite(self.root)
+        site.accessLog = accessLog
         self.site = internet.TCPServer(
                                             self.port, 
-                                            server.Site(self.root)
+                                            site,
+                                            backlog=self.backlog
                                         )
         # self.ws = internet.TCPServer(
         #                                     self.port+1,
@@ -91,6 +114,36 @@ class WebRootTree(KniveResource):
             
         return json.dumps(returnSon)
 
+class WebMetrics(KniveResource):
+    """Counters and rates of every channel in the Prometheus text format"""
+
+    def setup(self):
+        self.isLeaf = True
+
+    def render_GET(self,request):
+        request.setHeader('Content-Type','text/plain; version=0.0.4')
+        return renderPrometheus(self.backend.getStats())
+
+class WebStats(KniveResource):
+    """Counters and rates of every channel as JSON"""
+
+    def setup(self):
+        self.isLeaf = True
+
+    def render_GET(self,request):
+        request.setHeader('Content-Type','application/json')
+        return json.dumps(self.backend.getStats(),indent=4)
+
+class WebRemux(KniveResource):
+    """Progress and results of the remux jobs of recorded episodes as JSON"""
+
+    def setup(self):
+        self.isLeaf = True
+
+    def render_GET(self,request):
+        request.setHeader('Content-Type','application/json')
+        return json.dumps(self.backend.getRemuxStats(),indent=4)
+
 class WebData(KniveResource):
     """docstring for WebData"""
     def setup(self):